@@ -12,25 +12,39 @@ Date: 26/06/2023
 Usage:
     - Instantiate the `Scraper` class with the path to the configuration file.
     - Call the `scrape_site` method to initiate the scraping process.
+    - Or call `scrape_site_parallel` to crawl a page range with a pool of drivers.
+    - Pass `resume=True` to continue a crawl from its checkpoint.
 
 Example:
     scraper = Scraper('config.yaml')
     scraper.scrape_site()
 
 """
+import atexit
+import copy
 import json
+import logging
+import math
+import os
+import queue
+import socket
+import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from urllib.parse import urlparse
 import yaml
-import requests
-from bs4 import BeautifulSoup
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException
 from lxml import html
-from  lxml.etree import tostring
+from fetcher import HttpFetcher, find_static_element
+from extraction import ExtractionPlan
+from checkpoint import CheckpointStore
+from frontier import Frontier
+from pagecache import PageCache
+from metrics import CrawlMetrics, ErrorCounter, configure_logging
+
+logger = logging.getLogger(__name__)
 
 
 class PageInteractor:
@@ -38,39 +52,163 @@ class PageInteractor:
         self.driver = driver
 
     def click_element(self, by_method, value):
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, NoSuchElementException
         try:
             element = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((by_method, value)))
             element.click()
         except TimeoutException:
-            print("TimeoutException: Timed out waiting for element to be clickable.")
+            logger.error("TimeoutException: Timed out waiting for element to be clickable.")
         except NoSuchElementException:
-            print(f"No such element found with {by_method} '{value}'.")
+            logger.error(f"No such element found with {by_method} '{value}'.")
         except Exception as error:
-            print(f"An error occurred during clicking on the element: {str(error)}")
+            logger.error(f"An error occurred during clicking on the element: {str(error)}")
 
     def enter_text(self, by_method, value, text):
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, NoSuchElementException
         try:
             element = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((by_method, value)))
             element.clear()
             element.send_keys(text)
         except TimeoutException:
-            print("TimeoutException: Timed out waiting for element to be present.")
+            logger.error("TimeoutException: Timed out waiting for element to be present.")
         except NoSuchElementException:
-            print(f"No such element found with {by_method} '{value}'.")
+            logger.error(f"No such element found with {by_method} '{value}'.")
         except Exception as error:
-            print(f"An error occurred during entering text: {str(error)}")
+            logger.error(f"An error occurred during entering text: {str(error)}")
 
     def scroll_to_element(self, by_method, value):
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, NoSuchElementException
         try:
             element = WebDriverWait(self.driver, 10).until(EC.presence_of_element_located((by_method, value)))
             self.driver.execute_script("arguments[0].scrollIntoView();", element)
         except TimeoutException:
-            print("TimeoutException: Timed out waiting for element to be present.")
+            logger.error("TimeoutException: Timed out waiting for element to be present.")
         except NoSuchElementException:
-            print(f"No such element found with {by_method} '{value}'.")
+            logger.error(f"No such element found with {by_method} '{value}'.")
         except Exception as error:
-            print(f"An error occurred during scrolling: {str(error)}")
+            logger.error(f"An error occurred during scrolling: {str(error)}")
+
+
+SINK_METHODS = ('send_data',)  # Methods receiving the extracted records
+RAW_METHODS = ('scrap_page',)  # Methods returning raw page HTML
+NAVIGATION_METHODS = ('goto_next_page', 'goto_link')  # Methods loading a new page
+BLOCKED_RESOURCE_PATTERNS = {  # URL patterns blocked in the browser per resource type
+    'image': ['*.png*', '*.jpg*', '*.jpeg*', '*.gif*', '*.webp*', '*.avif*', '*.svg*', '*.ico*'],
+    'media': ['*.mp4*', '*.webm*', '*.m3u8*', '*.mp3*', '*.ogg*'],
+    'font': ['*.woff*', '*.ttf*', '*.otf*', '*.eot*'],
+    'stylesheet': ['*.css*'],
+}
+
+
+class PolitenessLimiter:
+    """
+    Throttle navigation per domain.
+
+    Every domain gets a minimum delay between two consecutive requests and an
+    optional cap on the number of requests in flight at the same time. Limits
+    are read from the `politeness` section of the configuration, with
+    per-domain overrides under `domains`.
+    """
+
+    def __init__(self, config=None):
+        """
+        Initialize the limiter.
+
+        Args:
+            config (dict): The politeness configuration (optional).
+        """
+        config = config or {}
+        self.defaults = {
+            'min_delay': config.get('min_delay', 0),
+            'max_concurrent': config.get('max_concurrent'),
+        }
+        self.domains = config.get('domains') or {}
+        self._lock = threading.Lock()
+        self._next_slot = {}
+        self._semaphores = {}
+
+    def _limits(self, domain):
+        limits = dict(self.defaults)
+        limits.update(self.domains.get(domain, {}))
+        return limits
+
+    def _semaphore(self, domain, max_concurrent):
+        if not max_concurrent:
+            return None
+        with self._lock:
+            if domain not in self._semaphores:
+                self._semaphores[domain] = threading.BoundedSemaphore(max_concurrent)
+            return self._semaphores[domain]
+
+    @contextmanager
+    def slot(self, url):
+        """
+        Wait for a free slot on the domain of the given URL.
+
+        Args:
+            url (str): The URL about to be requested.
+        """
+        domain = urlparse(url).netloc
+        limits = self._limits(domain)
+        semaphore = self._semaphore(domain, limits['max_concurrent'])
+        if semaphore:
+            semaphore.acquire()
+        try:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_slot.get(domain, now))
+                self._next_slot[domain] = start + limits['min_delay']
+            if start > now:
+                time.sleep(start - now)
+            yield
+        finally:
+            if semaphore:
+                semaphore.release()
+
+
+class DriverPool:
+    """A fixed-size pool of pre-warmed Selenium drivers."""
+
+    def __init__(self, factory, size):
+        """
+        Start `size` drivers in parallel using the given factory.
+
+        Args:
+            factory (callable): Returns a ready-to-use web driver.
+            size (int): The number of drivers in the pool.
+        """
+        self._idle = queue.Queue()
+        self._drivers = []
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            for driver in executor.map(lambda _: factory(), range(size)):
+                self._drivers.append(driver)
+                self._idle.put(driver)
+
+    @contextmanager
+    def driver(self):
+        """Borrow a driver from the pool, blocking until one is idle."""
+        driver = self._idle.get()
+        try:
+            yield driver
+        finally:
+            self._idle.put(driver)
 
+    def close(self):
+        """Quit every driver of the pool."""
+        for driver in self._drivers:
+            if driver is None:
+                continue
+            try:
+                driver.quit()
+            except Exception as error:
+                logger.error(f"An error occurred while closing a driver: {str(error)}")
+        self._drivers = []
 
 
 class Scraper:
@@ -84,45 +222,227 @@ class Scraper:
             config_file (str): Path to the configuration file.
         """
         self.config_filename = config_file
-        print("> Scraper Initialized")
-        print("-------------------")
-        print(f"Configuration File: {config_file}")
         with open(config_file, 'r',encoding='utf-8') as file:
             config = yaml.safe_load(file)
         self.config = config
+        logger.info("> Scraper Initialized")
+        logger.info(f"Configuration File: {config_file}")
         self.driver = None
-        print("\nSteps and Parameters:")
-        print('######################')
         states = self.config.get('states', {})
         for state, step in states.items():
-            print(f">State: {state}")
-            print(f"    Method: {step.get('method')}")
-            print(f"    Next state: {step.get('next_state')}")
+            logger.debug(f">State: {state}")
+            logger.debug(f"    Method: {step.get('method')}")
+            logger.debug(f"    Next state: {step.get('next_state')}")
             parameters = step.get('parameters', {})
-            if parameters:
-                print(" Parameters:")
-                for key, value in parameters.items():
-                    print(f"        {key}: {value}")
-            print("----------------------")
+            for key, value in parameters.items():
+                logger.debug(f"        {key}: {value}")
         self.step_results = {}  # Store results of each step
+        self.interactive = self.config.get('interactive', True)  # Pause after each step, when run from a terminal
+        self.save_progress = True  # Record the progress of the crawl in the checkpoint store
+        checkpoint_config = self.config.get('checkpoint', {})
+        self.crawl_id = checkpoint_config.get('crawl_id') or os.path.splitext(os.path.basename(config_file))[0]
+        self.checkpoint = CheckpointStore(
+            checkpoint_config.get('path', f"{os.path.splitext(config_file)[0]}.checkpoint.sqlite"),
+            lease=checkpoint_config.get('lease', 600),
+        )
+        concurrency = self.config.get('concurrency', {})
+        self.limiter = PolitenessLimiter(concurrency.get('politeness'))
+        http_config = self.config.get('http', {})
+        self.fetcher = HttpFetcher(
+            self.config.get('userAgent'),
+            pool_size=http_config.get('pool_size', max(10, concurrency.get('workers', 1))),
+            timeout=http_config.get('timeout', 15),
+        )
+        self.engine = self.config.get('engine', 'browser')  # Fetch backend of the current state
+        self.current_url = None  # Last URL navigated to
+        self.current_wait = None  # Readiness condition of the navigation to current_url, for a browser fallback
+        self.browser_url = None  # Last URL loaded in the driver
+        self.page_source = None  # Static HTML of the current URL, if fetched over HTTP
+        page_cache_config = self.config.get('page_cache')
+        self.page_cache = PageCache(page_cache_config.get('path', f"{os.path.splitext(config_file)[0]}.pages.sqlite")) \
+            if page_cache_config else None
+        self.offline = bool(page_cache_config and page_cache_config.get('offline'))  # Replay cached pages only
+        self.page_unchanged = False  # The current URL answered 304 Not Modified
+        self.page_skipped = False  # scrap_page skipped the current URL as unchanged
+        self.wait_times = deque(maxlen=1000)  # Duration of the latest readiness waits
+        self.current_state = None  # State being executed by scrape_site
+        self.plans = self._compile_plans(states)  # Compiled extraction plan per state
+        self.sinks = {}  # Buffered sink per address, when the `sink` section is set
+        self._sinks_lock = threading.Lock()
+        self.frontier = None  # Seen-set and URL queue, opened on first use
+        self.normalizer = None  # Typed row conversion of the `normalize` section, created on first use
+        self.started = time.time()  # Priority of the URLs queued by this crawl
+        self.known_pages = 0  # Consecutive pages without a new record
+        self.empty_results = 0  # Consecutive empty results routed to `on_empty`
+        self.stop_crawl = False  # Set by a state to end the crawl after it
+        self._crawl_stopped = threading.Event()  # Set when a worker ends a parallel crawl
+        self._pending_urls = {}  # New URLs of the current cycle, added to the seen-set when it completes
+        self._pending_pages = {}  # Page cache writes of the current cycle, applied when it completes
+        self._undelivered = []  # Completed cycles whose records are not delivered yet, shared with the workers
+        self._undelivered_lock = threading.Lock()
+        self._streaming = False  # The records are batched by scrape_site before reaching the sink
+        self._link = None  # URL popped from the frontier by next_link
+        self.metrics = CrawlMetrics(self.crawl_id)  # Per-state counters, shared with the workers
+        self._sink_retries = {}  # Sink retries already counted, per address
+        self._start_metrics(self.config.get('metrics', {}))
 
         #self.init_driver()
 
+    def _start_metrics(self, settings):
+        """
+        Expose the metrics as configured in the `metrics` section.
+
+        Errors logged while a state runs are counted in its metrics.
+
+        Args:
+            settings (dict): The `port` of the Prometheus endpoint and/or the
+                `snapshot_file` written every `snapshot_interval` seconds (default 30).
+        """
+        self._error_counter = ErrorCounter.attach(self.metrics)
+        if settings.get('port') is not None:
+            self.metrics.serve(settings['port'], settings.get('host', '0.0.0.0'))
+        if settings.get('snapshot_file'):
+            self.metrics.start_snapshots(settings['snapshot_file'], settings.get('snapshot_interval', 30))
+        if settings:
+            atexit.register(self.metrics.close)
+
+    def close_metrics(self):
+        """Stop counting the logged errors in the metrics of this scraper, and stop exposing them."""
+        self._error_counter.detach()
+        self.metrics.close()
+
+    def _compile_plans(self, states):
+        """
+        Compile the extraction plan of every extraction state.
+
+        Args:
+            states (dict): The states of the configuration.
+
+        Returns:
+            dict: The compiled `ExtractionPlan` by state name.
+
+        Raises:
+            ValueError: If a selector or field specification of a state is invalid.
+        """
+        plans = {}
+        for state, step in states.items():
+            if step.get('method') not in ('extract_records', 'extract_infos'):
+                continue
+            parameters = step.get('parameters', {})
+            try:
+                plans[state] = ExtractionPlan(parameters.get('selectors'), parameters.get('data_to_find'))
+            except ValueError as error:
+                raise ValueError(f"Invalid extraction parameters in state '{state}': {str(error)}") from error
+        return plans
+
+    def _get_plan(self, selectors=None, data_to_find=None):
+        """
+        Return the compiled plan of the current state, or compile one for direct calls.
+
+        Args:
+            selectors (list): The selectors (optional).
+            data_to_find (dict): The field specifications (optional).
+
+        Returns:
+            ExtractionPlan: The extraction plan.
+        """
+        plan = self.plans.get(self.current_state)
+        if plan is not None and plan.matches(selectors, data_to_find):
+            return plan
+        return ExtractionPlan(selectors, data_to_find)
+
     def init_driver(self):
         """
         Initialize the web driver for Selenium.
         """
+        self.driver = self._create_driver()
+
+    def _create_driver(self):
+        """
+        Create a new web driver with the profile of the `driver` section, and warm it up.
+
+        Returns:
+            WebDriver: The ready-to-use driver.
+        """
+        from selenium import webdriver
+        settings = self.config.get('driver', {})
+        driver = webdriver.Chrome(options=self._driver_options(settings), service_log_path='selenium.txt')
+        script = "Object.defineProperty(navigator, 'webdriver', {get: () => undefined})"
+        try:
+            # Run on every page loaded, not only on the blank page the driver starts on
+            driver.execute_cdp_cmd('Page.addScriptToEvaluateOnNewDocument', {'source': script})
+            blocked = self._blocked_urls(settings)
+            if blocked or settings.get('cache') is False:
+                driver.execute_cdp_cmd('Network.enable', {})
+            if blocked:
+                driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': blocked})
+            if settings.get('cache') is False:
+                driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled': True})
+        except Exception as error:
+            logger.error(f"An error occurred while configuring the driver: {str(error)}")
+            driver.execute_script(script)
+        driver.delete_all_cookies()
+        warm_up = settings.get('warm_up', 'https://www.google.com/')
+        if warm_up:
+            driver.get(url=warm_up)
+            self._wait_ready(driver=driver)
+        return driver
+
+    def _driver_options(self, settings):
+        """
+        Build the Chrome options of the driver profile.
+
+        Args:
+            settings (dict): The `driver` section of the configuration.
+
+        Returns:
+            Options: The Chrome options.
+        """
+        from selenium.webdriver.chrome.options import Options
         options = Options()
         options.add_argument('--disable-logging')
         options.add_argument('--disable-blink-features=AutomationControlled')
         options.add_argument(f"user-agent={self.config['userAgent']}")
         options.add_argument('--log-level=3')
-        self.driver = webdriver.Chrome(options=options, service_log_path='selenium.txt')
-        script = "Object.defineProperty(navigator, 'webdriver', {get: () => undefined})"
-        self.driver.execute_script(script)
-        self.driver.delete_all_cookies()
-        self.driver.get(url='https://www.google.com/')
-        time.sleep(1.5)
+        if settings.get('headless'):
+            options.add_argument('--headless=new')
+            options.add_argument(f"--window-size={settings.get('window_size', '1920,1080')}")
+        options.add_argument('--disable-extensions')
+        options.add_argument('--mute-audio')
+        if 'image' in settings.get('block_resources', []):
+            # Also covers the images whose URL has no extension
+            options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        if settings.get('cache_dir'):
+            # A disk cache shared by the drivers of the pool
+            options.add_argument(f"--disk-cache-dir={settings['cache_dir']}")
+        if settings.get('page_load_strategy'):
+            options.page_load_strategy = settings['page_load_strategy']
+        for argument in settings.get('arguments', []):
+            options.add_argument(argument)
+        return options
+
+    @staticmethod
+    def _blocked_urls(settings):
+        """
+        Return the URL patterns the driver must not download.
+
+        Args:
+            settings (dict): The `driver` section of the configuration.
+
+        Returns:
+            list: The patterns of the blocked resource types and domains.
+
+        Raises:
+            ValueError: If a resource type is not supported.
+        """
+        patterns = []
+        for resource in settings.get('block_resources', []):
+            if resource not in BLOCKED_RESOURCE_PATTERNS:
+                raise ValueError(f"Invalid resource type to block: {resource}")
+            patterns.extend(BLOCKED_RESOURCE_PATTERNS[resource])
+        for domain in settings.get('block_domains', []):
+            patterns.extend([f"*://{domain}/*", f"*.{domain}/*"])
+        return patterns + settings.get('block_urls', [])
     
     def get_nested_data(self, data, navigation_params):
         """Recursively navigate through nested data using provided navigation parameters.
@@ -169,10 +489,7 @@ class Scraper:
         navigation_params = kwargs['get']
 
         # Return the desired data
-        print(source)
-        print(navigation_params)
-        print(source)
-        input()
+        logger.debug(f"Getting {navigation_params} from {kwargs['source']}")
         return self.get_nested_data(source, navigation_params)
 
     def scrap_page(self, by_method, value):
@@ -184,26 +501,97 @@ class Scraper:
             value (str): The value to search for.
 
         Returns:
-            str: The HTML content of the page, or None if an error occurred.
+            str: The HTML content of the page, or None if an error occurred
+            or if the page did not change since the last visit.
+
+        Note:
+            With the `http` and `auto` engines the element is looked up in the
+            static HTML first. The `auto` engine falls back to the browser when
+            it is missing there.
+
+            With a `page_cache` section, a page that answered `304 Not
+            Modified` or whose content hashes as on the last visit is skipped
+            (unless `page_cache.skip_unchanged` is false): route the state's
+            `on_unchanged` to the next page so that it is not extracted again.
+            The hash is stored once the FSM completes the cycle, so that a page
+            whose extraction or delivery failed is scraped again.
         """
+        if self.page_cache is None or self.offline:
+            return self._scrap_element(by_method, value)
+        skip_unchanged = self.config['page_cache'].get('skip_unchanged', True)
+        if self.page_unchanged and skip_unchanged:
+            self.page_cache.stats['not_modified'] += 1
+            logger.info(f"> {self.current_url} was not modified, skipping it.")
+            self.page_skipped = True
+            if self.config.get('frontier'):
+                self._count_known_page()
+            return None
+        page_html = self._scrap_element(by_method, value)
+        if page_html is None or self.current_url is None:
+            return page_html
+        page = self.page_source
+        if page is None and self.driver is not None and self.browser_url == self.current_url:
+            page = self.driver.page_source
+        if not self.page_cache.content_changed(self.current_url, page_html):
+            if skip_unchanged:
+                logger.info(f"> {self.current_url} is unchanged since the last visit, skipping it.")
+                self.page_skipped = True
+                if self.config.get('frontier'):
+                    self._count_known_page()
+                return None
+        else:
+            self._pending_pages.setdefault(self.current_url, {})['content'] = (page_html, page)
+        return page_html
+
+    def _scrap_element(self, by_method, value):
+        """Locate the element of `scrap_page` in the static HTML or in the browser."""
+        if self.engine in ('http', 'auto') and self.page_source is not None:
+            try:
+                page_html = find_static_element(self.page_source, by_method, value)
+            except Exception as error:
+                logger.error(f"An error occurred during static scraping: {str(error)}")
+                page_html = None
+            if page_html is not None:
+                self.metrics.add(None, 'elements_matched')
+                return page_html
+            if self.engine == 'http' or self.offline:
+                logger.error(f"No such element found in the static HTML with {by_method} '{value}'.")
+                return None
+            logger.warning(f"'{value}' is missing from the static HTML, falling back to the browser.")
+            self.metrics.add(None, 'retries')
+        if self.offline:
+            logger.warning(f"{self.current_url} is not in the page cache.")
+            return None
+        if self.engine == 'http':
+            # The fetch failed; only the `auto` engine may start the browser
+            logger.error(f"No static HTML for {self.current_url}, skipping the page.")
+            return None
+        if self.current_url and self.browser_url != self.current_url:
+            # Wait for the page as the navigation state would have in the browser
+            self._browser_get(self.current_url, self.current_wait)
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.common.exceptions import TimeoutException, NoSuchElementException
+        from selenium.webdriver.common.by import By
         try:
             by_method = getattr(By, by_method)
             body_locator = (By.TAG_NAME, 'body')
             WebDriverWait(self.driver, 10).until(EC.presence_of_element_located(body_locator))
             page_content = self.driver.find_element(by_method, value)
             page_html = page_content.get_attribute('outerHTML')
+            self.metrics.add(None, 'elements_matched')
             return page_html
         except TimeoutException:
-            print("TimeoutException: Timed out waiting for element to be present.")
+            logger.error("TimeoutException: Timed out waiting for element to be present.")
             return None
         except NoSuchElementException:
-            print(f"No such element found with {by_method} '{value}'.")
+            logger.error(f"No such element found with {by_method} '{value}'.")
             return None
         except AttributeError:
-            print(f"AttributeError: The attribute {by_method} does not exist.")
+            logger.error(f"AttributeError: The attribute {by_method} does not exist.")
             return None
         except Exception as error:
-            print(f"An error occurred during scraping: {str(error)}")
+            logger.error(f"An error occurred during scraping: {str(error)}")
             return None
 
     def extract_data(self, raw_data, selectors):
@@ -217,15 +605,15 @@ class Scraper:
         Returns:
             dict: Extracted data, or None if an error occurred.
         """
+        from bs4 import BeautifulSoup
         extracted_data = {}
         try:
-            with open('raw_data.html', 'wb') as file:
-                file.write(raw_data.encode('utf-8'))
             soup = BeautifulSoup(raw_data, 'html.parser')
             for ida, selector in enumerate(selectors):
-                print(f"Extracting data with selector: {selector}")
+                logger.debug("Extracting data with selector: %s", selector)
                 data_divs = soup.find_all(**selector)
-                print(f"Found {len(data_divs)} elements with selector: {selector}")
+                self.metrics.add(None, 'elements_matched', len(data_divs))
+                logger.debug("Found %d elements with selector: %s", len(data_divs), selector)
                 data_list = []
                 for div in data_divs:
                     div_dict = {
@@ -236,14 +624,8 @@ class Scraper:
                     }
                     data_list.append(div_dict)
                 extracted_data[ida] = data_list
-        except TimeoutException:
-            print("TimeoutException: Timed out waiting for element to be present.")
-            return None
-        except NoSuchElementException:
-            print(f"No such element found with selector: {selector}.")
-            return None
         except Exception as error:
-            print(f"An error occurred during data extraction: {str(error)}")
+            logger.error(f"An error occurred during data extraction: {str(error)}")
             return None
         return extracted_data
 
@@ -259,51 +641,42 @@ class Scraper:
         Returns:
             dict: The data of interest, or None if an error occurred.
         """
+        plan = self._get_plan(data_to_find=data_to_find)
         output_data={}
         for data_samples in extracted_data:
             output_data[data_samples]=[]
             for sample in extracted_data[data_samples]:
-                infos={}
-                for key, value in data_to_find.items():
-                    if value['type'] == 'html':
-                        # Add HTML extraction logic here
-                        pass
-                    elif value['type'] == 'xpath':
-                        tree = html.fromstring(sample['raw'])
-                        elements = tree.xpath(value['attribute'])
-                        info=None
-                        if not elements:
-                            print(f"No elements found with XPath: {value['attribute']}")
-                            infos[key]= info
-                            continue
-                        element = elements[0]
-                        if value.get('extract') == 'text':
-                            info = element.text_content()
-                        elif value.get('extract') == 'attribute':
-                            attribute_name = value.get('attribute_name')
-                            if not attribute_name:
-                                print("No attribute name specified for XPath attribute extraction.")
-                                infos[key]= info
-                                continue
-                            info = element.get(attribute_name)
-                        elif value.get('extract') == 'element':
-                            print(value['extract'])
-                            info = tostring(element)
-                        else:
-                            print(f"Invalid extract type: {value.get('extract')}")
-                            infos[key]= info
-                            continue
-                        infos[key]= info
-
-                    elif value['type'] == 'text':
-                        # Add regex extraction logic here
-                        pass
-                    elif value['type'] == 'attribute':
-                        # Add attribute extraction logic here
-                        pass
-                output_data[data_samples].append(infos)
+                # Parse each sample once, whatever the number of fields
+                tree = html.fromstring(sample['raw'])
+                output_data[data_samples].append(plan.extract_fields(tree))
         return output_data
 
+    def extract_records(self, raw_data, selectors, data_to_find):
+        """
+        Extract the information of interest from the raw HTML in a single pass.
+
+        This fuses `extract_data` and `extract_infos`: the page is parsed once
+        with lxml, the selectors are evaluated as XPath on that tree and the
+        field XPaths are evaluated on each matching element, without
+        serializing elements back to strings.
+
+        Args:
+            raw_data (str): The raw HTML content.
+            selectors (list): A list of dictionaries containing selectors.
+            data_to_find (dict): The fields to extract from each matching element.
+
+        Returns:
+            dict: The data of interest by selector index, or None if an error occurred.
+        """
+        try:
+            plan = self._get_plan(selectors, data_to_find)
+            records = plan.extract(html.fromstring(raw_data))
+            self.metrics.add(None, 'elements_matched', sum(len(matches) for matches in records.values()))
+            return records
+        except Exception as error:
+            logger.error(f"An error occurred during data extraction: {str(error)}")
+            return None
+
     def extract_attributes(self, element):
         """
         Extract attributes from the given HTML element.
@@ -321,37 +694,197 @@ class Scraper:
                 attributes[child.name] = child_attributes
         return attributes
 
-    def goto_next_page(self, base_url, next_page):
+    def goto_next_page(self, base_url, next_page, wait=None):
         """
         Go to the next page using the base URL and next page number.
 
         Args:
             base_url (str): The base URL with a placeholder for the page number.
             next_page (int): The next page number.
+            wait (dict): The readiness condition to wait for (optional, see `_wait_ready`).
 
         Note:
-            This method also updates the configuration file with the new next_page value.
+            This method also advances the next_page value of the state; the
+            checkpoint store records it once the step is done.
         """
         next_page_url = base_url.format(i=next_page)
         next_page += 1
 
-        # Save the updated value of next_page back to the YAML configuration file
-        self.config['states']['goto_next_page']['parameters']['next_page'] = next_page
-        with open(self.config_filename, 'w',encoding='utf-8') as file:
-            yaml.safe_dump(self.config, file)
+        self.config['states'][self.current_state or 'goto_next_page']['parameters']['next_page'] = next_page
 
-        self.driver.get(next_page_url)
-        time.sleep(5)
+        self._navigate(next_page_url, wait)
 
-    def goto_link(self, link):
+    def goto_link(self, link, wait=None):
         """
         Go to the specified link.
 
         Args:
             link (str): The URL to navigate to.
+            wait (dict): The readiness condition to wait for (optional, see `_wait_ready`).
         """
-        self.driver.get(link)
-        time.sleep(5)
+        self._navigate(link, wait)
+
+    def _navigate(self, url, wait=None):
+        """
+        Go to the URL with the engine of the current state.
+
+        The `http` and `auto` engines download the static HTML over the pooled
+        session, the `browser` engine loads the URL in the driver.
+
+        Args:
+            url (str): The URL to load.
+            wait (dict): The readiness condition to wait for in the browser (optional).
+        """
+        self.current_url = url
+        self.current_wait = wait
+        self.page_source = None
+        self.page_unchanged = False
+        if self.offline:
+            self.page_source = self.page_cache.get_page(url)
+            if self.page_source is None:
+                logger.info(f"> {url} is not in the page cache, the replay is over.")
+                self.stop_crawl = True
+            else:
+                self.page_cache.stats['replayed'] += 1
+            return
+        if self.engine in ('http', 'auto'):
+            from requests.exceptions import RequestException
+            try:
+                self.page_source = self._fetch(url)
+                return
+            except RequestException as error:
+                if self.engine == 'http':
+                    logger.error(f"An error occurred during HTTP fetch: {str(error)}")
+                    return
+                logger.warning(f"HTTP fetch failed ({str(error)}), falling back to the browser.")
+                self.metrics.add(None, 'retries')
+        self._browser_get(url, wait)
+
+    def _fetch(self, url):
+        """
+        Download a page over HTTP, conditionally when the page cache knows it.
+
+        Args:
+            url (str): The URL to download.
+
+        Returns:
+            str: The HTML of the page, from the cache if it was not modified.
+        """
+        if self.page_cache is None:
+            with self.limiter.slot(url):
+                response = self.fetcher.fetch(url)
+            self.metrics.add(None, 'bytes_fetched', len(response.content))
+            return response.text
+        with self.limiter.slot(url):
+            response = self.fetcher.fetch(url, headers=self.page_cache.validators(url))
+        self.metrics.add(None, 'bytes_fetched', len(response.content))
+        if response.status_code == 304:
+            page = self.page_cache.get_page(url)
+            if page is not None:
+                self.page_unchanged = True
+                return page
+            self.metrics.add(None, 'retries')
+            with self.limiter.slot(url):
+                response = self.fetcher.fetch(url)
+            self.metrics.add(None, 'bytes_fetched', len(response.content))
+        # Cached when the cycle completes, so that a 304 never skips a page that was not delivered
+        self._pending_pages.setdefault(url, {})['response'] = (response.text, response.headers.get('ETag'),
+                                                               response.headers.get('Last-Modified'))
+        return response.text
+
+    def _browser_get(self, url, wait=None):
+        """
+        Load the URL in the driver, starting the driver if needed.
+
+        Args:
+            url (str): The URL to load.
+            wait (dict): The readiness condition to wait for (optional).
+        """
+        if self.driver is None:
+            self.init_driver()
+        with self.limiter.slot(url):
+            self.driver.get(url)
+        self.browser_url = url
+        self._wait_ready(wait)
+        try:
+            transferred = self.driver.execute_script(
+                "var entry = performance.getEntriesByType('navigation')[0]; return entry ? entry.transferSize : 0;")
+            self.metrics.add(None, 'bytes_fetched', transferred or 0)
+        except Exception as error:
+            logger.debug(f"Could not measure the size of {url}: {str(error)}")
+
+    def _wait_ready(self, wait=None, driver=None):
+        """
+        Wait until the page loaded in the driver is ready and record how long it took.
+
+        The condition is a dict with an `until` key and a `timeout` in seconds (default 10):
+            - `ready_state` (default): document.readyState is 'complete'.
+            - `selector`: an element located by `by_method` and `value` is present.
+            - `network_idle`: no new resource was requested for `idle_time` seconds (default 0.5).
+            - `js`: the JavaScript `script` returns a truthy value.
+
+        Args:
+            wait (dict): The readiness condition (optional).
+            driver (WebDriver): The driver to wait on (optional, defaults to the scraper's driver).
+
+        Returns:
+            float: The time spent waiting, in seconds.
+        """
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException
+        wait = wait or {}
+        driver = driver or self.driver
+        until = wait.get('until', 'ready_state')
+        start = time.monotonic()
+        ready = True
+        try:
+            condition = self._readiness_condition(until, wait)
+            WebDriverWait(driver, wait.get('timeout', 10), poll_frequency=0.1).until(condition)
+        except TimeoutException:
+            ready = False
+            logger.error(f"TimeoutException: Timed out waiting for the page to be ready ({until}).")
+        except Exception as error:
+            ready = False
+            logger.error(f"An error occurred while waiting for the page ({until}): {str(error)}")
+        elapsed = time.monotonic() - start
+        self.wait_times.append({'url': self.browser_url, 'until': until,
+                                'seconds': elapsed, 'ready': ready})
+        logger.debug(f"> Waited {elapsed:.2f}s for {until}")
+        return elapsed
+
+    def _readiness_condition(self, until, wait):
+        """
+        Build the WebDriverWait condition for a readiness check.
+
+        Args:
+            until (str): The kind of condition.
+            wait (dict): The condition parameters.
+
+        Returns:
+            callable: The condition, called with the driver.
+        """
+        if until == 'ready_state':
+            return lambda driver: driver.execute_script('return document.readyState') == 'complete'
+        if until == 'selector':
+            from selenium.webdriver.support import expected_conditions as EC
+            from selenium.webdriver.common.by import By
+            return EC.presence_of_element_located((getattr(By, wait['by_method']), wait['value']))
+        if until == 'js':
+            return lambda driver: driver.execute_script(wait['script'])
+        if until == 'network_idle':
+            idle_time = wait.get('idle_time', 0.5)
+            script = "return [document.readyState, performance.getEntriesByType('resource').length];"
+            activity = {'count': None, 'since': time.monotonic()}
+
+            def network_idle(driver):
+                ready_state, count = driver.execute_script(script)
+                now = time.monotonic()
+                if count != activity['count']:
+                    activity['count'], activity['since'] = count, now
+                    return False
+                return ready_state == 'complete' and now - activity['since'] >= idle_time
+            return network_idle
+        raise ValueError(f"Invalid readiness condition: {until}")
 
     def call_api(self, api_url, **kwargs):
         """
@@ -364,6 +897,7 @@ class Scraper:
         Returns:
             dict: The JSON response.
         """
+        import requests
         params = kwargs.get('params', None)
         headers = kwargs.get('headers', None)
         timeout = kwargs.get('timeout', 15)
@@ -373,7 +907,7 @@ class Scraper:
             response.raise_for_status()  # Raise an exception for non-200 status codes
             return response.json()
         except requests.exceptions.RequestException as error:
-            print(f"An error occurred during API request: {str(error)}")
+            logger.error(f"An error occurred during API request: {str(error)}")
             return None
 
     def send_data(self, data, address):
@@ -385,66 +919,703 @@ class Scraper:
             address (str): The address to send the data to.
 
         Returns:
-            int: The status code of the response.
+            int: The status code of the response, or the number of records
+            queued when the `sink` section of the configuration is set.
+
+        Note:
+            With a `sink` section, the records are handed to a `BufferedSink`
+            that posts them in batches on a background thread, and this
+            method returns immediately.
         """
+        if self.config.get('sink'):
+            sink = self._get_sink(address)
+            queued = sink.put(self._iter_records(data))
+            with self._sinks_lock:
+                retries = sink.stats['retries'] - self._sink_retries.get(address, 0)
+                self._sink_retries[address] = sink.stats['retries']
+            if retries:
+                self.metrics.add(None, 'retries', retries)
+            return queued
+        import requests
         headers = {'Content-Type': 'application/json'}
         response = requests.post(address, data=json.dumps(data), headers=headers, timeout=5)
 
-        print(response.status_code)
-        print(response.text)
+        logger.info(f"> {address} answered {response.status_code}: {response.text}")
 
         return response.status_code
 
-    def scrape_site(self, config=None):
+    def _get_sink(self, address):
+        """
+        Return the buffered sink of an address, creating it on first use.
+
+        Args:
+            address (str): The address the records are posted to.
+
+        Returns:
+            BufferedSink: The sink.
+        """
+        from sink import BufferedSink
+        with self._sinks_lock:
+            sink = self.sinks.get(address)
+            if sink is None:
+                settings = self.config['sink']
+                sink = BufferedSink(
+                    address,
+                    batch_size=settings.get('batch_size', 100),
+                    max_age=settings.get('max_age', 5.0),
+                    retries=settings.get('retries', 3),
+                    backoff=settings.get('backoff', 0.5),
+                    timeout=settings.get('timeout', 10),
+                    spill_file=settings.get('spill_file', 'spill.ndjson'),
+                    max_pending=settings.get('max_pending', 10000),
+                )
+                if settings.get('replay_spill'):
+                    sink.replay_spill()
+                atexit.register(sink.close)
+                self.sinks[address] = sink
+            return sink
+
+    def flush_sinks(self):
+        """Wait until every buffered sink has delivered its records, then commit the completed cycles."""
+        for sink in list(self.sinks.values()):
+            sink.flush()
+        self._commit_delivered()
+
+    def _get_frontier(self):
+        """Return the frontier of the `frontier` section, opening it on first use."""
+        with self._sinks_lock:
+            if self.frontier is None:
+                settings = self.config.get('frontier', {})
+                self.frontier = Frontier(
+                    settings.get('path', f"{os.path.splitext(self.config_filename)[0]}.frontier.sqlite"),
+                    capacity=settings.get('capacity', 1000000),
+                    error_rate=settings.get('error_rate', 0.001),
+                )
+            return self.frontier
+
+    def filter_new_records(self, records, url_field=None, stop_after=None):
+        """
+        Keep the records whose URL was not scraped by a previous run.
+
+        The URLs of the new records are added to the seen-set of the frontier,
+        and queued for `next_link`, once the FSM completes the cycle. After
+        `stop_after` consecutive pages without a new record the crawl stops,
+        as the following pages were scraped by a previous run.
+
+        Args:
+            records: The extracted records (by selector index, a list or a single record).
+            url_field (str): The field holding the URL of a record (optional, `frontier.url_field`).
+            stop_after (int): The number of consecutive known pages ending the crawl
+                (optional, `frontier.stop_after_known_pages`, 0 to never stop).
+
+        Returns:
+            list: The new records.
+        """
+        url_field = url_field or self.config.get('frontier', {}).get('url_field', 'url')
+        records = list(self._iter_records(records))
+        urls = [record.get(url_field) for record in records]
+        held = self._held_urls()
+        new_urls = set(self._get_frontier().filter_new(url for url in urls if url and url not in held))
+        new_records = []
+        for record, url in zip(records, urls):
+            if url in new_urls:
+                new_urls.discard(url)
+                self._pending_urls[url] = None
+            elif url:
+                continue
+            new_records.append(record)
+        logger.info(f"> {len(new_records)} new records out of {len(records)}")
+        if new_records or not records:
+            self.known_pages = 0
+        else:
+            self._count_known_page(stop_after)
+        return new_records
+
+    def _held_urls(self):
+        """Return the new URLs of the current cycle and of the completed cycles not committed yet."""
+        held = set(self._pending_urls)
+        with self._undelivered_lock:
+            for cycle in self._undelivered:
+                held.update(cycle[1])
+        return held
+
+    def normalize_records(self, records):
+        """
+        Convert the raw fields of extracted records into the typed columns of
+        the `normalize` section, for the whole batch at once.
+
+        Args:
+            records: The extracted records (by selector index, a list or a single record).
+
+        Returns:
+            list: The rows, ready for a bulk insert.
+        """
+        return self._get_normalizer().normalize(list(self._iter_records(records)))
+
+    def _get_normalizer(self):
+        """Return the normalizer of the `normalize` section, creating it on first use."""
+        with self._sinks_lock:
+            if self.normalizer is None:
+                from normalize import Normalizer
+                settings = self.config.get('normalize', {})
+                db_manager = None
+                if settings.get('database'):
+                    from database import DatabaseManager
+                    try:
+                        db_manager = DatabaseManager(settings['database'])
+                    except Exception as error:
+                        # The names are then kept as scraped, without the lookup tables
+                        logger.error(f"An error occurred while opening the lookup database: {str(error)}")
+                self.normalizer = Normalizer(settings.get('columns', {}), db_manager,
+                                             lookup_ttl=settings.get('lookup_ttl', 3600))
+            return self.normalizer
+
+    def _count_known_page(self, stop_after=None):
+        """
+        Count a page without new records, and stop the crawl after `stop_after` in a row.
+
+        Args:
+            stop_after (int): The number of consecutive known pages ending the crawl
+                (optional, `frontier.stop_after_known_pages`).
+        """
+        settings = self.config.get('frontier', {})
+        stop_after = settings.get('stop_after_known_pages', 1) if stop_after is None else stop_after
+        self.known_pages += 1
+        if stop_after and self.known_pages >= stop_after:
+            logger.info(f"> {self.known_pages} pages without new records, stopping the crawl.")
+            self.stop_crawl = True
+
+    def _commit_seen(self):
+        """
+        Commit the completed cycle once its records are delivered.
+
+        The cycle waits until the buffered sinks delivered (or spilled) the
+        records queued so far, and when streaming until `scrape_site` passed
+        its batch to them, so that records lost in memory by a crash are
+        scraped again by the next run.
+        """
+        if self._pending_urls or self._pending_pages:
+            marks = None if self._streaming else self._sink_marks()
+            with self._undelivered_lock:
+                self._undelivered.append([marks, self._pending_urls, self._pending_pages, self])
+            self._pending_urls = {}
+            self._pending_pages = {}
+        self._commit_delivered()
+
+    def _sink_marks(self):
+        """Return the number of records queued so far by each buffered sink."""
+        with self._sinks_lock:
+            return {address: sink.stats['queued'] for address, sink in self.sinks.items()}
+
+    def _mark_streamed(self):
+        """Let the completed cycles wait for the sinks, once `scrape_site` passed their records to them."""
+        marks = self._sink_marks()
+        with self._undelivered_lock:
+            for cycle in self._undelivered:
+                # The cycles of the other workers are still in their own batch
+                if cycle[0] is None and cycle[3] is self:
+                    cycle[0] = marks
+        self._commit_delivered()
+
+    def _commit_delivered(self):
+        """
+        Add the new URLs of the delivered cycles to the seen-set of the frontier,
+        and their pages and content hashes to the page cache, in cycle order.
+        """
+        with self._undelivered_lock:
+            while self._undelivered:
+                marks, urls, pages, _ = self._undelivered[0]
+                if marks is None or any(self.sinks[address].settled() < mark for address, mark in marks.items()):
+                    return
+                self._undelivered.pop(0)
+                if urls:
+                    enqueue = self.config.get('frontier', {}).get('enqueue', True)
+                    self._get_frontier().add(urls, priority=self.started, enqueue=enqueue)
+                for url, writes in pages.items():
+                    if 'response' in writes:
+                        page, etag, last_modified = writes['response']
+                        self.page_cache.store_page(url, page, etag, last_modified)
+                    if 'content' in writes:
+                        self.page_cache.store_content(url, *writes['content'])
+
+    def next_link(self):
+        """
+        Pop the next URL to visit from the frontier, the most recent first.
+
+        The URL popped by the previous call is removed from the queue, as the
+        FSM came back here once it was processed.
+
+        Returns:
+            str: The URL, or None if the queue is empty.
+        """
+        frontier = self._get_frontier()
+        if self._link is not None:
+            frontier.done(self._link)
+        self._link = frontier.pop()
+        return self._link
+
+    def scrape_site(self, config=None, single_pass=False, stream=None, resume=False):
         """
         Scrape the website using the provided configuration.
 
         Args:
             config (dict): The configuration to use (optional).
+            single_pass (bool): Stop when the FSM comes back to its initial state.
+            stream (bool): Stream the records to the sink in batches (optional,
+                defaults to `streaming.enabled`).
+            resume (bool): Continue the crawl from its checkpoint instead of
+                starting from the initial state.
 
         Note:
             If no configuration is provided, the default configuration will be used.
         """
         config = self.config if not config else config
+        streaming = config.get('streaming', {})
+        if stream is None:
+            stream = streaming.get('enabled', False)
+        if not stream:
+            try:
+                for _ in self._run_steps(config, single_pass, resume=resume):
+                    pass
+            finally:
+                if not single_pass:
+                    self.flush_sinks()
+            return
+
+        sinks = [step for step in config['states'].values() if step['method'] in SINK_METHODS]
+        if not sinks:
+            raise ValueError("Streaming requires a send_data state.")
+        address = sinks[0]['parameters']['address']
+        batch_size = streaming.get('batch_size', 50)
+        batch = []
+        self._streaming = True
+        try:
+            for record in self.stream_records(config, single_pass, resume):
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    self.send_data(batch, address)
+                    batch = []
+                    self._mark_streamed()
+        finally:
+            # Deliver what was extracted before the crawl stopped
+            self._streaming = False
+            if batch:
+                self.send_data(batch, address)
+            self._mark_streamed()
+            if not single_pass:
+                self.flush_sinks()
+
+    def stream_records(self, config=None, single_pass=False, resume=False):
+        """
+        Run the FSM and yield the extracted records one by one.
+
+        Sink states are skipped: the records they would have received are
+        yielded instead, so that the caller decides where they go.
+
+        Args:
+            config (dict): The configuration to use (optional).
+            single_pass (bool): Stop when the FSM comes back to its initial state.
+            resume (bool): Continue the crawl from its checkpoint.
+
+        Yields:
+            dict: The extracted records.
+        """
+        config = self.config if not config else config
+        states = config['states']
+        for state, step, result in self._run_steps(config, single_pass, skip=SINK_METHODS, resume=resume):
+            next_state = step.get('next_state')
+            if next_state in states and states[next_state]['method'] in SINK_METHODS:
+                yield from self._iter_records(result)
+
+    @staticmethod
+    def _iter_records(data):
+        """
+        Flatten the output of an extraction state into records.
+
+        Args:
+            data: The extracted data (by selector index, a list or a single record).
+
+        Yields:
+            dict: The records.
+        """
+        if isinstance(data, dict) and all(isinstance(value, list) for value in data.values()):
+            for records in data.values():
+                yield from records
+        elif isinstance(data, list):
+            yield from data
+        elif data:
+            yield data
+
+    def _run_steps(self, config, single_pass=False, skip=(), resume=False):
+        """
+        Execute the states of the FSM one after the other.
+
+        Args:
+            config (dict): The configuration to use.
+            single_pass (bool): Stop when the FSM comes back to its initial state.
+            skip (tuple): Methods whose states are passed through without being executed.
+            resume (bool): Start from the checkpoint of the crawl.
+
+        Yields:
+            tuple: The state name, its step configuration and its result.
+        """
         # Get the initial state
         state = config['initial_state']
+        self.stop_crawl = False
+        if resume:
+            state = self._resume(config)
+        elif self.save_progress:
+            self.checkpoint.save(self.crawl_id, state=state, next_page=None,
+                                 inflight_state=None, inflight_url=None, finished=0)
         previous_result = None
         while state is not None:
             step = config['states'][state]
-            print("******************************")
-            print(">Step:", state)
-            print("     Method:", step['method'])
-            parameters = step.get('parameters', {})
-            if parameters:
-                print(">Parameters:")
-                for key, value in parameters.items():
-                    if isinstance(value, str) and value == "{previous_result}":
-                        value = previous_result
-                        print(f'>previous_result : {type(previous_result)} {len(previous_result)}')
             method_name = step['method']
+            logger.debug(f">Step: {state} ({method_name})")
             parameters = {}
             # Replace placeholders in parameters with previous result, if applicable
-            print(type(previous_result))
-            
             for key, value in step.get('parameters', {}).items():
                 if isinstance(value, str) and value == "{previous_result}":
                     parameters[key] = previous_result
-                    print(f'>previous_result : {type(previous_result)} {len(previous_result)}')
+                    logger.debug(">previous_result : %s", type(previous_result))
                 else:
                     parameters[key] = value
-            # Execute the method with the provided parameters
-            method = getattr(self, method_name)
-            result = method(**parameters)
-            self.step_results[state] = result
-            print(result)
-            input(f">End of step {state}")            # Get the next state
-            state = step['next_state']
+            if method_name in skip:
+                result = previous_result
+            else:
+                # Execute the method with the provided parameters
+                self.current_state = state
+                self.page_skipped = False
+                self.engine = self._step_engine(config, step)
+                method = getattr(self, method_name)
+                with self.metrics.track(state):
+                    result = method(**parameters)
+                self._retain(config, state, step, result)
+                logger.debug(">Result of %s: %s", state, result)
+            next_step = config['states'].get(step.get('next_state')) if isinstance(step.get('next_state'), str) else None
+            if next_step is not None and next_step['method'] in SINK_METHODS:
+                self.metrics.add(state, 'records_emitted', sum(1 for _ in self._iter_records(result)))
+            yield state, step, result
+            if self.interactive and sys.stdin.isatty():
+                input(f">End of step {state}")
+            # Get the next state
+            current, state = state, step.get('next_state')
             if callable(state):
                 state = state(result)
+            if self.page_skipped and 'on_unchanged' in step:
+                state = step['on_unchanged']
+            elif 'on_empty' in step:
+                state = self._on_empty(step, result, state)
+            if self.stop_crawl:
+                state = None
+            if state is None or state == config['initial_state']:
+                self._commit_seen()
+            if self.save_progress:
+                self._save_checkpoint(config, current, step, state)
+            if single_pass and state == config['initial_state']:
+                state = None
             # Update the previous result for next iteration
             previous_result = result
 
-#scraper = Scraper('configWololo.yaml')
-#scraper = Scraper('configAvito.yaml')
-scraper = Scraper('configAvito2.yaml')
-scraper.scrape_site()
+    def _on_empty(self, step, result, state):
+        """
+        Route an empty result to the `on_empty` state of the step.
+
+        Args:
+            step (dict): The step configuration.
+            result: The result of the step.
+            state (str): The next state of a non-empty result.
+
+        Returns:
+            str: The next state.
+
+        Note:
+            A page skipped as unchanged is not counted. After
+            `stop_after_empty` (3 by default, 0 to never stop) empty results
+            in a row, the crawl ends: past the last page, a site answers with
+            empty pages or errors and `on_empty` would loop forever.
+        """
+        if any(True for _ in self._iter_records(result)):
+            self.empty_results = 0
+            return state
+        if self.page_skipped:
+            self.empty_results = 0
+        else:
+            self.empty_results += 1
+            stop_after = step.get('stop_after_empty', 3)
+            if stop_after and self.empty_results >= stop_after:
+                logger.info(f"> {self.empty_results} empty results in a row, stopping the crawl.")
+                self.stop_crawl = True
+        return step['on_empty']
+
+    def _step_engine(self, config, step):
+        """Return the fetch backend of a state; offline replay reads the static cached HTML."""
+        if self.offline:
+            return 'http'
+        return step.get('engine', config.get('engine', 'browser'))
+
+    def _save_checkpoint(self, config, state, step, next_state):
+        """
+        Record the progress of the crawl once a step is done.
+
+        A navigation step puts its URL in flight until the FSM comes back to
+        its initial state (or stops), so that a resumed crawl reloads the page
+        whose processing was interrupted.
+
+        Args:
+            config (dict): The configuration in use.
+            state (str): The state that was executed.
+            step (dict): The state configuration.
+            next_state (str): The state executed next, or None if the crawl is over.
+        """
+        values = {'state': next_state, 'finished': int(next_state is None)}
+        if step['method'] in NAVIGATION_METHODS:
+            values.update(inflight_state=state, inflight_url=self.current_url)
+            if 'next_page' in step.get('parameters', {}):
+                values['next_page'] = step['parameters']['next_page']
+        elif next_state is None or next_state == config['initial_state']:
+            values.update(inflight_state=None, inflight_url=None)
+        self.checkpoint.save(self.crawl_id, **values)
+
+    def _resume(self, config):
+        """
+        Restore the checkpoint of the crawl and return the state to start from.
+
+        The page in flight is loaded again and the crawl continues with the
+        state following its navigation step. Without a page in flight, the
+        crawl starts over from the initial state with the recorded next page.
+
+        Args:
+            config (dict): The configuration in use.
+
+        Returns:
+            str: The state to start from.
+        """
+        checkpoint = self.checkpoint.load(self.crawl_id)
+        if checkpoint is None or checkpoint['finished']:
+            logger.info(f"> No checkpoint to resume for {self.crawl_id}, starting from the initial state.")
+            return config['initial_state']
+        if checkpoint['next_page'] is not None:
+            for step in config['states'].values():
+                if step['method'] == 'goto_next_page':
+                    step['parameters']['next_page'] = checkpoint['next_page']
+        if not checkpoint['inflight_url']:
+            logger.info(f"> Resuming {self.crawl_id} from {config['initial_state']} (next page: {checkpoint['next_page']})")
+            return config['initial_state']
+        state = checkpoint['inflight_state']
+        step = config['states'][state]
+        logger.info(f"> Resuming {self.crawl_id}: reloading {checkpoint['inflight_url']} ({state})")
+        self.current_state = state
+        self.engine = self._step_engine(config, step)
+        self._navigate(checkpoint['inflight_url'], step.get('parameters', {}).get('wait'))
+        return step.get('next_state')
+
+    def _retain(self, config, state, step, result):
+        """
+        Store the result of a step according to the retention policy.
+
+        The `retention` section of the configuration sets the `policy`: `last`
+        (default) keeps the last result of every state, `none` keeps only the
+        states listed in `keep`. With `drop_raw`, the raw HTML returned by
+        `scrap_page` is never retained once it has been handed to the next state.
+
+        Args:
+            config (dict): The configuration in use.
+            state (str): The state name.
+            step (dict): The state configuration.
+            result: The result of the step.
+        """
+        retention = config.get('retention', {})
+        keep = retention.get('keep', [])
+        if retention.get('policy', 'last') == 'none':
+            retain = state in keep
+        else:
+            retain = state in keep or not (retention.get('drop_raw') and step['method'] in RAW_METHODS)
+        if retain:
+            self.step_results[state] = result
+        else:
+            self.step_results.pop(state, None)
+        if retention.get('drop_raw') and step['method'] in RAW_METHODS:
+            self.page_source = None
+
+    def scrape_site_parallel(self, workers=None, first_page=None, last_page=None, resume=False, fresh=False):
+        """
+        Crawl a page range with several independent FSM runs in parallel.
+
+        The range is split into chunks of `pages_per_run` pages, claimed from
+        the checkpoint store so that several processes sharing the store crawl
+        distinct chunks. Each chunk is crawled by its own FSM run, one pass per
+        page, on a driver borrowed from a pool of pre-warmed drivers. The
+        initial state must be the `goto_next_page` state.
+
+        Claims are kept in the store while the crawl is unfinished, so that
+        other processes and resumed crawls share its page range. A run that
+        is not resumed starts over once every claimed range is done.
+
+        When a worker's FSM ends the crawl (`stop_crawl`, e.g. after known or
+        empty pages), its chunk is marked done and no further chunk is
+        claimed; the other workers complete the chunks they hold.
+
+        Args:
+            workers (int): The number of drivers (optional, `concurrency.workers`).
+            first_page (int): The first page to crawl (optional, `concurrency.first_page`).
+            last_page (int): The last page to crawl (optional, `concurrency.last_page`).
+            resume (bool): Take back at once the unfinished chunks claimed by
+                this owner (`checkpoint.owner`, the host name by default) in a
+                crawl that stopped, instead of waiting for their lease to expire.
+            fresh (bool): Forget every claim of the crawl first, finished or not.
+
+        Returns:
+            dict: The number of pages crawled, failed chunks and the crawl rate.
+        """
+        settings = self.config.get('concurrency', {})
+        workers = workers or settings.get('workers', 1)
+        first_page = settings.get('first_page', 1) if first_page is None else first_page
+        last_page = settings.get('last_page', first_page) if last_page is None else last_page
+        initial_state = self.config['initial_state']
+        if self.config['states'][initial_state]['method'] != 'goto_next_page':
+            raise ValueError("Parallel crawling requires goto_next_page as initial state.")
+
+        pages = last_page - first_page + 1
+        chunk_size = settings.get('pages_per_run') or math.ceil(pages / workers)
+        owner = self.config.get('checkpoint', {}).get('owner') or socket.gethostname()
+        if fresh:
+            reset = self.checkpoint.reset_claims(self.crawl_id)
+            logger.info(f"> Starting {self.crawl_id} afresh: {reset} claimed runs forgotten")
+        elif resume:
+            released = self.checkpoint.release_owner(self.crawl_id, owner)
+            logger.info(f"> Resuming {self.crawl_id}: {released} unfinished runs released")
+        elif self.checkpoint.reset_claims(self.crawl_id, finished_only=True):
+            logger.info(f"> The previous crawl of {self.crawl_id} is finished, starting over")
+        logger.info(f"> Parallel crawl: {pages} pages, runs of {chunk_size} pages, {workers} workers")
+
+        start = time.monotonic()
+        pool = DriverPool(self._driver_factory(), workers)
+        self._crawl_stopped = threading.Event()
+        crawled, failed = 0, []
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self._scrape_claims, pool, first_page, last_page, chunk_size, owner)
+                           for _ in range(workers)]
+                for future in as_completed(futures):
+                    worker_crawled, worker_failed = future.result()
+                    crawled += worker_crawled
+                    failed.extend(worker_failed)
+        finally:
+            pool.close()
+            self.flush_sinks()
+        elapsed = time.monotonic() - start
+        summary = {
+            'pages': crawled,
+            # A released chunk may fail again in the worker that took it over
+            'failed_runs': sorted(set(failed)),
+            'stopped': self._crawl_stopped.is_set(),
+            'elapsed': elapsed,
+            'pages_per_minute': crawled * 60 / elapsed if elapsed else 0,
+        }
+        logger.info(f"> Parallel crawl done: {summary}")
+        return summary
+
+    def _driver_factory(self):
+        """Return the driver factory of a pool: no driver when every state uses the `http` engine."""
+        engines = {step.get('engine', self.config.get('engine', 'browser'))
+                   for step in self.config['states'].values()}
+        return self._create_driver if engines != {'http'} else lambda: None
+
+    def _scrape_claims(self, pool, first_page, last_page, chunk_size, owner):
+        """
+        Claim chunks of the page range and crawl them until every page is claimed.
+
+        A chunk that fails is released from the page where it stopped and the
+        worker stops, so that another worker (or a later run) takes it over
+        at once instead of this one retrying it in a loop.
+
+        Args:
+            pool (DriverPool): The driver pool.
+            first_page (int): The first page of the crawl.
+            last_page (int): The last page of the crawl.
+            chunk_size (int): The number of pages of a chunk.
+            owner (str): The identifier the chunks are claimed with.
+
+        Returns:
+            tuple: The number of pages crawled and the (first, last) pages of the failed chunks.
+        """
+        crawled, failed = 0, []
+        while not self._crawl_stopped.is_set():
+            claim = self.checkpoint.claim_range(self.crawl_id, first_page, last_page, chunk_size, owner)
+            if claim is None:
+                return crawled, failed
+            start = claim['next_page']
+            try:
+                self._scrape_pages(pool, claim)
+            except Exception as error:
+                logger.error(f"An error occurred while crawling pages {claim['first_page']}-{claim['last_page']}: {str(error)}")
+                failed.append((claim['first_page'], claim['last_page']))
+                self.checkpoint.release_claim(self.crawl_id, claim)
+                crawled += claim['next_page'] - start
+                return crawled, failed
+            crawled += claim['next_page'] - start
+        return crawled, failed
+
+    def _scrape_pages(self, pool, claim):
+        """
+        Run one FSM pass per page of a claimed chunk on a driver borrowed from the pool.
+
+        The progress of the chunk is recorded after every page. When the
+        FSM ends the crawl, the chunk is marked done and the crawl-wide stop
+        flag is set.
+
+        Args:
+            pool (DriverPool): The driver pool.
+            claim (dict): The chunk returned by `CheckpointStore.claim_range`.
+        """
+        with pool.driver() as driver:
+            worker = self._spawn_worker(driver)
+            initial_state = worker.config['initial_state']
+            try:
+                for page in range(claim['next_page'], claim['last_page'] + 1):
+                    worker.config['states'][initial_state]['parameters']['next_page'] = page
+                    worker.scrape_site(single_pass=True)
+                    if worker.stop_crawl:
+                        logger.info(f"> The crawl was stopped at page {page}.")
+                        self._crawl_stopped.set()
+                        self.checkpoint.advance_claim(self.crawl_id, claim, claim['last_page'] + 1)
+                        break
+                    self.checkpoint.advance_claim(self.crawl_id, claim, page + 1)
+            finally:
+                # A worker without a pooled driver may have started one for a fallback
+                if worker.driver is not None and worker.driver is not driver:
+                    worker.driver.quit()
+
+    def _spawn_worker(self, driver):
+        """
+        Create a scraper sharing this one's settings but with its own driver and state.
+
+        Args:
+            driver (WebDriver): The driver the worker will use.
+
+        Returns:
+            Scraper: The worker scraper.
+        """
+        worker = copy.copy(self)
+        worker.config = copy.deepcopy(self.config)
+        worker.driver = driver
+        worker.browser_url = None
+        worker.step_results = {}
+        worker.interactive = False
+        worker.save_progress = False
+        worker.frontier = self._get_frontier() if self.config.get('frontier') else None
+        worker.normalizer = self._get_normalizer() if self.config.get('normalize') else None
+        worker.known_pages = 0
+        worker.empty_results = 0
+        worker._pending_urls = {}
+        worker._pending_pages = {}
+        worker._link = None
+        return worker
+
+if __name__ == '__main__':
+    configure_logging('configAvito2.yaml')
+    #scraper = Scraper('configWololo.yaml')
+    #scraper = Scraper('configAvito.yaml')
+    scraper = Scraper('configAvito2.yaml')
+    scraper.scrape_site()
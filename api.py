@@ -1,9 +1,23 @@
-from flask import Flask, request, jsonify
-from database import DatabaseManager
+import json
+import threading
+from flask import Flask, Response, request, jsonify, stream_with_context
 
 app = Flask(__name__)
 
-db_manager = DatabaseManager('configDB.yaml')
+DB_CONFIG = 'configDB.yaml'  # The database configuration, read on first use
+_db_manager = None
+_db_manager_lock = threading.Lock()
+
+
+def get_db_manager():
+    """Return the database manager, created on first use so that importing the app is cheap."""
+    global _db_manager
+    if _db_manager is None:
+        with _db_manager_lock:
+            if _db_manager is None:
+                from database import DatabaseManager
+                _db_manager = DatabaseManager(DB_CONFIG)
+    return _db_manager
 
 @app.route('/add_record/<table_name>', methods=['POST'])
 def add_record(table_name):
@@ -11,20 +25,68 @@ def add_record(table_name):
     data = request.get_json()
 
     # Add the record to the database.
-    if db_manager.add_record(table_name, **data):
+    if get_db_manager().add_record(table_name, **data):
         return jsonify(message='Record added.'), 201
     else:
         return jsonify(message='Failed to add record.'), 500
 
+def read_ndjson(stream, chunk_size):
+    """Yield lists of at most chunk_size records read from an NDJSON stream."""
+    chunk = []
+    for line in stream:
+        if line.strip():
+            chunk.append(json.loads(line))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def write_records(table_name, write, verb):
+    """Feed the records of the request to write(table_name, records) and build the response."""
+    # Records come either as an NDJSON stream or as a JSON array (or {"records": [...]}).
+    if request.mimetype == 'application/x-ndjson':
+        chunk_size = get_db_manager().config.get('bulk', {}).get('chunk_size', 5000)
+        count = 0
+        for chunk in read_ndjson(request.stream, chunk_size):
+            written = write(table_name, chunk)
+            if written is None:
+                return jsonify(message=f'Failed to {verb} records after {count} records.', count=count), 500
+            count += written
+    else:
+        data = request.get_json()
+        records = data.get('records') if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            return jsonify(message='Expecting a list of records.'), 400
+        count = write(table_name, records)
+        if count is None:
+            return jsonify(message=f'Failed to {verb} records.'), 500
+    return jsonify(message=f'{count} records {verb}ed.', count=count), 201
+
+@app.route('/add_records/<table_name>', methods=['POST'])
+def add_records(table_name):
+    return write_records(table_name, get_db_manager().add_records, 'add')
+
+@app.route('/upsert_records/<table_name>', methods=['POST'])
+def upsert_records(table_name):
+    # Optional ?conflict=URLAnnonce,... overrides the unique columns of the configuration.
+    conflict = request.args.get('conflict')
+    conflict_columns = conflict.split(',') if conflict else None
+    return write_records(table_name, lambda table, records: get_db_manager().upsert_records(table, records, conflict_columns), 'upsert')
+
 @app.route('/update_record/<table_name>', methods=['PUT'])
 def update_record(table_name):
     # Extract data from the request.
     data = request.get_json()
     filters = data.get("filters")
     updates = data.get("updates")
+    try:
+        get_db_manager().check_filters(table_name, filters)
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
 
     # Update the record in the database.
-    count = db_manager.update_record(table_name, filters, **updates)
+    count = get_db_manager().update_record(table_name, filters, **updates)
     if count is not None:
         return jsonify(message=f'{count} records updated.'), 200
     else:
@@ -35,9 +97,13 @@ def update_record(table_name):
 def delete_record(table_name):
     # Extract data from the request.
     data = request.get_json()
+    try:
+        get_db_manager().check_filters(table_name, data)
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
 
     # Delete the record from the database.
-    count = db_manager.delete_records(table_name, data)
+    count = get_db_manager().delete_records(table_name, data)
     if count is not None:
         return jsonify(message=f'{count} records deleted.'), 200
     else:
@@ -47,18 +113,60 @@ def delete_record(table_name):
 def get_record(table_name):
     # Extract data from the request.
     data = request.args.to_dict()
-    print(data)
 
-    # Check if 'single' parameter is provided and if it is set to 'true'.
+    # 'limit', 'after' (keyset cursor on ID), 'fields' and 'format' shape the response,
+    # every other parameter is a filter on a column.
+    try:
+        limit = int(data.pop('limit', -1))
+        after = data.pop('after', None)
+        after = int(after) if after is not None else None
+    except ValueError:
+        return jsonify(message="'limit' and 'after' must be integers."), 400
+    fields = data.pop('fields', None)
+    fields = fields.split(',') if fields else None
+    response_format = data.pop('format', 'json')
+    try:
+        get_db_manager().check_filters(table_name, data)
+    except ValueError as e:
+        return jsonify(message=str(e)), 400
+
+    if response_format == 'ndjson':
+        # Stream the rows as they come off a server-side cursor.
+        try:
+            rows = get_db_manager().iter_records(table_name, filters=data, fields=fields, after=after, limit=limit)
+            first = next(rows, None)
+        except Exception as e:
+            print(f"Failed to get records: {e}")
+            return jsonify(message='Failed to get records.'), 500
+
+        def generate():
+            if first is None:
+                return
+            yield json.dumps(first, default=json_default) + '\n'
+            for row in rows:
+                yield json.dumps(row, default=json_default) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
     # Get the records from the database.
-    records = db_manager.get_records(table_name, **data)
+    records = get_db_manager().get_records(table_name, filters=data, fields=fields, after=after, limit=limit)
 
     if records is not None:
-        return jsonify(records=records), 200
+        next_cursor = records[-1]['ID'] if records and len(records) == limit else None
+        return jsonify(records=records, next_cursor=next_cursor), 200
     else:
         return jsonify(message='Failed to get records.'), 500
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    # Hit/miss counters of the query cache, to check whether it pays off.
+    if get_db_manager().cache is None:
+        return jsonify(message='Query cache is disabled.'), 404
+    return jsonify(get_db_manager().cache.stats()), 200
+
+def json_default(value):
+    """Serialize the values json does not handle, such as dates."""
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,222 @@
+"""
+Async API
+
+The ASGI variant of `api.py`: the same routes, served by Starlette on an
+event loop and backed by `AsyncDatabaseManager`, so that requests waiting on
+the database do not hold a worker each. The connection pool is sized by the
+`pooling` section of configDB.yaml.
+
+Author: mdakk072
+
+Usage:
+    uvicorn api_async:app --port 5001
+    python api_async.py
+
+"""
+import contextlib
+import json
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+DB_CONFIG = 'configDB.yaml'  # The database configuration, read on first use
+_db_manager = None
+
+
+def get_db_manager():
+    """Return the database manager, created on first use so that importing the app is cheap."""
+    global _db_manager
+    if _db_manager is None:
+        from async_database import AsyncDatabaseManager
+        _db_manager = AsyncDatabaseManager(DB_CONFIG)
+    return _db_manager
+
+
+def json_default(value):
+    """Serialize the values json does not handle, such as dates."""
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+class Response(JSONResponse):
+    """A JSON response that also serializes dates and bytes."""
+
+    def render(self, content):
+        return json.dumps(content, default=json_default, separators=(',', ':')).encode('utf-8')
+
+
+async def add_record(request):
+    # Extract data from the request.
+    data = await request.json()
+
+    # Add the record to the database.
+    if await get_db_manager().add_record(request.path_params['table_name'], **data):
+        return Response({'message': 'Record added.'}, 201)
+    else:
+        return Response({'message': 'Failed to add record.'}, 500)
+
+
+async def read_ndjson(stream, chunk_size):
+    """Yield lists of at most chunk_size records read from an NDJSON byte stream."""
+    chunk = []
+    pending = b''
+    async for data in stream:
+        pending += data
+        *lines, pending = pending.split(b'\n')
+        for line in lines:
+            if line.strip():
+                chunk.append(json.loads(line))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+    if pending.strip():
+        chunk.append(json.loads(pending))
+    if chunk:
+        yield chunk
+
+
+async def write_records(request, write, verb):
+    """Feed the records of the request to write(table_name, records) and build the response."""
+    table_name = request.path_params['table_name']
+    # Records come either as an NDJSON stream or as a JSON array (or {"records": [...]}).
+    if request.headers.get('content-type', '').split(';')[0] == 'application/x-ndjson':
+        chunk_size = get_db_manager().config.get('bulk', {}).get('chunk_size', 5000)
+        count = 0
+        async for chunk in read_ndjson(request.stream(), chunk_size):
+            written = await write(table_name, chunk)
+            if written is None:
+                return Response({'message': f'Failed to {verb} records after {count} records.', 'count': count}, 500)
+            count += written
+    else:
+        data = await request.json()
+        records = data.get('records') if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            return Response({'message': 'Expecting a list of records.'}, 400)
+        count = await write(table_name, records)
+        if count is None:
+            return Response({'message': f'Failed to {verb} records.'}, 500)
+    return Response({'message': f'{count} records {verb}ed.', 'count': count}, 201)
+
+
+async def add_records(request):
+    return await write_records(request, get_db_manager().add_records, 'add')
+
+
+async def upsert_records(request):
+    # Optional ?conflict=URLAnnonce,... overrides the unique columns of the configuration.
+    conflict = request.query_params.get('conflict')
+    conflict_columns = conflict.split(',') if conflict else None
+
+    async def upsert(table, records):
+        return await get_db_manager().upsert_records(table, records, conflict_columns)
+    return await write_records(request, upsert, 'upsert')
+
+
+async def update_record(request):
+    # Extract data from the request.
+    data = await request.json()
+    filters = data.get("filters")
+    updates = data.get("updates")
+    try:
+        get_db_manager().check_filters(request.path_params['table_name'], filters)
+    except ValueError as e:
+        return Response({'message': str(e)}, 400)
+
+    # Update the record in the database.
+    count = await get_db_manager().update_record(request.path_params['table_name'], filters, **updates)
+    if count is not None:
+        return Response({'message': f'{count} records updated.'}, 200)
+    else:
+        return Response({'message': 'Failed to update records.'}, 500)
+
+
+async def delete_record(request):
+    # Extract data from the request.
+    data = await request.json()
+    try:
+        get_db_manager().check_filters(request.path_params['table_name'], data)
+    except ValueError as e:
+        return Response({'message': str(e)}, 400)
+
+    # Delete the record from the database.
+    count = await get_db_manager().delete_records(request.path_params['table_name'], data)
+    if count is not None:
+        return Response({'message': f'{count} records deleted.'}, 200)
+    else:
+        return Response({'message': 'Failed to delete records.'}, 500)
+
+
+async def get_record(request):
+    table_name = request.path_params['table_name']
+    data = dict(request.query_params)
+
+    # 'limit', 'after' (keyset cursor on ID), 'fields' and 'format' shape the response,
+    # every other parameter is a filter on a column.
+    try:
+        limit = int(data.pop('limit', -1))
+        after = data.pop('after', None)
+        after = int(after) if after is not None else None
+    except ValueError:
+        return Response({'message': "'limit' and 'after' must be integers."}, 400)
+    fields = data.pop('fields', None)
+    fields = fields.split(',') if fields else None
+    response_format = data.pop('format', 'json')
+    try:
+        get_db_manager().check_filters(table_name, data)
+    except ValueError as e:
+        return Response({'message': str(e)}, 400)
+
+    if response_format == 'ndjson':
+        # Stream the rows as they come off a server-side cursor.
+        rows = get_db_manager().iter_records(table_name, filters=data, fields=fields, after=after, limit=limit)
+        try:
+            first = await anext(rows, None)
+        except Exception as e:
+            print(f"Failed to get records: {e}")
+            return Response({'message': 'Failed to get records.'}, 500)
+
+        async def generate():
+            if first is None:
+                return
+            yield json.dumps(first, default=json_default) + '\n'
+            async for row in rows:
+                yield json.dumps(row, default=json_default) + '\n'
+        return StreamingResponse(generate(), media_type='application/x-ndjson')
+
+    # Get the records from the database.
+    records = await get_db_manager().get_records(table_name, filters=data, fields=fields, after=after, limit=limit)
+
+    if records is not None:
+        next_cursor = records[-1]['ID'] if records and len(records) == limit else None
+        return Response({'records': records, 'next_cursor': next_cursor}, 200)
+    else:
+        return Response({'message': 'Failed to get records.'}, 500)
+
+
+async def cache_stats(request):
+    # Hit/miss counters of the query cache, to check whether it pays off.
+    if get_db_manager().cache is None:
+        return Response({'message': 'Query cache is disabled.'}, 404)
+    return Response(get_db_manager().cache.stats(), 200)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await get_db_manager().create_tables()
+    yield
+    await get_db_manager().dispose()
+
+
+app = Starlette(routes=[
+    Route('/add_record/{table_name}', add_record, methods=['POST']),
+    Route('/add_records/{table_name}', add_records, methods=['POST']),
+    Route('/upsert_records/{table_name}', upsert_records, methods=['POST']),
+    Route('/update_record/{table_name}', update_record, methods=['PUT']),
+    Route('/delete_record/{table_name}', delete_record, methods=['DELETE']),
+    Route('/get_record/{table_name}', get_record, methods=['GET']),
+    Route('/cache_stats', cache_stats, methods=['GET']),
+], lifespan=lifespan)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=5001)
@@ -0,0 +1,327 @@
+"""
+Async Database Manager
+
+This file contains `AsyncDatabaseManager`, the non-blocking counterpart of
+`DatabaseManager` used by the ASGI API. It reads the same configuration file,
+builds the same tables and statements, and runs them on an asyncpg engine
+sized by the `pooling` section, so that a slow query only holds its own
+connection instead of a server worker.
+
+Author: mdakk072
+
+Usage:
+    db_manager = AsyncDatabaseManager('configDB.yaml')
+    await db_manager.create_tables()
+    records = await db_manager.get_records('Proprietes', filters={'Etat': 'New'})
+    await db_manager.dispose()
+
+"""
+import time
+import yaml
+from sqlalchemy.ext.asyncio import create_async_engine
+from database import DatabaseManager
+
+
+class AsyncDatabaseManager(DatabaseManager):
+    """A DatabaseManager whose operations are coroutines running on an asyncpg engine."""
+
+    def __init__(self, config_file: str):
+        """
+        Initialize the manager with a configuration file.
+
+        Table classes are registered but the schema is not migrated: call
+        `create_tables` once the event loop is running.
+
+        Parameters:
+            config_file (str): The path to the configuration file.
+        """
+        with open(config_file, 'r') as f:
+            self.config = yaml.safe_load(f)
+
+        self.engine = self._configure_engine()
+        self._configure_options()
+        self._build_tables()
+        self.schema_changes = []
+
+    def _configure_engine(self):
+        """Configure the async SQLAlchemy engine and return it."""
+        return create_async_engine(self._engine_url('asyncpg'), **self._engine_options())
+
+    async def create_tables(self):
+        """Bring the database schema up to date, unless it was already migrated to this configuration."""
+        async with self.engine.begin() as connection:
+            self.schema_changes = await connection.run_sync(self._sync_schema)
+
+    async def migrate(self, force=False):
+        """
+        Bring the database schema up to date with the table configuration.
+
+        Parameters:
+            force (bool): Compare the configuration with the database even if
+                the stored fingerprint matches.
+
+        Returns:
+            list: The DDL changes applied.
+        """
+        async with self.engine.begin() as connection:
+            return await connection.run_sync(self._sync_schema, force)
+
+    async def dispose(self):
+        """Close the pooled connections."""
+        await self.engine.dispose()
+
+    def get_session(self):
+        """ORM sessions are synchronous: use the coroutines of this manager, or a `DatabaseManager`."""
+        raise NotImplementedError("AsyncDatabaseManager has no synchronous sessions; use its coroutines "
+                                  "or a DatabaseManager.")
+
+    def session_scope(self):
+        """ORM sessions are synchronous: use the coroutines of this manager, or a `DatabaseManager`."""
+        return self.get_session()
+
+    async def add_record(self, table_name, **kwargs):
+        """
+        Insert one record.
+
+        Parameters:
+            table_name (str): The name of the table.
+            **kwargs: The column values.
+
+        Returns:
+            bool: True if the record was added.
+        """
+        return await self.add_records(table_name, [kwargs]) is not None
+
+    async def add_records(self, table_name, rows):
+        """
+        Insert many records in a single transaction.
+
+        Same behaviour as `DatabaseManager.add_records`; on PostgreSQL, batches
+        of at least `bulk.copy_threshold` rows go through asyncpg's binary COPY.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (list): The records, as dictionaries of column values.
+
+        Returns:
+            int: The number of records added, or None if the insert failed.
+        """
+        try:
+            table, rows = self._prepare_rows(table_name, rows)
+            if not rows:
+                return 0
+            async with self.engine.begin() as connection:
+                if self._can_copy(table) and len(rows) >= self.copy_threshold:
+                    await self._copy_records(connection, table, rows)
+                else:
+                    for group in self._group_rows(rows):
+                        await connection.execute(table.insert(), group)
+        except Exception as e:
+            print(f"Failed to add records: {e}")
+            return None
+        self._invalidate(table_name)
+        return len(rows)
+
+    async def _copy_records(self, connection, table, rows):
+        """
+        Load records with asyncpg's `copy_records_to_table`.
+
+        Parameters:
+            connection (AsyncConnection): The connection of the current transaction.
+            table (Table): The table.
+            rows (list): The records, as dictionaries of column values.
+        """
+        raw_connection = await connection.get_raw_connection()
+        # One COPY per set of columns, so that omitted columns keep their server defaults
+        for group in self._group_rows(rows):
+            columns = [column.name for column in table.columns if column.name in group[0]]
+            await raw_connection.driver_connection.copy_records_to_table(
+                table.name, columns=columns, records=[tuple(row[column] for column in columns) for row in group])
+
+    async def upsert_records(self, table_name, rows, conflict_columns=None):
+        """
+        Insert many records, updating the existing ones that share their unique key.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (list): The records, as dictionaries of column values.
+            conflict_columns (list): The unique columns identifying a record (optional).
+
+        Returns:
+            int: The number of records inserted or updated, or None if the upsert failed.
+        """
+        try:
+            batches, count = self._upsert_batches(table_name, rows, conflict_columns)
+            async with self.engine.begin() as connection:
+                for statement, group in batches:
+                    await connection.execute(statement, group)
+        except Exception as e:
+            print(f"Failed to upsert records: {e}")
+            return None
+        self._invalidate(table_name)
+        return count
+
+    async def update_record(self, table_name, filters, **kwargs):
+        """
+        Update every record matching the filters with a single UPDATE statement.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters (see `_build_conditions`).
+            **kwargs: The new column values.
+
+        Returns:
+            int: The number of records updated, or None if the update failed.
+        """
+        try:
+            statement = self._update_statement(table_name, filters, kwargs)
+            async with self.engine.begin() as connection:
+                count = (await connection.execute(statement)).rowcount
+        except Exception as e:
+            print(f"Failed to update records: {e}")
+            return None
+        self._invalidate(table_name)
+        return count
+
+    async def claim_records(self, table_name, filters, limit, fields=None, **kwargs):
+        """
+        Atomically set new values on the first records matching the filters and return them.
+
+        Same behaviour as `DatabaseManager.claim_records`.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters selecting the claimable records (see `_build_conditions`).
+            limit (int): The maximum number of records to claim.
+            fields (list): The columns to return besides the ID (optional, all columns).
+            **kwargs: The new column values marking the records as claimed.
+
+        Returns:
+            list: The claimed records, as dictionaries ordered by ID, or None if the claim failed.
+        """
+        try:
+            statement, key = self._claim_statement(table_name, filters, limit, fields, kwargs)
+            async with self.engine.begin() as connection:
+                records = [dict(row._mapping) for row in await connection.execute(statement)]
+        except Exception as e:
+            print(f"Failed to claim records: {e}")
+            return None
+        self._invalidate(table_name)
+        return sorted(records, key=lambda record: record[key])
+
+    async def update_records(self, table_name, rows):
+        """
+        Update many records by ID, each with its own values, in one transaction.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (iterable): The records, as dictionaries of column values including the ID.
+
+        Returns:
+            int: The number of records updated, or None if the update failed.
+        """
+        try:
+            count = 0
+            async with self.engine.begin() as connection:
+                for statement, parameters in self._update_batches(table_name, rows):
+                    count += (await connection.execute(statement, parameters)).rowcount
+        except Exception as e:
+            print(f"Failed to update records: {e}")
+            return None
+        self._invalidate(table_name)
+        return count
+
+    async def delete_records(self, table_name, filters):
+        """
+        Delete every record matching the filters with a single DELETE statement.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters (see `_build_conditions`).
+
+        Returns:
+            int: The number of records deleted, or None if the delete failed.
+        """
+        try:
+            statement = self._delete_statement(table_name, filters)
+            async with self.engine.begin() as connection:
+                count = (await connection.execute(statement)).rowcount
+        except Exception as e:
+            print(f"Failed to delete records: {e}")
+            return None
+        self._invalidate(table_name)
+        return count
+
+    async def _check_slow_query(self, connection, statement, elapsed):
+        """Print the plan of a slow query, as `DatabaseManager._check_slow_query` does."""
+        if not self._is_slow(elapsed):
+            return
+        try:
+            compiled, explain = self._explain_statement(statement)
+            self._print_plan(compiled, (await connection.execute(explain)).fetchall(), elapsed)
+        except Exception as e:
+            print(f"Failed to explain slow query: {e}")
+
+    async def get_records(self, table_name, **kwargs):
+        """
+        Get the records of a table matching the given filters.
+
+        Parameters:
+            table_name (str): The name of the table.
+            **kwargs: The same options as `DatabaseManager.get_records`.
+
+        Returns:
+            list: The records as dictionaries, or None if the query failed.
+        """
+        if self.cache is None:
+            return await self._get_records(table_name, **kwargs)
+        params = {key: kwargs.get(key) for key in ('filters', 'fields', 'after', 'limit')}
+        found, records, token = self.cache.lookup(table_name, params)
+        if found:
+            return records
+        records = await self._get_records(table_name, **kwargs)
+        self.cache.store(token, records)
+        return records
+
+    async def _get_records(self, table_name, **kwargs):
+        """Run the query of `get_records` against the database."""
+        try:
+            statement = self._select_records(
+                table_name,
+                filters=kwargs.get('filters', {}),
+                fields=kwargs.get('fields'),
+                after=kwargs.get('after'),
+                limit=kwargs.get('limit', -1),
+            )
+            async with self.engine.connect() as connection:
+                start = time.perf_counter()
+                records = [dict(row._mapping) for row in await connection.execute(statement)]
+                await self._check_slow_query(connection, statement, time.perf_counter() - start)
+                return records
+        except Exception as e:
+            print(f"Failed to get records: {e}")
+            return None
+
+    async def iter_records(self, table_name, batch_size=1000, **kwargs):
+        """
+        Stream the records of a table from a server-side cursor.
+
+        Parameters:
+            table_name (str): The name of the table.
+            batch_size (int): The number of rows fetched from the cursor at a time.
+            **kwargs: The same options as `get_records`.
+
+        Yields:
+            dict: The records.
+        """
+        statement = self._select_records(
+            table_name,
+            filters=kwargs.get('filters', {}),
+            fields=kwargs.get('fields'),
+            after=kwargs.get('after'),
+            limit=kwargs.get('limit', -1),
+        )
+        async with self.engine.connect() as connection:
+            result = await connection.stream(statement.execution_options(yield_per=batch_size))
+            async for row in result:
+                yield dict(row._mapping)
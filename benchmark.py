@@ -0,0 +1,379 @@
+"""
+Extraction Benchmark
+
+This file benchmarks the extraction states of a scraper configuration
+offline, on saved pages: no browser and no network are involved. Each page
+goes through the `scrap_page` lookup (on the static HTML) and the chain of
+extraction states that follows it in the FSM (`extract_data` /
+`extract_infos` or `extract_records`), exactly as `Scraper` runs them.
+
+The run reports:
+    - pages/sec and the p50/p99 latency of a page, and of each state;
+    - the mean latency of each field of the extraction plans;
+    - the Python allocations of a page (peak and retained memory, with
+      tracemalloc; the C allocations of lxml are not traced);
+    - the number of records emitted.
+
+Runs can be saved as JSON and compared, to validate parser and selector
+optimizations with numbers.
+
+Author: mdakk072
+
+Usage:
+    python benchmark.py run configAvito.yaml fixtures/avito --output before.json
+    python benchmark.py run configAvito.yaml --from-cache pages_avito.sqlite --output after.json
+    python benchmark.py compare before.json after.json --threshold 0.1
+
+"""
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+from lxml import html
+
+EXTRACTION_METHODS = ('extract_data', 'extract_infos', 'extract_records')
+
+
+def percentile(values, p):
+    """
+    Return the p-th percentile of values (nearest rank).
+
+    Args:
+        values (list): The values.
+        p (float): The percentile, between 0 and 1.
+
+    Returns:
+        float: The percentile, or None if there is no value.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def summarize(durations):
+    """Return the count, mean, p50 and p99 of durations in seconds, in milliseconds."""
+    return {
+        'count': len(durations),
+        'mean_ms': statistics.mean(durations) * 1000 if durations else None,
+        'p50_ms': percentile(durations, 0.50) * 1000 if durations else None,
+        'p99_ms': percentile(durations, 0.99) * 1000 if durations else None,
+    }
+
+
+def load_fixtures(directory=None, cache_path=None):
+    """
+    Load the saved pages to benchmark.
+
+    Args:
+        directory (str): A directory of `.html` / `.htm` files (optional).
+        cache_path (str): A page cache file (see `PageCache`) whose pages are used (optional).
+
+    Returns:
+        list: (name, HTML) pairs.
+    """
+    pages = []
+    if directory:
+        for path in sorted(glob.glob(os.path.join(directory, '*.htm*'))):
+            with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                pages.append((os.path.basename(path), file.read()))
+    if cache_path:
+        from pagecache import PageCache
+        cache = PageCache(cache_path)
+        pages.extend((url, cache.get_page(url)) for url in cache.urls())
+        cache.close()
+    return pages
+
+
+class ExtractionBenchmark:
+    """Run the extraction states of a configuration on saved pages and measure them."""
+
+    def __init__(self, config_file):
+        """
+        Load the configuration and build an offline scraper from it.
+
+        Args:
+            config_file (str): The path to the scraper configuration.
+
+        Raises:
+            ValueError: If the configuration has no scrap_page state followed by extraction states.
+        """
+        with open(config_file, 'r', encoding='utf-8') as file:
+            config = yaml.safe_load(file)
+        states = config['states']
+        scrap_states = [state for state, step in states.items() if step['method'] == 'scrap_page'
+                        and states.get(step.get('next_state'), {}).get('method') in EXTRACTION_METHODS]
+        if not scrap_states:
+            raise ValueError("The configuration has no scrap_page state followed by an extraction state.")
+        self.scrap_step = states[scrap_states[0]]
+        self.chain = []
+        state = self.scrap_step.get('next_state')
+        while state in states and states[state]['method'] in EXTRACTION_METHODS and state not in self.chain:
+            self.chain.append(state)
+            state = states[state].get('next_state')
+
+        # An offline scraper: no checkpoint, frontier or page cache file next to the configuration
+        for section in ('checkpoint', 'frontier', 'page_cache', 'sink', 'metrics'):
+            config.pop(section, None)
+        self._directory = tempfile.TemporaryDirectory()
+        config['checkpoint'] = {'path': os.path.join(self._directory.name, 'checkpoint.sqlite')}
+        offline_config = os.path.join(self._directory.name, os.path.basename(config_file))
+        with open(offline_config, 'w', encoding='utf-8') as file:
+            yaml.safe_dump(config, file)
+        from Scrapper import Scraper
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.scraper = Scraper(offline_config)
+        self.scraper.interactive = False
+        self.scraper.save_progress = False
+        self.scraper.engine = 'http'
+        self.config = config
+
+    def _scrap(self, page_html):
+        parameters = self.scrap_step.get('parameters', {})
+        self.scraper.page_source = page_html
+        self.scraper.current_url = None
+        return self.scraper.scrap_page(parameters['by_method'], parameters['value'])
+
+    def _run_page(self, page_html, timings=None, inputs=None):
+        """
+        Run the scrap_page lookup and the extraction chain on a page.
+
+        Args:
+            page_html (str): The HTML of the page.
+            timings (dict): Receives the duration of each state, by state name (optional).
+            inputs (list): Receives the (state, parameters) of each extraction state (optional).
+
+        Returns:
+            The output of the last extraction state.
+        """
+        start = time.perf_counter()
+        result = self._scrap(page_html)
+        if timings is not None:
+            timings.setdefault('scrap_page', []).append(time.perf_counter() - start)
+        for state in self.chain:
+            step = self.config['states'][state]
+            parameters = {key: result if value == '{previous_result}' else value
+                          for key, value in step.get('parameters', {}).items()}
+            if inputs is not None:
+                inputs.append((state, parameters))
+            self.scraper.current_state = state
+            start = time.perf_counter()
+            result = getattr(self.scraper, step['method'])(**parameters)
+            if timings is not None:
+                timings.setdefault(state, []).append(time.perf_counter() - start)
+        return result
+
+    def extract(self, page_html):
+        """
+        Run the scrap_page lookup and the extraction chain on a page.
+
+        Args:
+            page_html (str): The HTML of the page.
+
+        Returns:
+            list: The extracted records.
+        """
+        return list(self.scraper._iter_records(self._run_page(page_html)))
+
+    def _time_fields(self, inputs):
+        """
+        Time each field of the extraction plans on the elements it is evaluated on.
+
+        Args:
+            inputs (list): The (state, parameters) of the extraction states.
+
+        Returns:
+            dict: The durations of the evaluations of each field, by "state.field".
+        """
+        from extraction import extract_field
+        durations = {}
+        for state, parameters in inputs:
+            plan = self.scraper.plans.get(state)
+            if plan is None:
+                continue
+            if plan.selectors and parameters.get('raw_data'):
+                tree = html.fromstring(parameters['raw_data'])
+                elements = [element for selector in plan.selectors for element in selector(tree)]
+            else:
+                elements = [html.fromstring(sample['raw'])
+                            for samples in (parameters.get('extracted_data') or {}).values() for sample in samples]
+            for element in elements:
+                for key, spec, compiled in plan.fields:
+                    start = time.perf_counter()
+                    extract_field(element, spec, compiled(element))
+                    durations.setdefault(f"{state}.{key}", []).append(time.perf_counter() - start)
+        return durations
+
+    def run(self, pages, repeat=5, warmup=1):
+        """
+        Benchmark the extraction of the pages.
+
+        Args:
+            pages (list): (name, HTML) pairs.
+            repeat (int): The number of measured passes over the pages.
+            warmup (int): The number of passes run before measuring.
+
+        Returns:
+            dict: The results.
+        """
+        if not pages:
+            raise ValueError("No page to benchmark.")
+        page_durations, state_durations, inputs = [], {}, []
+        records = 0
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            for _ in range(warmup):
+                for _, page_html in pages:
+                    self._run_page(page_html)
+            start = time.perf_counter()
+            for iteration in range(repeat):
+                for _, page_html in pages:
+                    page_start = time.perf_counter()
+                    result = self._run_page(page_html, state_durations, inputs if iteration == 0 else None)
+                    page_durations.append(time.perf_counter() - page_start)
+                    if iteration == 0:
+                        records += sum(1 for _ in self.scraper._iter_records(result))
+                    output.seek(0)
+                    output.truncate()
+            elapsed = time.perf_counter() - start
+
+            field_durations = self._time_fields(inputs)
+
+            # Allocations, in a separate pass as tracing slows everything down
+            peaks, allocated = [], []
+            tracemalloc.start()
+            for _, page_html in pages:
+                tracemalloc.reset_peak()
+                before = tracemalloc.take_snapshot()
+                self._run_page(page_html)
+                after = tracemalloc.take_snapshot()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+                allocated.append(sum(stat.size_diff for stat in after.compare_to(before, 'filename') if stat.size_diff > 0))
+                output.seek(0)
+                output.truncate()
+            tracemalloc.stop()
+
+        return {
+            'pages': len(pages),
+            'repeat': repeat,
+            'records_per_pass': records,
+            'pages_per_sec': len(page_durations) / elapsed,
+            'page': summarize(page_durations),
+            'states': {state: summarize(durations) for state, durations in state_durations.items()},
+            'fields': {field: summarize(durations) for field, durations in field_durations.items()},
+            'memory': {
+                'peak_kib_mean': statistics.mean(peaks) / 1024,
+                'peak_kib_max': max(peaks) / 1024,
+                'retained_kib_mean': statistics.mean(allocated) / 1024,
+            },
+        }
+
+
+def print_results(results):
+    """Print the results of a run."""
+    format_ms = lambda value: f"{value:10.3f}" if value is not None else f"{'-':>10}"
+    print(f"{results['pages']} pages x {results['repeat']}: {results['pages_per_sec']:.1f} pages/sec, "
+          f"{results['records_per_pass']} records per pass")
+    print(f"{'':<40} {'mean ms':>10} {'p50 ms':>10} {'p99 ms':>10}")
+    rows = [('page', results['page'])] + [(f"state {state}", summary) for state, summary in results['states'].items()]
+    rows += [(f"field {field}", summary) for field, summary in results['fields'].items()]
+    for name, summary in rows:
+        print(f"{name[:40]:<40} {format_ms(summary['mean_ms'])} {format_ms(summary['p50_ms'])} {format_ms(summary['p99_ms'])}")
+    memory = results['memory']
+    print(f"memory: peak {memory['peak_kib_mean']:.1f} KiB per page (max {memory['peak_kib_max']:.1f} KiB), "
+          f"{memory['retained_kib_mean']:.1f} KiB allocated and kept")
+
+
+def compare(baseline, candidate, threshold=0.1):
+    """
+    Print the changes between two runs and tell whether the candidate regressed.
+
+    A regression is a throughput lower, or a page p99 / peak memory higher,
+    than the baseline by more than the threshold.
+
+    Args:
+        baseline (dict): The results of the reference run.
+        candidate (dict): The results of the run to check.
+        threshold (float): The tolerated relative change.
+
+    Returns:
+        bool: True if the candidate regressed.
+    """
+    def change(old, new):
+        return (new - old) / old if old else 0.0
+
+    metrics = [
+        ('pages/sec', baseline['pages_per_sec'], candidate['pages_per_sec'], False),
+        ('page p50 ms', baseline['page']['p50_ms'], candidate['page']['p50_ms'], True),
+        ('page p99 ms', baseline['page']['p99_ms'], candidate['page']['p99_ms'], True),
+        ('peak KiB', baseline['memory']['peak_kib_mean'], candidate['memory']['peak_kib_mean'], True),
+    ]
+    for state in baseline['states'].keys() & candidate['states'].keys():
+        metrics.append((f"state {state} p50 ms", baseline['states'][state]['p50_ms'],
+                        candidate['states'][state]['p50_ms'], True))
+    for field in sorted(baseline['fields'].keys() & candidate['fields'].keys()):
+        metrics.append((f"field {field} mean ms", baseline['fields'][field]['mean_ms'],
+                        candidate['fields'][field]['mean_ms'], True))
+
+    regressed = False
+    print(f"{'':<40} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for name, old, new, lower_is_better in metrics:
+        delta = change(old, new)
+        worse = delta > threshold if lower_is_better else delta < -threshold
+        gating = name in ('pages/sec', 'page p99 ms', 'peak KiB')
+        regressed |= worse and gating
+        flag = ' REGRESSION' if worse and gating else (' worse' if worse else '')
+        print(f"{name[:40]:<40} {old:10.3f} {new:10.3f} {delta:+8.1%}{flag}")
+    if baseline['records_per_pass'] != candidate['records_per_pass']:
+        print(f"records per pass changed: {baseline['records_per_pass']} -> {candidate['records_per_pass']}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the extraction states of a configuration offline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='Benchmark a configuration on saved pages.')
+    run_parser.add_argument('config', help='The scraper configuration.')
+    run_parser.add_argument('fixtures', nargs='?', help='A directory of saved .html pages.')
+    run_parser.add_argument('--from-cache', help='Use the pages of a page cache file.')
+    run_parser.add_argument('--repeat', type=int, default=5, help='The number of measured passes.')
+    run_parser.add_argument('--warmup', type=int, default=1, help='The number of passes before measuring.')
+    run_parser.add_argument('--output', help='Save the results as JSON.')
+    run_parser.add_argument('--compare', help='Compare with the results of a previous run.')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='The tolerated relative change.')
+    compare_parser = commands.add_parser('compare', help='Compare two saved runs.')
+    compare_parser.add_argument('baseline', help='The results of the reference run.')
+    compare_parser.add_argument('candidate', help='The results of the run to check.')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='The tolerated relative change.')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        with open(args.candidate, 'r', encoding='utf-8') as file:
+            candidate = json.load(file)
+        sys.exit(1 if compare(baseline, candidate, args.threshold) else 0)
+
+    from metrics import configure_logging
+    configure_logging(level='WARNING')
+    pages = load_fixtures(args.fixtures, args.from_cache)
+    results = ExtractionBenchmark(args.config).run(pages, args.repeat, args.warmup)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        sys.exit(1 if compare(baseline, results, args.threshold) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Query Cache
+
+This file contains `QueryCache`, the read-through cache placed in front of
+`DatabaseManager.get_records`. Entries expire after a TTL, the least recently
+used entries are evicted when the cache is full, and writes to a table
+invalidate every cached query of that table.
+
+The cache lives in the memory of one process and only sees the writes made
+through its own `DatabaseManager`. Writes made elsewhere (enrich.py, another
+API worker process, a script or a manual query) are not invalidated: reads may
+return the previous rows until the entries expire, i.e. for up to `ttl`
+seconds.
+
+Author: mdakk072
+
+Usage:
+    cache = QueryCache(ttl=30, max_entries=1024)
+    records = cache.get_or_load('Proprietes', {'filters': {'Etat': 'New'}}, load)
+    cache.invalidate('Proprietes')
+
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    """A thread-safe TTL and LRU cache of query results, invalidated per table."""
+
+    def __init__(self, ttl=30, max_entries=1024):
+        """
+        Initialize the cache.
+
+        Parameters:
+            ttl (float): The number of seconds an entry stays valid.
+            max_entries (int): The number of entries above which the least recently used is evicted.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (expiry, value)
+        self._keys_by_table = {}
+        self._generations = {}  # Bumped by invalidate() to discard loads started before it
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(table_name, params):
+        """
+        Build the cache key of a query.
+
+        Parameters:
+            table_name (str): The name of the table.
+            params (dict): The query parameters (filters, limit, ...).
+
+        Returns:
+            tuple: The key, identical for equivalent parameters whatever their order.
+        """
+        return table_name, json.dumps(params, sort_keys=True, default=str)
+
+    def get_or_load(self, table_name, params, load):
+        """
+        Return the cached result of a query, or load and cache it.
+
+        Parameters:
+            table_name (str): The name of the table.
+            params (dict): The query parameters.
+            load (callable): Runs the query; a None result is not cached.
+
+        Returns:
+            The query result.
+        """
+        found, value, token = self.lookup(table_name, params)
+        if found:
+            return value
+        value = load()
+        self.store(token, value)
+        return value
+
+    def lookup(self, table_name, params):
+        """
+        Look a query up, for callers that run the query themselves (e.g. with await).
+
+        Parameters:
+            table_name (str): The name of the table.
+            params (dict): The query parameters.
+
+        Returns:
+            tuple: Whether the query was found, its cached result and the token
+                to pass to `store` with the loaded result on a miss.
+        """
+        key = self.make_key(table_name, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1], None
+            self.misses += 1
+            return False, None, (key, self._generations.get(table_name, 0))
+
+    def store(self, token, value):
+        """
+        Cache the result loaded after a missed `lookup`.
+
+        The result is dropped if the table was invalidated since the lookup.
+
+        Parameters:
+            token (tuple): The token returned by `lookup`.
+            value: The query result; None is not cached.
+        """
+        if value is None or token is None:
+            return
+        key, generation = token
+        with self._lock:
+            if self._generations.get(key[0], 0) == generation:
+                self._store(key, value)
+
+    def _store(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        self._keys_by_table.setdefault(key[0], set()).add(key)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._keys_by_table[evicted[0]].discard(evicted)
+            self.evictions += 1
+
+    def invalidate(self, table_name):
+        """
+        Drop every cached query of a table.
+
+        Parameters:
+            table_name (str): The name of the table that was written to.
+        """
+        with self._lock:
+            self._generations[table_name] = self._generations.get(table_name, 0) + 1
+            for key in self._keys_by_table.pop(table_name, set()):
+                self._entries.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        Return the counters of the cache.
+
+        Returns:
+            dict: Hits, misses, hit ratio, evictions, invalidations and size.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+            }
@@ -0,0 +1,253 @@
+"""
+Checkpoint Store
+
+This file contains `CheckpointStore`, the SQLite file in which the scraper
+records the progress of its crawls, instead of rewriting its YAML
+configuration on every page:
+    - per crawl, the FSM state being executed, the next page to crawl and the
+      URL in flight (navigated to but not processed yet), so that
+      `scrape_site(resume=True)` continues where the crawl stopped;
+    - the page ranges claimed by parallel crawls, so that several processes
+      sharing the store crawl distinct ranges. A claim is leased: a range
+      whose owner stopped renewing it can be claimed again, from the page
+      where its owner stopped.
+
+Author: mdakk072
+
+Usage:
+    store = CheckpointStore('checkpoint_avito.sqlite')
+    store.save('avito', state='scrap_page', next_page=16)
+    claim = store.claim_range('avito', 1, 100, size=10, owner='host-1')
+
+"""
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawls (
+    crawl_id TEXT PRIMARY KEY,
+    state TEXT,
+    next_page INTEGER,
+    inflight_state TEXT,
+    inflight_url TEXT,
+    finished INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS claims (
+    crawl_id TEXT NOT NULL,
+    first_page INTEGER NOT NULL,
+    last_page INTEGER NOT NULL,
+    next_page INTEGER NOT NULL,
+    owner TEXT,
+    expires_at REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (crawl_id, first_page)
+);
+"""
+
+
+class CheckpointStore:
+    """A SQLite store of crawl checkpoints and page range claims, shared by threads and processes."""
+
+    def __init__(self, path, lease=600):
+        """
+        Open (and create if needed) the store.
+
+        Args:
+            path (str): The path of the SQLite file.
+            lease (float): The number of seconds a claim stays owned without being renewed.
+        """
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+
+    def _transaction(self, callback):
+        """Run callback(cursor) in an immediate (write-locked) transaction and return its result."""
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                result = callback(cursor)
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            return result
+
+    def load(self, crawl_id):
+        """
+        Return the checkpoint of a crawl.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+
+        Returns:
+            dict: The state, next page, in-flight state and URL and whether the
+                crawl finished, or None if the crawl has no checkpoint.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT state, next_page, inflight_state, inflight_url, finished FROM crawls WHERE crawl_id = ?',
+                (crawl_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'state': row[0],
+            'next_page': row[1],
+            'inflight_state': row[2],
+            'inflight_url': row[3],
+            'finished': bool(row[4]),
+        }
+
+    def save(self, crawl_id, **values):
+        """
+        Update the checkpoint of a crawl.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            **values: The columns to update among `state`, `next_page`,
+                `inflight_state`, `inflight_url` and `finished`.
+        """
+        columns = ('state', 'next_page', 'inflight_state', 'inflight_url', 'finished')
+        unknown = set(values) - set(columns)
+        if unknown:
+            raise ValueError(f"Unknown checkpoint fields: {sorted(unknown)}")
+        assignments = ''.join(f', {column} = excluded.{column}' for column in values)
+        placeholders = ''.join(', ?' for _ in values)
+        with self._lock:
+            self._connection.execute(
+                f"INSERT INTO crawls (crawl_id, updated_at{''.join(f', {column}' for column in values)}) "
+                f"VALUES (?, ?{placeholders}) "
+                f"ON CONFLICT (crawl_id) DO UPDATE SET updated_at = excluded.updated_at{assignments}",
+                (crawl_id, time.time(), *values.values()))
+
+    def reset(self, crawl_id):
+        """
+        Forget the checkpoint and the claims of a crawl.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+        """
+        def delete(cursor):
+            cursor.execute('DELETE FROM crawls WHERE crawl_id = ?', (crawl_id,))
+            cursor.execute('DELETE FROM claims WHERE crawl_id = ?', (crawl_id,))
+        self._transaction(delete)
+
+    def reset_claims(self, crawl_id, finished_only=False):
+        """
+        Forget the page ranges claimed by a crawl, so that its pages are crawled again.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            finished_only (bool): Only forget them if every claimed range is done,
+                i.e. no crawl is running or waiting to be resumed.
+
+        Returns:
+            int: The number of ranges forgotten.
+        """
+        def delete(cursor):
+            if finished_only and cursor.execute(
+                    'SELECT 1 FROM claims WHERE crawl_id = ? AND done = 0 LIMIT 1', (crawl_id,)).fetchone():
+                return 0
+            return cursor.execute('DELETE FROM claims WHERE crawl_id = ?', (crawl_id,)).rowcount
+        return self._transaction(delete)
+
+    def claim_range(self, crawl_id, first_page, last_page, size, owner):
+        """
+        Claim the next range of pages to crawl.
+
+        A range whose lease expired is taken over first, from the page where
+        its previous owner stopped; otherwise the range following the last
+        claimed one is claimed.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            first_page (int): The first page of the crawl.
+            last_page (int): The last page of the crawl.
+            size (int): The number of pages of a new range.
+            owner (str): The identifier of the claiming worker.
+
+        Returns:
+            dict: The claimed range (`first_page`, `last_page` and the
+                `next_page` to crawl), or None if every page is claimed.
+        """
+        def claim(cursor):
+            now = time.time()
+            row = cursor.execute(
+                'SELECT first_page, last_page, next_page FROM claims '
+                'WHERE crawl_id = ? AND done = 0 AND expires_at < ? AND first_page BETWEEN ? AND ? '
+                'ORDER BY first_page LIMIT 1',
+                (crawl_id, now, first_page, last_page)).fetchone()
+            if row is not None:
+                cursor.execute('UPDATE claims SET owner = ?, expires_at = ? WHERE crawl_id = ? AND first_page = ?',
+                               (owner, now + self.lease, crawl_id, row[0]))
+                return {'first_page': row[0], 'last_page': row[1], 'next_page': row[2]}
+            claimed_until = cursor.execute(
+                'SELECT MAX(last_page) FROM claims WHERE crawl_id = ? AND first_page BETWEEN ? AND ?',
+                (crawl_id, first_page, last_page)).fetchone()[0]
+            start = first_page if claimed_until is None else claimed_until + 1
+            if start > last_page:
+                return None
+            end = min(start + size - 1, last_page)
+            cursor.execute(
+                'INSERT INTO claims (crawl_id, first_page, last_page, next_page, owner, expires_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (crawl_id, start, end, start, owner, now + self.lease))
+            return {'first_page': start, 'last_page': end, 'next_page': start}
+        return self._transaction(claim)
+
+    def advance_claim(self, crawl_id, claim, next_page):
+        """
+        Record the progress of a claimed range and renew its lease.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            claim (dict): The claim returned by `claim_range`.
+            next_page (int): The next page of the range to crawl; past the
+                last page, the range is marked done.
+        """
+        claim['next_page'] = next_page
+        with self._lock:
+            self._connection.execute(
+                'UPDATE claims SET next_page = ?, expires_at = ?, done = ? WHERE crawl_id = ? AND first_page = ?',
+                (next_page, time.time() + self.lease, int(next_page > claim['last_page']),
+                 crawl_id, claim['first_page']))
+
+    def release_claim(self, crawl_id, claim):
+        """
+        Give a claimed range up, so that another worker can take it over at once.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            claim (dict): The claim returned by `claim_range`.
+        """
+        with self._lock:
+            self._connection.execute(
+                'UPDATE claims SET owner = NULL, expires_at = 0 WHERE crawl_id = ? AND first_page = ? AND done = 0',
+                (crawl_id, claim['first_page']))
+
+    def release_owner(self, crawl_id, owner):
+        """
+        Give up the unfinished ranges of an owner, e.g. when a crashed crawl is resumed.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            owner (str): The identifier the ranges were claimed with.
+
+        Returns:
+            int: The number of ranges released.
+        """
+        with self._lock:
+            return self._connection.execute(
+                'UPDATE claims SET owner = NULL, expires_at = 0 WHERE crawl_id = ? AND owner = ? AND done = 0',
+                (crawl_id, owner)).rowcount
+
+    def close(self):
+        """Close the store."""
+        with self._lock:
+            self._connection.close()
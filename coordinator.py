@@ -0,0 +1,531 @@
+"""
+Crawl Coordinator
+
+This file spreads one crawl over several machines. The coordinator splits the
+crawl definition of a scraper configuration into work units on a shared queue:
+    - `pages` units, ranges of the listing pages of a `goto_next_page` crawl;
+    - `url` units, the detail URLs queued in the frontier, visited from the
+      `coordinator.url_state` state (e.g. `goto_link`).
+Any number of `CrawlWorker` processes, on any number of hosts, then claim the
+units and run them on their own driver pool.
+
+`WorkQueue` holds the units in a `work_units` table, either in PostgreSQL
+(the database of a `DatabaseManager` configuration, claimed with
+`FOR UPDATE SKIP LOCKED`) or in a local SQLite file for a single host or for
+tests. A claimed unit is leased: workers renew the leases of their units with
+a heartbeat, and a unit whose lease expired (its worker died) is delivered
+again, up to `max_attempts` times, from the page where it stopped.
+
+Author: mdakk072
+
+Usage:
+    python coordinator.py plan configAvito.yaml
+    python coordinator.py work configAvito.yaml --threads 4
+    python coordinator.py stats configAvito.yaml
+
+"""
+import argparse
+import copy
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import Column, Float, Index, Integer, MetaData, String, Table, Text, UniqueConstraint, \
+    create_engine, event, text
+
+logger = logging.getLogger(__name__)
+
+STATUSES = ('queued', 'leased', 'done', 'failed')
+
+metadata = MetaData()
+work_units = Table(
+    'work_units', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('crawl_id', String, nullable=False),
+    Column('unit_key', String, nullable=False),
+    Column('kind', String, nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('status', String, nullable=False, default='queued'),
+    Column('owner', String),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('progress', Integer),
+    Column('lease_expires', Float, nullable=False, default=0),
+    Column('updated_at', Float, nullable=False),
+    Column('error', Text),
+    UniqueConstraint('crawl_id', 'unit_key', name='uq_work_units_key'),
+    Index('ix_work_units_claim', 'crawl_id', 'status', 'id'),
+)
+
+
+class WorkQueue:
+    """A leased work queue in a PostgreSQL or SQLite table, shared by processes and hosts."""
+
+    def __init__(self, engine, lease=120, max_attempts=3):
+        """
+        Create the `work_units` table if needed.
+
+        Args:
+            engine (Engine): The SQLAlchemy engine of the database holding the queue.
+            lease (float): The number of seconds a unit stays claimed without a heartbeat.
+            max_attempts (int): The number of deliveries of a unit before it is marked failed.
+        """
+        self.engine = engine
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # Claimers skip the rows locked by each other; SQLite serializes writers instead
+        self._skip_locked = ' FOR UPDATE SKIP LOCKED' if engine.dialect.name == 'postgresql' else ''
+        metadata.create_all(engine)
+
+    @classmethod
+    def open(cls, location, lease=120, max_attempts=3):
+        """
+        Open the queue of a `DatabaseManager` configuration or of a SQLite file.
+
+        Args:
+            location (str): A `.yaml` database configuration (PostgreSQL) or the path of a SQLite file.
+            lease (float): The number of seconds a unit stays claimed without a heartbeat.
+            max_attempts (int): The number of deliveries of a unit before it is marked failed.
+
+        Returns:
+            WorkQueue: The queue.
+        """
+        if location.endswith(('.yaml', '.yml')):
+            from database import DatabaseManager
+            engine = DatabaseManager(location).engine
+        else:
+            engine = create_engine(f"sqlite:///{location}", connect_args={'timeout': 30})
+
+            @event.listens_for(engine, 'connect')
+            def configure(connection, _):
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+        return cls(engine, lease, max_attempts)
+
+    def enqueue(self, crawl_id, units):
+        """
+        Add work units to the queue, ignoring the ones already queued.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            units (iterable): The units, as (kind, payload dict) tuples.
+
+        Returns:
+            int: The number of units added.
+        """
+        now = time.time()
+        rows = [{
+            'crawl_id': crawl_id,
+            'unit_key': f"{kind}:{json.dumps(payload, sort_keys=True)}",
+            'kind': kind,
+            'payload': json.dumps(payload),
+            'now': now,
+        } for kind, payload in units]
+        if not rows:
+            return 0
+        statement = text(
+            "INSERT INTO work_units (crawl_id, unit_key, kind, payload, status, attempts, lease_expires, updated_at) "
+            "VALUES (:crawl_id, :unit_key, :kind, :payload, 'queued', 0, 0, :now) "
+            "ON CONFLICT (crawl_id, unit_key) DO NOTHING")
+        with self.engine.begin() as connection:
+            before = self._count(connection, crawl_id)
+            connection.execute(statement, rows)
+            return self._count(connection, crawl_id) - before
+
+    @staticmethod
+    def _count(connection, crawl_id):
+        return connection.execute(text('SELECT COUNT(*) FROM work_units WHERE crawl_id = :crawl_id'),
+                                  {'crawl_id': crawl_id}).scalar()
+
+    def claim(self, crawl_id, owner, limit=1):
+        """
+        Lease the next queued units, and the units whose lease expired.
+
+        An expired unit that was already delivered `max_attempts` times is
+        marked failed instead.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+            owner (str): The identifier of the claiming worker.
+            limit (int): The maximum number of units to claim.
+
+        Returns:
+            list: The claimed units, as dicts with `id`, `kind`, `payload`,
+                `progress` and `attempts`, in queue order.
+        """
+        now = time.time()
+        parameters = {'crawl_id': crawl_id, 'owner': owner, 'now': now, 'expires': now + self.lease,
+                      'limit': limit, 'max_attempts': self.max_attempts}
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE work_units SET status = 'failed', owner = NULL, updated_at = :now "
+                "WHERE crawl_id = :crawl_id AND status = 'leased' AND lease_expires < :now "
+                "AND attempts >= :max_attempts"), parameters)
+            rows = connection.execute(text(
+                "UPDATE work_units SET status = 'leased', owner = :owner, attempts = attempts + 1, "
+                "lease_expires = :expires, updated_at = :now "
+                "WHERE id IN (SELECT id FROM work_units WHERE crawl_id = :crawl_id "
+                "AND (status = 'queued' OR (status = 'leased' AND lease_expires < :now)) "
+                f"ORDER BY id LIMIT :limit{self._skip_locked}) "
+                "RETURNING id, kind, payload, progress, attempts"), parameters).fetchall()
+        units = [{'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'progress': row[3],
+                  'attempts': row[4]} for row in rows]
+        return sorted(units, key=lambda unit: unit['id'])
+
+    def heartbeat(self, owner):
+        """
+        Renew the leases of the units of a worker.
+
+        Args:
+            owner (str): The identifier of the worker.
+
+        Returns:
+            int: The number of leases renewed.
+        """
+        now = time.time()
+        with self.engine.begin() as connection:
+            return connection.execute(text(
+                "UPDATE work_units SET lease_expires = :expires, updated_at = :now "
+                "WHERE owner = :owner AND status = 'leased'"),
+                {'owner': owner, 'now': now, 'expires': now + self.lease}).rowcount
+
+    def progress(self, unit, owner, progress):
+        """
+        Record the progress of a unit (e.g. its next page) and renew its lease.
+
+        Args:
+            unit (dict): The unit returned by `claim`.
+            owner (str): The identifier of the worker.
+            progress (int): The progress, from which a redelivered unit restarts.
+
+        Returns:
+            bool: False if the unit is no longer leased by the worker.
+        """
+        unit['progress'] = progress
+        now = time.time()
+        with self.engine.begin() as connection:
+            return connection.execute(text(
+                "UPDATE work_units SET progress = :progress, lease_expires = :expires, updated_at = :now "
+                "WHERE id = :id AND owner = :owner AND status = 'leased'"),
+                {'id': unit['id'], 'owner': owner, 'progress': progress, 'now': now,
+                 'expires': now + self.lease}).rowcount == 1
+
+    def complete(self, unit, owner):
+        """
+        Mark a unit done.
+
+        Args:
+            unit (dict): The unit returned by `claim`.
+            owner (str): The identifier of the worker.
+
+        Returns:
+            bool: False if the unit was meanwhile delivered to another worker.
+        """
+        with self.engine.begin() as connection:
+            return connection.execute(text(
+                "UPDATE work_units SET status = 'done', owner = NULL, updated_at = :now "
+                "WHERE id = :id AND owner = :owner AND status = 'leased'"),
+                {'id': unit['id'], 'owner': owner, 'now': time.time()}).rowcount == 1
+
+    def release(self, unit, owner, error=None):
+        """
+        Give a unit up after an error: it is queued again, or marked failed after `max_attempts`.
+
+        Args:
+            unit (dict): The unit returned by `claim`.
+            owner (str): The identifier of the worker.
+            error (str): The error message (optional).
+        """
+        status = 'failed' if unit['attempts'] >= self.max_attempts else 'queued'
+        with self.engine.begin() as connection:
+            connection.execute(text(
+                "UPDATE work_units SET status = :status, owner = NULL, lease_expires = 0, error = :error, "
+                "updated_at = :now WHERE id = :id AND owner = :owner AND status = 'leased'"),
+                {'id': unit['id'], 'owner': owner, 'status': status, 'error': error, 'now': time.time()})
+
+    def release_owner(self, owner):
+        """
+        Queue again the units of a worker that stopped, without waiting for their leases to expire.
+
+        Args:
+            owner (str): The identifier of the worker.
+
+        Returns:
+            int: The number of units released.
+        """
+        with self.engine.begin() as connection:
+            return connection.execute(text(
+                "UPDATE work_units SET status = 'queued', owner = NULL, lease_expires = 0, updated_at = :now "
+                "WHERE owner = :owner AND status = 'leased'"), {'owner': owner, 'now': time.time()}).rowcount
+
+    def stats(self, crawl_id):
+        """
+        Count the units of a crawl by status.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+
+        Returns:
+            dict: The number of units of each status.
+        """
+        counts = dict.fromkeys(STATUSES, 0)
+        with self.engine.connect() as connection:
+            for status, count in connection.execute(text(
+                    'SELECT status, COUNT(*) FROM work_units WHERE crawl_id = :crawl_id GROUP BY status'),
+                    {'crawl_id': crawl_id}):
+                counts[status] = count
+        return counts
+
+    def reset(self, crawl_id):
+        """
+        Remove every unit of a crawl.
+
+        Args:
+            crawl_id (str): The crawl identifier.
+        """
+        with self.engine.begin() as connection:
+            connection.execute(text('DELETE FROM work_units WHERE crawl_id = :crawl_id'), {'crawl_id': crawl_id})
+
+
+def open_queue(config):
+    """
+    Open the work queue of the `coordinator` section of a scraper configuration.
+
+    Args:
+        config (dict): The scraper configuration.
+
+    Returns:
+        WorkQueue: The queue.
+    """
+    settings = config.get('coordinator', {})
+    return WorkQueue.open(settings.get('queue', 'work_units.sqlite'), settings.get('lease', 120),
+                          settings.get('max_attempts', 3))
+
+
+def plan(scraper, queue):
+    """
+    Split the crawl of a scraper configuration into work units.
+
+    A configuration starting with `goto_next_page` is split into ranges of
+    `coordinator.pages_per_unit` pages of `concurrency.first_page` to
+    `concurrency.last_page`. With a `coordinator.url_state`, the URLs queued in
+    the frontier are moved to the work queue, one unit per URL.
+
+    Args:
+        scraper (Scraper): The scraper of the configuration.
+        queue (WorkQueue): The work queue.
+
+    Returns:
+        int: The number of units added.
+    """
+    config = scraper.config
+    settings = config.get('coordinator', {})
+    concurrency = config.get('concurrency', {})
+    units = []
+    if config['states'][config['initial_state']]['method'] == 'goto_next_page':
+        first_page = concurrency.get('first_page', 1)
+        last_page = concurrency.get('last_page', first_page)
+        size = settings.get('pages_per_unit', concurrency.get('pages_per_run', 25))
+        for start in range(first_page, last_page + 1, size):
+            units.append(('pages', {'first_page': start, 'last_page': min(start + size - 1, last_page)}))
+    added = queue.enqueue(scraper.crawl_id, units)
+    if settings.get('url_state') and config.get('frontier'):
+        frontier = scraper._get_frontier()
+        while True:
+            urls = []
+            while len(urls) < 500:
+                url = frontier.pop()
+                if url is None:
+                    break
+                urls.append(url)
+            if not urls:
+                break
+            added += queue.enqueue(scraper.crawl_id, [('url', {'url': url}) for url in urls])
+            for url in urls:
+                frontier.done(url)
+    return added
+
+
+class CrawlWorker:
+    """Claim the work units of a crawl and run them on a pool of drivers."""
+
+    def __init__(self, scraper, queue, owner=None, threads=None):
+        """
+        Initialize the worker.
+
+        Args:
+            scraper (Scraper): The scraper of the configuration.
+            queue (WorkQueue): The work queue.
+            owner (str): The identifier of the worker (optional, host name and process id).
+            threads (int): The number of units run at once (optional, `concurrency.workers`).
+        """
+        self.scraper = scraper
+        self.queue = queue
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+        self.threads = threads or scraper.config.get('concurrency', {}).get('workers', 1)
+        settings = scraper.config.get('coordinator', {})
+        self.heartbeat_interval = settings.get('heartbeat', queue.lease / 3)
+        self.poll_interval = settings.get('poll_interval', 5)
+        self.url_config = self._url_config(scraper.config, settings.get('url_state'))
+        self.stats = {'units': 0, 'failed': 0, 'lost': 0, 'pages': 0, 'urls': 0}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    @staticmethod
+    def _url_config(config, url_state):
+        """
+        Derive the configuration running one URL unit: from `url_state` until the
+        FSM reaches a `next_link` state, which would pop the frontier.
+        """
+        if not url_state:
+            return None
+        config = copy.deepcopy(config)
+        config['initial_state'] = url_state
+        states = config['states']
+        for step in states.values():
+            for key in ('next_state', 'on_empty', 'on_unchanged'):
+                if step.get(key) in states and states[step[key]]['method'] == 'next_link':
+                    step[key] = None
+        return config
+
+    def run(self, follow=False):
+        """
+        Run units until every unit of the crawl is done or failed, or until
+        `stop` is called when following the queue.
+
+        Args:
+            follow (bool): Keep polling the queue for new units instead of returning.
+
+        Returns:
+            dict: The number of units done, failed and lost (delivered again to
+                another worker), and of pages and URLs crawled.
+        """
+        from Scrapper import DriverPool
+        heartbeat = threading.Thread(target=self._heartbeat, name='Heartbeat', daemon=True)
+        heartbeat.start()
+        start = time.monotonic()
+        pool = DriverPool(self.scraper._driver_factory(), self.threads)
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                for future in [executor.submit(self._work, pool, follow) for _ in range(self.threads)]:
+                    future.result()
+        finally:
+            self._stop.set()
+            pool.close()
+            self.scraper.flush_sinks()
+            self.queue.release_owner(self.owner)
+        elapsed = time.monotonic() - start
+        summary = dict(self.stats, elapsed=elapsed,
+                       pages_per_minute=(self.stats['pages'] + self.stats['urls']) * 60 / elapsed if elapsed else 0)
+        logger.info(f"> Worker {self.owner} done: {summary}")
+        return summary
+
+    def stop(self):
+        """Stop once the units in progress are done."""
+        self._stop.set()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self.queue.heartbeat(self.owner)
+            except Exception as error:
+                logger.error(f"An error occurred during the heartbeat: {str(error)}")
+
+    def _work(self, pool, follow):
+        """Claim and run units one by one."""
+        while not self._stop.is_set():
+            units = self.queue.claim(self.scraper.crawl_id, self.owner)
+            if not units:
+                # Units leased by other workers are delivered again if their worker dies
+                if not follow and not self.queue.stats(self.scraper.crawl_id)['leased']:
+                    return
+                self._stop.wait(self.poll_interval)
+                continue
+            unit = units[0]
+            try:
+                self._run_unit(pool, unit)
+            except Exception as error:
+                logger.error(f"An error occurred while running the unit {unit['id']} ({unit['payload']}): {str(error)}")
+                self.queue.release(unit, self.owner, str(error))
+                self._count('failed')
+                continue
+            self._count('units' if self.queue.complete(unit, self.owner) else 'lost')
+
+    def _count(self, name, value=1):
+        with self._stats_lock:
+            self.stats[name] += value
+
+    def _run_unit(self, pool, unit):
+        """
+        Run a unit on a driver borrowed from the pool.
+
+        A `pages` unit runs one FSM pass per page and records its progress after
+        every page; a `url` unit runs the FSM from `coordinator.url_state`.
+
+        Args:
+            pool (DriverPool): The driver pool.
+            unit (dict): The unit returned by `WorkQueue.claim`.
+        """
+        with pool.driver() as driver:
+            worker = self.scraper._spawn_worker(driver)
+            try:
+                if unit['kind'] == 'pages':
+                    initial_state = worker.config['initial_state']
+                    first_page = unit['progress'] or unit['payload']['first_page']
+                    for page in range(first_page, unit['payload']['last_page'] + 1):
+                        worker.config['states'][initial_state]['parameters']['next_page'] = page
+                        worker.scrape_site(single_pass=True)
+                        self._count('pages')
+                        if not self.queue.progress(unit, self.owner, page + 1):
+                            logger.warning(f"> Unit {unit['id']} was delivered to another worker, giving it up.")
+                            return
+                elif unit['kind'] == 'url':
+                    if self.url_config is None:
+                        raise ValueError("URL units require coordinator.url_state.")
+                    config = copy.deepcopy(self.url_config)
+                    config['states'][config['initial_state']]['parameters']['link'] = unit['payload']['url']
+                    worker.scrape_site(config=config, single_pass=True)
+                    self._count('urls')
+                else:
+                    raise ValueError(f"Invalid work unit kind: {unit['kind']}")
+            finally:
+                # A worker without a pooled driver may have started one for a fallback
+                if worker.driver is not None and worker.driver is not driver:
+                    worker.driver.quit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Spread a crawl over several workers through a shared work queue.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('plan', 'Split the crawl of a configuration into work units.'),
+                            ('work', 'Claim and run the work units of a configuration.'),
+                            ('stats', 'Count the work units of a configuration by status.'),
+                            ('reset', 'Remove the work units of a configuration.')):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('config', help='The scraper configuration.')
+        if name == 'work':
+            command.add_argument('--threads', type=int, help='The number of units run at once.')
+            command.add_argument('--owner', help='The identifier of this worker.')
+            command.add_argument('--follow', action='store_true', help='Keep polling for new units.')
+    args = parser.parse_args()
+
+    from metrics import configure_logging
+    configure_logging(args.config)
+    from Scrapper import Scraper
+    scraper = Scraper(args.config)
+    scraper.interactive = False
+    queue = open_queue(scraper.config)
+    if args.command == 'plan':
+        print(f"{plan(scraper, queue)} units added: {queue.stats(scraper.crawl_id)}")
+    elif args.command == 'work':
+        print(CrawlWorker(scraper, queue, args.owner, args.threads).run(args.follow))
+    elif args.command == 'stats':
+        print(queue.stats(scraper.crawl_id))
+    else:
+        queue.reset(scraper.crawl_id)
+
+
+if __name__ == '__main__':
+    main()
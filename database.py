@@ -1,10 +1,92 @@
+import csv
+import hashlib
+import io
+import json
 import os
+import threading
+import time
+from collections.abc import Mapping
+from datetime import datetime
 import yaml
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, exc,ARRAY,Enum
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, exc,ARRAY,Enum, Index, text, select, update, delete, inspect, MetaData, Table, bindparam, \
+    UniqueConstraint, func
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import sessionmaker, declarative_base
 from contextlib import contextmanager
+from cache import QueryCache
+
+# Filter operators, used as {"Prix": {"gte": 100000}} or as Prix__gte=100000 in a query string
+FILTER_OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(value),
+    'not_in': lambda column, value: column.not_in(value),
+    'like': lambda column, value: column.like(value),
+    'ilike': lambda column, value: column.ilike(value),
+    'is_null': lambda column, value: column.is_(None) if value else column.is_not(None),
+}
+
+SCHEMA_LOCK_KEY = 7340091  # PostgreSQL advisory lock serializing schema migrations
+
+# The fingerprint of the table configuration the schema was last migrated to
+schema_metadata = MetaData()
+schema_meta = Table(
+    'schema_meta', schema_metadata,
+    Column('key', String, primary_key=True),
+    Column('value', String, nullable=False),
+    Column('updated_at', Float, nullable=False),
+)
+
+
+class TableClasses(Mapping):
+    """The ORM classes of the configured tables by name, each built on first access."""
+
+    def __init__(self, build, configs):
+        """
+        Parameters:
+            build (callable): Builds the class of a table from its configuration.
+            configs (dict): The table configurations by name.
+        """
+        self._build = build
+        self._configs = configs
+        self._classes = {}
+        self._building = set()
+        self._lock = threading.RLock()
+
+    def __getitem__(self, name):
+        table_class = self._classes.get(name)
+        if table_class is not None:
+            return table_class
+        if name not in self._configs:
+            raise KeyError(name)
+        with self._lock:
+            if name not in self._classes and name not in self._building:
+                self._building.add(name)
+                try:
+                    self._classes[name] = self._build(self._configs[name])
+                finally:
+                    self._building.discard(name)
+            return self._classes.get(name)
+
+    def __contains__(self, name):
+        return name in self._configs
+
+    def __iter__(self):
+        return iter(self._configs)
+
+    def __len__(self):
+        return len(self._configs)
+
+    def build_all(self):
+        """Build the classes of every table."""
+        for name in self._configs:
+            self[name]
 
-Base = declarative_base()
 
 class DatabaseManager:
     """A class to manage database operations based on a provided configuration."""
@@ -21,23 +103,45 @@ class DatabaseManager:
 
         self.engine = self._configure_engine()
         self.Session = sessionmaker(bind=self.engine)  # Create a sessionmaker instance
+        self._configure_options()
         self._create_tables()
 
     def _configure_engine(self):
         """Configure the SQLAlchemy engine and return it."""
+        return create_engine(self._engine_url(), **self._engine_options())
+
+    def _engine_url(self, driver=None):
+        """
+        Build the database URL from the configuration.
+
+        Parameters:
+            driver (str): The DBAPI driver, e.g. 'asyncpg' (optional).
+
+        Returns:
+            str: The URL.
+        """
         db_config = self.config['database']
-        pooling_config = self.config['pooling']
         password =    db_config['password']
+        scheme = f"postgresql+{driver}" if driver else "postgresql"
+        return f"{scheme}://{db_config['username']}:{password}@{db_config['host']}:{db_config['port']}/{db_config['name']}"
 
-        engine = create_engine(
-            f"postgresql://{db_config['username']}:{password}@{db_config['host']}:{db_config['port']}/{db_config['name']}",
-            echo=self.config['sqlalchemy']['echo'],
-            pool_size=pooling_config['pool_size'],
-            max_overflow=pooling_config['max_overflow'],
-            pool_timeout=pooling_config['pool_timeout'],
-            pool_recycle=pooling_config['pool_recycle']
-        )
-        return engine
+    def _engine_options(self):
+        """Return the engine options of the `sqlalchemy` and `pooling` sections."""
+        pooling_config = self.config['pooling']
+        return {
+            'echo': self.config['sqlalchemy']['echo'],
+            'pool_size': pooling_config['pool_size'],
+            'max_overflow': pooling_config['max_overflow'],
+            'pool_timeout': pooling_config['pool_timeout'],
+            'pool_recycle': pooling_config['pool_recycle'],
+        }
+
+    def _configure_options(self):
+        """Read the bulk loading and query cache settings."""
+        self.copy_threshold = self.config.get('bulk', {}).get('copy_threshold', 10000)
+        cache_config = self.config.get('cache', {})
+        self.cache = QueryCache(cache_config.get('ttl', 30), cache_config.get('max_entries', 1024)) \
+            if cache_config.get('enabled') else None
 
     @contextmanager
     def session_scope(self):
@@ -55,22 +159,220 @@ class DatabaseManager:
 
     def _create_tables(self):
         """
-        Dynamically create a class for each table and create all tables in the engine.
-        This function also handles tables dict that helps with mapping table names to 
-        their respective classes.
+        Prepare the table classes and bring the database schema up to date.
+
+        On a warm start, when the schema was already migrated to this table
+        configuration, this costs two queries whatever the number of tables.
+        The changes applied are kept in `schema_changes`.
         """
-        self.tables = {}
-        for table in self.config['tables']:
-            attrs = {
-                '__tablename__': table['name'],
-                'id': Column('ID', Integer, primary_key=True)
-            }
-            for column in table['columns']:
-                if column['name'] != 'ID':
-                    attrs[column['name']] = Column(column['name'], self._get_column_type(column), ForeignKey(column['foreign_key']) if 'foreign_key' in column else None)
-            table_class = type(table['name'], (Base,), attrs)
-            self.tables[table['name']] = table_class  
-        Base.metadata.create_all(self.engine)
+        self._build_tables()
+        with self.engine.begin() as connection:
+            self.schema_changes = self._sync_schema(connection)
+
+    def migrate(self, force=False):
+        """
+        Bring the database schema up to date with the table configuration.
+
+        Parameters:
+            force (bool): Compare the configuration with the database even if
+                the stored fingerprint matches, e.g. after a manual change.
+
+        Returns:
+            list: The DDL changes applied.
+        """
+        with self.engine.begin() as connection:
+            return self._sync_schema(connection, force)
+
+    def _build_tables(self):
+        """
+        Register the table classes of the configuration, built on first use.
+
+        Each manager has its own declarative base, so that several managers
+        (e.g. a synchronous and an asynchronous one) can live in one process.
+        """
+        self.Base = declarative_base()
+        self.tables = TableClasses(self._build_table, {table['name']: table for table in self.config['tables']})
+
+    def _build_table(self, table):
+        """
+        Dynamically create the class of a table of the configuration.
+
+        The tables it references are built first, so that its foreign keys resolve.
+
+        Parameters:
+            table (dict): The table information.
+
+        Returns:
+            type: The ORM class of the table.
+        """
+        for column in table['columns']:
+            referenced = column['foreign_key'].split('.')[0] if 'foreign_key' in column else None
+            if referenced in self.tables:
+                self.tables[referenced]
+        attrs = {'__tablename__': table['name']}
+        if table.get('indices'):
+            attrs['__table_args__'] = tuple(self._build_index(index) for index in table['indices'])
+        if not any(column.get('primary_key') for column in table['columns']):
+            attrs['id'] = Column('ID', Integer, primary_key=True)
+        for column in table['columns']:
+            attribute = 'id' if column['name'] == 'ID' else column['name']
+            attrs[attribute] = self._build_column(column)
+        return type(table['name'], (self.Base,), attrs)
+
+    def _schema_fingerprint(self):
+        """Return the hash of the table configuration."""
+        return hashlib.sha256(json.dumps(self.config['tables'], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _stored_fingerprint(connection):
+        """Return the fingerprint the schema was last migrated to, or None."""
+        if not inspect(connection).has_table('schema_meta'):
+            return None
+        return connection.execute(select(schema_meta.c.value).where(schema_meta.c.key == 'fingerprint')).scalar()
+
+    def _sync_schema(self, connection, force=False):
+        """
+        Migrate the schema if the table configuration changed since the last migration.
+
+        Concurrent migrations are serialized with an advisory lock on PostgreSQL.
+
+        Parameters:
+            connection (Connection): A connection in a transaction.
+            force (bool): Migrate even if the stored fingerprint matches.
+
+        Returns:
+            list: The DDL changes applied.
+        """
+        fingerprint = self._schema_fingerprint()
+        if not force and self._stored_fingerprint(connection) == fingerprint:
+            return []
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': SCHEMA_LOCK_KEY})
+            if not force and self._stored_fingerprint(connection) == fingerprint:
+                return []
+        changes = self._migrate_schema(connection)
+        if any(change.startswith('Skipped') for change in changes):
+            # Keep the old fingerprint, so that the next start retries the migration.
+            return changes
+        schema_meta.create(connection, checkfirst=True)
+        connection.execute(delete(schema_meta).where(schema_meta.c.key == 'fingerprint'))
+        connection.execute(schema_meta.insert().values(key='fingerprint', value=fingerprint, updated_at=time.time()))
+        return changes
+
+    def _migrate_schema(self, connection):
+        """
+        Create the missing tables, columns, indexes and unique constraints of the configuration.
+
+        Columns and tables that are no longer configured are left in place,
+        and column type changes are not applied.
+
+        Parameters:
+            connection (Connection): A connection in a transaction.
+
+        Returns:
+            list: The DDL changes applied.
+        """
+        self.tables.build_all()
+        inspector = inspect(connection)
+        existing = set(inspector.get_table_names())
+        changes = []
+        for table in self.Base.metadata.sorted_tables:
+            if table.name not in existing:
+                table.create(connection)
+                changes.append(f"Created table {table.name}")
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    definition = CreateColumn(column).compile(dialect=connection.dialect)
+                    table_name = connection.dialect.identifier_preparer.quote(table.name)
+                    connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {definition}"))
+                    changes.append(f"Added column {table.name}.{column.name}")
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(connection)
+                    changes.append(f"Created index {index.name}")
+            changes.extend(self._migrate_unique_constraints(connection, inspector, table))
+        for change in changes:
+            print(f"Schema migration: {change}")
+        return changes
+
+    def _migrate_unique_constraints(self, connection, inspector, table):
+        """
+        Add the unique constraints of the configuration that an existing table lacks, as unique indexes.
+
+        `upsert_records` needs them for `ON CONFLICT`. A constraint is not added
+        while the table holds duplicate keys (NULL keys are not duplicates): they
+        must be removed first, and the migration is retried on the next start.
+
+        Parameters:
+            connection (Connection): A connection in a transaction.
+            inspector (Inspector): The inspector of the connection.
+            table (Table): The table.
+
+        Returns:
+            list: The DDL changes applied, or skipped.
+        """
+        existing = {tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(table.name)}
+        existing |= {tuple(index['column_names']) for index in inspector.get_indexes(table.name) if index['unique']}
+        changes = []
+        for constraint in table.constraints:
+            if not isinstance(constraint, UniqueConstraint):
+                continue
+            columns = list(constraint.columns)
+            names = tuple(column.name for column in columns)
+            if names in existing:
+                continue
+            duplicates = connection.execute(
+                select(func.count()).select_from(
+                    select(*columns).where(*(column.is_not(None) for column in columns))
+                    .group_by(*columns).having(func.count() > 1).subquery())).scalar()
+            index_name = f"uq_{table.name.lower()}_{'_'.join(names).lower()}"
+            if duplicates:
+                changes.append(f"Skipped unique index {index_name}: {duplicates} duplicate keys to remove first")
+                continue
+            Index(index_name, *columns, unique=True).create(connection)
+            changes.append(f"Created unique index {index_name}")
+        return changes
+
+    def _build_column(self, column):
+        """
+        Build the SQLAlchemy column for a column of the configuration.
+
+        The `primary_key`, `unique`, `nullable` and `default` options are
+        honoured. The default is also declared on the server side so that it
+        applies to rows loaded with COPY.
+
+        Parameters:
+            column (dict): The column information.
+
+        Returns:
+            Column: The SQLAlchemy column.
+        """
+        options = {key: column[key] for key in ('primary_key', 'unique', 'nullable', 'index') if key in column}
+        if 'default' in column:
+            options['default'] = column['default']
+            options['server_default'] = str(column['default'])
+        return Column(column['name'], self._get_column_type(column),
+                      ForeignKey(column['foreign_key']) if 'foreign_key' in column else None, **options)
+
+    def _build_index(self, index):
+        """
+        Build a single-column, composite or partial index of the configuration.
+
+        Parameters:
+            index (dict): The index information (`name`, `columns`, optional
+                `unique` and `where`, a SQL condition making the index partial).
+
+        Returns:
+            Index: The SQLAlchemy index.
+        """
+        options = {'unique': index.get('unique', False)}
+        if 'where' in index:
+            options['postgresql_where'] = text(index['where'])
+            options['sqlite_where'] = text(index['where'])
+        return Index(index['name'], *index['columns'], **options)
 
     def _get_column_type(self, column):
         """
@@ -125,48 +427,560 @@ class DatabaseManager:
         except Exception as e:
             print(f"Failed to add record: {e}")
             return False
+        self._invalidate(table_name)
         return True
 
+    def _invalidate(self, table_name):
+        """Drop the cached queries of a table after a write."""
+        if self.cache is not None:
+            self.cache.invalidate(table_name)
+
+    def add_records(self, table_name, rows):
+        """
+        Insert many records in a single transaction.
+
+        Rows are inserted with a Core `insert()` executed as an executemany,
+        grouped by the set of columns they provide so that missing columns
+        keep their defaults. On PostgreSQL, batches of at least
+        `bulk.copy_threshold` rows are loaded with COPY instead.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (list): The records, as dictionaries of column values.
+
+        Returns:
+            int: The number of records added, or None if the insert failed.
+        """
+        try:
+            table, rows = self._prepare_rows(table_name, rows)
+            if not rows:
+                return 0
+            if self._can_copy(table) and len(rows) >= self.copy_threshold:
+                count = self._copy_records(table, rows)
+                self._invalidate(table_name)
+                return count
+            with self.engine.begin() as connection:
+                for group in self._group_rows(rows):
+                    connection.execute(table.insert(), group)
+        except Exception as e:
+            print(f"Failed to add records: {e}")
+            return None
+        self._invalidate(table_name)
+        return len(rows)
+
+    def _prepare_rows(self, table_name, rows):
+        """
+        Check that rows only provide columns of the table, and convert their
+        values to the column types (ISO dates received as JSON strings, for
+        instance, which asyncpg and SQLite reject for a DateTime column).
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (iterable): The records, as dictionaries of column values.
+
+        Returns:
+            tuple: The table and the converted rows as a list.
+
+        Raises:
+            ValueError: If a row provides an unknown column or a value of the wrong type.
+        """
+        table = self.tables[table_name].__table__
+        rows = list(rows)
+        unknown = {key for row in rows for key in row} - set(table.columns.keys())
+        if unknown:
+            raise ValueError(f"Unknown columns for table {table_name}: {sorted(unknown)}")
+        rows = [{name: self._coerce(table.c[name], value) for name, value in row.items()} for row in rows]
+        return table, rows
+
+    @staticmethod
+    def _group_rows(rows):
+        """Group rows by the set of columns they provide, for executemany."""
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        return list(groups.values())
+
+    def _can_copy(self, table):
+        """Tell whether COPY can be used to load the given table."""
+        return (self.engine.dialect.name == 'postgresql' and
+                not any(isinstance(column.type, ARRAY) for column in table.columns))
+
+    def _copy_records(self, table, rows):
+        """
+        Load records with PostgreSQL COPY.
+
+        Rows are copied in groups providing the same columns, so that the
+        columns a row omits keep their server defaults instead of NULL.
+
+        Parameters:
+            table (Table): The table.
+            rows (list): The records, as dictionaries of column values.
+
+        Returns:
+            int: The number of records added.
+        """
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for group in self._group_rows(rows):
+                columns = [column.name for column in table.columns if column.name in group[0]]
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for row in group:
+                    writer.writerow(['\\N' if row[column] is None else row[column] for column in columns])
+                buffer.seek(0)
+                column_list = ', '.join(f'"{column}"' for column in columns)
+                cursor.copy_expert(f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')', buffer)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+        return len(rows)
+
+    def upsert_records(self, table_name, rows, conflict_columns=None):
+        """
+        Insert many records, updating the existing ones that share their unique key.
+
+        This issues `INSERT ... ON CONFLICT (...) DO UPDATE` so that re-scraped
+        listings replace their previous version instead of being duplicated.
+        Only the columns provided by a row are updated. Within a batch, the
+        last row of a key wins; rows without a key are all inserted.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (list): The records, as dictionaries of column values.
+            conflict_columns (list): The unique columns identifying a record
+                (optional, defaults to the `unique` columns of the configuration).
+
+        Returns:
+            int: The number of records inserted or updated, or None if the upsert failed.
+        """
+        try:
+            batches, count = self._upsert_batches(table_name, rows, conflict_columns)
+            with self.engine.begin() as connection:
+                for statement, group in batches:
+                    connection.execute(statement, group)
+        except Exception as e:
+            print(f"Failed to upsert records: {e}")
+            return None
+        self._invalidate(table_name)
+        return count
+
+    def _upsert_batches(self, table_name, rows, conflict_columns=None):
+        """
+        Build the `INSERT ... ON CONFLICT` statements of an upsert.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (iterable): The records, as dictionaries of column values.
+            conflict_columns (list): The unique columns identifying a record (optional).
+
+        Returns:
+            tuple: The (statement, rows) pairs to execute and the number of distinct records.
+
+        Raises:
+            ValueError: If the table has no unique column, a column is unknown
+                or the dialect does not support upserts.
+        """
+        table, rows = self._prepare_rows(table_name, rows)
+        conflict_columns = conflict_columns or self._unique_columns(table_name)
+        if not conflict_columns:
+            raise ValueError(f"No unique column to detect conflicts on in table {table_name}")
+        dialect_insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}.get(self.engine.dialect.name)
+        if dialect_insert is None:
+            raise ValueError(f"Upserts are not supported on {self.engine.dialect.name}")
+
+        # A NULL key never conflicts, so only the rows with a complete key are deduplicated
+        keyed_rows, unkeyed_rows = {}, []
+        for row in rows:
+            key = tuple(row.get(column) for column in conflict_columns)
+            if any(value is None for value in key):
+                unkeyed_rows.append(row)
+            else:
+                keyed_rows[key] = row
+        unique_rows = list(keyed_rows.values()) + unkeyed_rows
+        batches = []
+        for group in self._group_rows(unique_rows):
+            statement = dialect_insert(table)
+            updates = {key: statement.excluded[key] for key in group[0] if key not in conflict_columns}
+            if updates:
+                statement = statement.on_conflict_do_update(index_elements=conflict_columns, set_=updates)
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=conflict_columns)
+            batches.append((statement, group))
+        return batches, len(unique_rows)
+
+    def _unique_columns(self, table_name):
+        """Return the names of the columns declared unique in the configuration."""
+        for table in self.config['tables']:
+            if table['name'] == table_name:
+                return [column['name'] for column in table['columns'] if column.get('unique')]
+        return []
+
     def update_record(self, table_name, filters, **kwargs):
+        """
+        Update every record matching the filters with a single UPDATE statement.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters (see `_build_conditions`).
+            **kwargs: The new column values.
+
+        Returns:
+            int: The number of records updated, or None if the update failed.
+        """
         try:
-            with self.session_scope() as session:
-                records = session.query(self.tables[table_name]).filter_by(**filters).all()
-                for record in records:
-                    for key, value in kwargs.items():
-                        setattr(record, key, value)
-                return len(records)
+            statement = self._update_statement(table_name, filters, kwargs)
+            with self.engine.begin() as connection:
+                count = connection.execute(statement).rowcount
         except Exception as e:
             print(f"Failed to update records: {e}")
             return None
+        self._invalidate(table_name)
+        return count
 
     def delete_records(self, table_name, filters):
+        """
+        Delete every record matching the filters with a single DELETE statement.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters (see `_build_conditions`).
+
+        Returns:
+            int: The number of records deleted, or None if the delete failed.
+        """
         try:
-            with self.session_scope() as session:
-                records = session.query(self.tables[table_name]).filter_by(**filters).all()
-                for record in records:
-                    session.delete(record)
-                return len(records)
+            statement = self._delete_statement(table_name, filters)
+            with self.engine.begin() as connection:
+                count = connection.execute(statement).rowcount
         except Exception as e:
             print(f"Failed to delete records: {e}")
             return None
-    
-    def get_records(self, table_name, **kwargs):
+        self._invalidate(table_name)
+        return count
+
+    def claim_records(self, table_name, filters, limit, fields=None, **kwargs):
+        """
+        Atomically set new values on the first records matching the filters and return them.
+
+        The records are selected by ID and updated with a single statement;
+        on PostgreSQL the rows already locked by another claimer are skipped
+        (`FOR UPDATE SKIP LOCKED`), so that concurrent workers claim disjoint
+        batches.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters selecting the claimable records (see `_build_conditions`).
+            limit (int): The maximum number of records to claim.
+            fields (list): The columns to return besides the ID (optional, all columns).
+            **kwargs: The new column values marking the records as claimed.
+
+        Returns:
+            list: The claimed records, as dictionaries ordered by ID, or None if the claim failed.
+        """
         try:
-            filters = kwargs.get('filters', {})
-            limit = kwargs.get('limit', -1)
+            statement, key = self._claim_statement(table_name, filters, limit, fields, kwargs)
+            with self.engine.begin() as connection:
+                records = [dict(row._mapping) for row in connection.execute(statement)]
+        except Exception as e:
+            print(f"Failed to claim records: {e}")
+            return None
+        self._invalidate(table_name)
+        return sorted(records, key=lambda record: record[key])
 
-            with self.session_scope() as session:
-                query = session.query(self.tables[table_name]).filter_by(**filters)
+    def _claim_statement(self, table_name, filters, limit, fields, values):
+        """Build the UPDATE ... RETURNING statement of `claim_records`, and return it with the name of the ID column."""
+        table = self.tables[table_name].__table__
+        key = list(table.primary_key.columns)[0]
+        columns = [key] + [table.c[name] for name in fields if name != key.name] if fields else list(table.columns)
+        claimable = (select(key).where(*self._build_conditions(table, filters))
+                     .order_by(key).limit(limit).with_for_update(skip_locked=True))
+        values = {name: self._coerce(table.c[name], value) for name, value in values.items()}
+        statement = update(table).where(key.in_(claimable.scalar_subquery())).values(**values).returning(*columns)
+        return statement, key.name
+
+    def update_records(self, table_name, rows):
+        """
+        Update many records by ID, each with its own values, in one transaction.
+
+        Rows providing the same columns are sent together as one executemany
+        UPDATE statement.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (iterable): The records, as dictionaries of column values including the ID.
+
+        Returns:
+            int: The number of records updated, or None if the update failed.
+        """
+        try:
+            count = 0
+            with self.engine.begin() as connection:
+                for statement, parameters in self._update_batches(table_name, rows):
+                    count += connection.execute(statement, parameters).rowcount
+        except Exception as e:
+            print(f"Failed to update records: {e}")
+            return None
+        self._invalidate(table_name)
+        return count
+
+    def _update_batches(self, table_name, rows):
+        """
+        Build the executemany UPDATE statements of `update_records`.
+
+        Parameters:
+            table_name (str): The name of the table.
+            rows (iterable): The records, as dictionaries of column values including the ID.
+
+        Returns:
+            list: The (statement, parameters) pairs, one per group of rows providing the same columns.
+        """
+        table, rows = self._prepare_rows(table_name, rows)
+        key = list(table.primary_key.columns)[0]
+        batches = []
+        for group in self._group_rows(rows):
+            names = [name for name in group[0] if name != key.name]
+            if not names:
+                continue
+            statement = (update(table).where(key == bindparam('key_value'))
+                         .values({name: bindparam(f"value_{name}") for name in names}))
+            parameters = [dict({f"value_{name}": row[name] for name in names}, key_value=row[key.name])
+                          for row in group]
+            batches.append((statement, parameters))
+        return batches
+
+    def check_filters(self, table_name, filters):
+        """
+        Check that filters can be applied to a table, before running a query.
 
-                if limit != -1:
-                    query = query.limit(limit)
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The filters (see `_build_conditions`).
+
+        Raises:
+            ValueError: If the table, a column or an operator is unknown, or a
+                value does not convert to the type of its column.
+        """
+        if table_name not in self.tables:
+            raise ValueError(f"Invalid table {table_name}")
+        self._build_conditions(self.tables[table_name].__table__, filters or {})
+
+    def _update_statement(self, table_name, filters, values):
+        """Build the UPDATE statement of `update_record`."""
+        table = self.tables[table_name].__table__
+        values = {key: self._coerce(table.c[key], value) for key, value in values.items()}
+        return update(table).where(*self._build_conditions(table, filters)).values(**values)
+
+    def _delete_statement(self, table_name, filters):
+        """Build the DELETE statement of `delete_records`."""
+        table = self.tables[table_name].__table__
+        return delete(table).where(*self._build_conditions(table, filters))
+
+    def _is_slow(self, elapsed):
+        """Tell whether a query duration calls for its plan to be logged."""
+        settings = self.config.get('sqlalchemy', {})
+        return settings.get('explain_slow_queries', False) and elapsed * 1000 >= settings.get('slow_query_ms', 200)
+
+    def _explain_statement(self, statement):
+        """
+        Build the EXPLAIN query of a statement, with its parameters inlined.
+
+        Parameters:
+            statement (Select): The statement.
+
+        Returns:
+            tuple: The compiled statement and the EXPLAIN query.
+        """
+        compiled = statement.compile(dialect=self.engine.dialect, compile_kwargs={'literal_binds': True})
+        prefix = 'EXPLAIN ' if self.engine.dialect.name == 'postgresql' else 'EXPLAIN QUERY PLAN '
+        return compiled, text(prefix + str(compiled))
+
+    @staticmethod
+    def _print_plan(compiled, plan, elapsed):
+        print(f"Slow query ({elapsed * 1000:.0f} ms): {compiled}")
+        for row in plan:
+            print(f"    {' '.join(str(value) for value in row)}")
+
+    def _check_slow_query(self, session, statement, elapsed):
+        """
+        Log the query plan of a query slower than `sqlalchemy.slow_query_ms`.
+
+        Nothing is done unless `sqlalchemy.explain_slow_queries` is true.
+
+        Parameters:
+            session (Session | Connection): The session or connection the query ran in.
+            statement (Select): The query statement.
+            elapsed (float): The query duration in seconds.
+        """
+        if not self._is_slow(elapsed):
+            return
+        try:
+            compiled, explain = self._explain_statement(statement)
+            self._print_plan(compiled, session.execute(explain).fetchall(), elapsed)
+        except Exception as e:
+            print(f"Failed to explain slow query: {e}")
+
+    def _build_conditions(self, table, filters):
+        """
+        Build the WHERE conditions matching the given filters.
+
+        A filter is either a plain value (equality), a dictionary of operators
+        such as {"gte": 100000, "lt": 200000} or {"in": ["Casablanca", "Rabat"]},
+        or a key suffixed with its operator as in query strings (`Prix__gte`).
+        The operators are those of `FILTER_OPERATORS`. Values are converted to
+        the type of the column, e.g. ISO dates for DateTime columns.
+
+        Parameters:
+            table (Table): The table.
+            filters (dict): The filters, by column name.
+
+        Returns:
+            list: The SQLAlchemy conditions.
+
+        Raises:
+            ValueError: If a column or an operator is unknown, or a value does
+                not convert to the type of its column.
+        """
+        conditions = []
+        for key, value in filters.items():
+            name, _, operator = key.partition('__')
+            operations = value if isinstance(value, dict) else {operator or 'eq': value}
+            if name not in table.c:
+                raise ValueError(f"Invalid filter column {name} for table {table.name}")
+            column = table.c[name]
+            for operator, operand in operations.items():
+                if operator not in FILTER_OPERATORS:
+                    raise ValueError(f"Invalid filter operator {operator} on {name}")
+                if operator in ('in', 'not_in') and isinstance(operand, str):
+                    operand = operand.split(',')
+                if operator == 'is_null' and isinstance(operand, str):
+                    operand = operand.lower() in ('1', 'true', 'yes')
+                else:
+                    operand = self._coerce(column, operand)
+                conditions.append(FILTER_OPERATORS[operator](column, operand))
+        return conditions
+
+    def _coerce(self, column, value):
+        """
+        Convert a value, typically a string from a query string, to the type of a column.
+
+        Parameters:
+            column (Column): The column.
+            value: The value, or a list of values.
+
+        Returns:
+            The converted value.
+        """
+        if isinstance(value, list):
+            return [self._coerce(column, item) for item in value]
+        if not isinstance(value, str):
+            return value
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            return value
+        if python_type is datetime:
+            return datetime.fromisoformat(value)
+        if python_type in (int, float):
+            return python_type(value)
+        return value
+
+    def _select_records(self, table_name, filters=None, fields=None, after=None, limit=-1):
+        """
+        Build the SELECT statement of a page of records.
+
+        Records are ordered by ID so that `after` works as a keyset cursor.
+        The ID column is always part of the projection.
+
+        Parameters:
+            table_name (str): The name of the table.
+            filters (dict): The column values to match (optional).
+            fields (list): The columns to return (optional, all by default).
+            after (int): Only return records with a greater ID (optional).
+            limit (int): The maximum number of records, -1 for no limit.
+
+        Returns:
+            Select: The statement.
+        """
+        table = self.tables[table_name].__table__
+        key = table.c['ID']
+        columns = [key] + [table.c[field] for field in fields if field != 'ID'] if fields else list(table.c)
+        statement = select(*columns).where(*self._build_conditions(table, filters or {})).order_by(key)
+        if after is not None:
+            statement = statement.where(key > after)
+        if limit != -1:
+            statement = statement.limit(limit)
+        return statement
+
+    def get_records(self, table_name, **kwargs):
+        """
+        Get the records of a table matching the given filters.
+
+        Parameters:
+            table_name (str): The name of the table.
+            **kwargs: `filters` (dict), `fields` (list of columns), `after`
+                (ID of the last record of the previous page) and `limit`.
+
+        Returns:
+            list: The records as dictionaries, or None if the query failed.
+
+        Note:
+            When the `cache` section of the configuration is enabled, results
+            are served from the query cache; they must not be modified. Only
+            the writes of this manager invalidate it: rows written by other
+            processes may show up only after `cache.ttl` seconds.
+        """
+        if self.cache is None:
+            return self._get_records(table_name, **kwargs)
+        params = {key: kwargs.get(key) for key in ('filters', 'fields', 'after', 'limit')}
+        return self.cache.get_or_load(table_name, params, lambda: self._get_records(table_name, **kwargs))
 
-                records = query.all()
-                return [self._record_to_dict(record) for record in records]
+    def _get_records(self, table_name, **kwargs):
+        """Run the query of `get_records` against the database."""
+        try:
+            statement = self._select_records(
+                table_name,
+                filters=kwargs.get('filters', {}),
+                fields=kwargs.get('fields'),
+                after=kwargs.get('after'),
+                limit=kwargs.get('limit', -1),
+            )
+            with self.engine.connect() as connection:
+                start = time.perf_counter()
+                records = [dict(row._mapping) for row in connection.execute(statement)]
+                self._check_slow_query(connection, statement, time.perf_counter() - start)
+                return records
         except Exception as e:
             print(f"Failed to get records: {e}")
             return None
 
+    def iter_records(self, table_name, batch_size=1000, **kwargs):
+        """
+        Stream the records of a table from a server-side cursor.
+
+        Parameters:
+            table_name (str): The name of the table.
+            batch_size (int): The number of rows fetched from the cursor at a time.
+            **kwargs: The same options as `get_records`.
+
+        Yields:
+            dict: The records.
+        """
+        statement = self._select_records(
+            table_name,
+            filters=kwargs.get('filters', {}),
+            fields=kwargs.get('fields'),
+            after=kwargs.get('after'),
+            limit=kwargs.get('limit', -1),
+        )
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(statement)
+            for row in result:
+                yield dict(row._mapping)
+
 '''
 if __name__ == "__main__":
     db_manager = DatabaseManager('configDB.yaml')
@@ -0,0 +1,250 @@
+"""
+Listing Enrichment
+
+This file fills in the details of the listings already stored in the
+database (rooms, surfaces, floor...), which only appear on their detail pages.
+Instead of running the FSM once per listing, `Enricher` drains the backlog in
+batches:
+    - it claims a batch of rows in state `New` with a single statement
+      (`FOR UPDATE SKIP LOCKED` on PostgreSQL), marking them `Enriching`, so
+      that any number of enrichers can run at once on disjoint rows;
+    - it downloads their detail pages concurrently over pooled HTTP
+      connections, within the politeness limits of the configuration;
+    - it extracts the fields of the `enrichment` section with a compiled
+      extraction plan and converts them to the types of their columns;
+    - it writes the whole batch back with one executemany UPDATE, advancing
+      `Etat` to `Enriched`, `Removed` (404/410) or `Failed`.
+Rows left `Enriching` by a stopped enricher are put back in the backlog with
+`--requeue`.
+
+Author: mdakk072
+
+Usage:
+    python enrich.py configAvito2.yaml
+    python enrich.py configAvito2.yaml --threads 32 --batch-size 200 --follow
+    python enrich.py configAvito2.yaml --requeue --retry-failed
+
+"""
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from lxml import html
+from extraction import ExtractionPlan
+from fetcher import HttpFetcher
+from normalize import read_number
+
+logger = logging.getLogger(__name__)
+
+CLAIMED, ENRICHED, REMOVED, FAILED = 'Enriching', 'Enriched', 'Removed', 'Failed'
+
+
+class Enricher:
+    """Claim listings in batches, fetch their detail pages concurrently and store their details."""
+
+    def __init__(self, scraper, db_manager, settings=None):
+        """
+        Initialize the enricher.
+
+        Args:
+            scraper (Scraper): The scraper of the configuration, for its user agent, politeness limits and metrics.
+            db_manager (DatabaseManager): The database holding the listings.
+            settings (dict): The enrichment settings (optional, the `enrichment` section of the configuration).
+
+        Raises:
+            ValueError: If a field is not a column of the table or its specification is invalid.
+        """
+        settings = settings if settings is not None else scraper.config.get('enrichment', {})
+        self.scraper = scraper
+        self.db_manager = db_manager
+        self.table = settings.get('table', 'Proprietes')
+        self.url_column = settings.get('url_column', 'URLAnnonce')
+        self.status_column = settings.get('status_column', 'Etat')
+        self.pending = settings.get('pending', 'New')
+        self.batch_size = settings.get('batch_size', 100)
+        self.threads = settings.get('threads', 16)
+        self.poll_interval = settings.get('poll_interval', 30)
+        self.plan = ExtractionPlan(data_to_find=settings.get('fields', {}))
+        table = db_manager.tables[self.table].__table__
+        self.key = list(table.primary_key.columns)[0].name
+        unknown = [key for key, _, _ in self.plan.fields if key not in table.c]
+        if unknown:
+            raise ValueError(f"Unknown columns for table {self.table}: {unknown}")
+        self.types = {key: table.c[key].type.python_type for key, _, _ in self.plan.fields}
+        self.fetcher = HttpFetcher(scraper.config.get('userAgent'), pool_size=self.threads,
+                                   timeout=scraper.config.get('http', {}).get('timeout', 15))
+        self.stats = {'batches': 0, ENRICHED: 0, REMOVED: 0, FAILED: 0}
+
+    def claim(self):
+        """
+        Claim the next batch of listings to enrich.
+
+        Returns:
+            list: The claimed listings, as dictionaries with their ID and URL.
+        """
+        records = self.db_manager.claim_records(self.table, {self.status_column: self.pending}, self.batch_size,
+                                                fields=[self.url_column], **{self.status_column: CLAIMED})
+        if records is None:
+            raise RuntimeError(f"Could not claim listings from {self.table}.")
+        return records
+
+    def enrich_record(self, record):
+        """
+        Fetch the detail page of a listing and extract its fields.
+
+        Args:
+            record (dict): The claimed listing.
+
+        Returns:
+            dict: The row to write back: the ID, the fields found and the new state.
+        """
+        from requests.exceptions import HTTPError, RequestException
+        row = {self.key: record[self.key]}
+        url = record[self.url_column]
+        if not url:
+            return dict(row, **{self.status_column: FAILED})
+        try:
+            with self.scraper.metrics.track('enrich'):
+                with self.scraper.limiter.slot(url):
+                    page_html = self.fetcher.get(url)
+                self.scraper.metrics.add('enrich', 'bytes_fetched', len(page_html))
+                values = self.plan.extract_fields(html.fromstring(page_html))
+        except HTTPError as error:
+            gone = error.response is not None and error.response.status_code in (404, 410)
+            if not gone:
+                logger.error(f"An error occurred while fetching {url}: {str(error)}")
+            return dict(row, **{self.status_column: REMOVED if gone else FAILED})
+        except (RequestException, ValueError) as error:
+            logger.error(f"An error occurred while enriching {url}: {str(error)}")
+            return dict(row, **{self.status_column: FAILED})
+        for name, value in values.items():
+            value = self._convert(name, value)
+            if value is not None:
+                row[name] = value
+        return dict(row, **{self.status_column: ENRICHED})
+
+    def _convert(self, name, value):
+        """Convert an extracted text to the type of its column, or None if it does not parse."""
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        value = ' '.join(value.split())
+        python_type = self.types[name]
+        if python_type in (int, float):
+            number = read_number(value)
+            return None if number is None else python_type(round(number) if python_type is int else number)
+        if python_type is datetime:
+            try:
+                return datetime.fromisoformat(value)
+            except ValueError:
+                return None
+        return value or None
+
+    def run(self, follow=False, max_batches=None):
+        """
+        Enrich batches until the backlog is empty.
+
+        A batch interrupted by an error is put back in the backlog.
+
+        Args:
+            follow (bool): Keep polling for new listings instead of returning.
+            max_batches (int): Stop after this number of batches (optional).
+
+        Returns:
+            dict: The number of batches and of listings per new state, and the
+                throughput in listings per minute.
+        """
+        start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                while max_batches is None or self.stats['batches'] < max_batches:
+                    records = self.claim()
+                    if not records:
+                        if not follow:
+                            break
+                        time.sleep(self.poll_interval)
+                        continue
+                    self._run_batch(executor, records)
+        finally:
+            self.fetcher.close()
+        elapsed = time.monotonic() - start
+        done = self.stats[ENRICHED] + self.stats[REMOVED] + self.stats[FAILED]
+        summary = dict(self.stats, elapsed=elapsed, listings_per_minute=done * 60 / elapsed if elapsed else 0)
+        logger.info(f"> Enrichment done: {summary}")
+        return summary
+
+    def _run_batch(self, executor, records):
+        """Enrich a claimed batch and write it back, or release it on error."""
+        batch_start = time.monotonic()
+        try:
+            rows = list(executor.map(self.enrich_record, records))
+            if self.db_manager.update_records(self.table, rows) is None:
+                raise RuntimeError(f"Could not write the enriched listings to {self.table}.")
+        except BaseException:
+            self.release(records)
+            raise
+        self.stats['batches'] += 1
+        for row in rows:
+            self.stats[row[self.status_column]] += 1
+        self.scraper.metrics.add('enrich', 'records_emitted', len(rows))
+        elapsed = time.monotonic() - batch_start
+        logger.info(f"> Batch of {len(rows)} listings enriched in {elapsed:.1f}s "
+                    f"({len(rows) * 60 / elapsed if elapsed else 0:.0f}/min): {self.stats}")
+
+    def release(self, records):
+        """
+        Put claimed listings back in the backlog.
+
+        Args:
+            records (list): The listings returned by `claim`.
+        """
+        rows = [{self.key: record[self.key], self.status_column: self.pending} for record in records]
+        self.db_manager.update_records(self.table, rows)
+
+    def requeue(self, retry_failed=False):
+        """
+        Put back in the backlog the listings left claimed by stopped enrichers,
+        and optionally the failed ones. Run it while no enricher is running.
+
+        Args:
+            retry_failed (bool): Also retry the listings whose enrichment failed.
+
+        Returns:
+            int: The number of listings put back.
+        """
+        states = [CLAIMED, FAILED] if retry_failed else [CLAIMED]
+        return self.db_manager.update_record(self.table, {self.status_column: {'in': states}},
+                                             **{self.status_column: self.pending})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Enrich the stored listings with the details of their pages.')
+    parser.add_argument('config', help='The scraper configuration, with an `enrichment` section.')
+    parser.add_argument('--threads', type=int, help='The number of pages fetched at once.')
+    parser.add_argument('--batch-size', type=int, help='The number of listings claimed at once.')
+    parser.add_argument('--max-batches', type=int, help='Stop after this number of batches.')
+    parser.add_argument('--follow', action='store_true', help='Keep polling for new listings.')
+    parser.add_argument('--requeue', action='store_true', help='Put the listings left claimed back in the backlog.')
+    parser.add_argument('--retry-failed', action='store_true', help='With --requeue, retry the failed listings too.')
+    args = parser.parse_args()
+
+    from metrics import configure_logging
+    configure_logging(args.config)
+    from Scrapper import Scraper
+    from database import DatabaseManager
+    scraper = Scraper(args.config)
+    settings = dict(scraper.config.get('enrichment', {}))
+    for name in ('threads', 'batch_size'):
+        if getattr(args, name):
+            settings[name] = getattr(args, name)
+    enricher = Enricher(scraper, DatabaseManager(settings.get('database', 'configDB.yaml')), settings)
+    if args.requeue:
+        print(f"{enricher.requeue(args.retry_failed)} listings put back in the backlog")
+    else:
+        print(enricher.run(args.follow, args.max_batches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Extraction helpers
+
+This file contains the lxml helpers behind the scraper's fused extraction
+stage: the page is parsed once, the BeautifulSoup-style selectors of the
+configuration are translated to XPath, and the per-field XPaths are evaluated
+directly on the matching elements of the live tree.
+
+`ExtractionPlan` compiles the selectors and field specifications of a state
+once, so that invalid expressions are reported when the configuration is
+loaded and no expression is re-compiled during the crawl.
+
+Author: mdakk072
+
+Usage:
+    plan = ExtractionPlan(selectors, data_to_find)
+    output_data = plan.extract(html.fromstring(page_html))
+
+"""
+import logging
+from lxml import etree
+from lxml.etree import tostring
+
+logger = logging.getLogger(__name__)
+
+EXTRACT_TYPES = ('text', 'attribute', 'element')
+
+
+def xpath_literal(value):
+    """
+    Quote a string for use in an XPath expression.
+
+    Args:
+        value (str): The string to quote.
+
+    Returns:
+        str: The XPath string literal.
+    """
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    parts = value.split("'")
+    return "concat(" + ", \"'\", ".join(f"'{part}'" for part in parts) + ")"
+
+
+def selector_to_xpath(selector):
+    """
+    Translate a BeautifulSoup `find_all` selector to an XPath expression.
+
+    Like BeautifulSoup, a single class name matches any element carrying that
+    class, while a value containing spaces must match the whole attribute.
+
+    Args:
+        selector (dict): The selector (`name`, `attrs` and/or attribute keywords).
+
+    Returns:
+        str: The XPath expression selecting the matching elements.
+    """
+    selector = dict(selector)
+    name = selector.pop('name', None) or '*'
+    attrs = dict(selector.pop('attrs', {}) or {})
+    if 'class_' in selector:
+        attrs['class'] = selector.pop('class_')
+    attrs.update(selector)
+
+    predicates = []
+    for attribute, value in attrs.items():
+        if value is True:
+            predicates.append(f"@{attribute}")
+        elif attribute == 'class' and ' ' not in value:
+            predicates.append(f"contains(concat(' ', normalize-space(@class), ' '), {xpath_literal(f' {value} ')})")
+        else:
+            predicates.append(f"@{attribute}={xpath_literal(value)}")
+    return f"descendant-or-self::{name}" + ''.join(f"[{predicate}]" for predicate in predicates)
+
+
+def scope_xpath(expression):
+    """
+    Make an absolute XPath relative to the element it is evaluated on.
+
+    The field XPaths of the configuration were written against a fragment
+    holding a single matching element, where `//` means "this element or any
+    of its descendants". Evaluated on the full page they would search the whole
+    document, so the leading step is rewritten onto the element's own axes.
+
+    Args:
+        expression (str): The XPath expression.
+
+    Returns:
+        str: The expression scoped to the context element.
+    """
+    if expression.startswith('//'):
+        return 'descendant-or-self::' + expression[2:]
+    if expression.startswith('/'):
+        return 'self::' + expression[1:]
+    return expression
+
+
+def extract_field(element, spec, elements=None):
+    """
+    Extract one field from an element according to its specification.
+
+    Args:
+        element (HtmlElement): The element holding the field.
+        spec (dict): The field specification (`attribute`, `extract`, `attribute_name`).
+        elements (list): The elements already matched by the field's XPath (optional).
+
+    Returns:
+        The extracted value, or None if nothing was found.
+    """
+    if elements is None:
+        elements = element.xpath(scope_xpath(spec['attribute']))
+    if not elements:
+        logger.debug("No elements found with XPath: %s", spec['attribute'])
+        return None
+    found = elements[0]
+    extract = spec.get('extract')
+    if extract == 'text':
+        return found.text_content()
+    if extract == 'attribute':
+        attribute_name = spec.get('attribute_name')
+        if not attribute_name:
+            logger.error("No attribute name specified for XPath attribute extraction.")
+            return None
+        return found.get(attribute_name)
+    if extract == 'element':
+        return tostring(found)
+    logger.error(f"Invalid extract type: {extract}")
+    return None
+
+
+def css_to_xpath(expression):
+    """
+    Translate a CSS selector to an XPath relative to the element it is evaluated on.
+
+    Args:
+        expression (str): The CSS selector.
+
+    Returns:
+        str: The equivalent XPath expression.
+    """
+    from cssselect import HTMLTranslator
+    return HTMLTranslator().css_to_xpath(expression, prefix='descendant-or-self::')
+
+
+class ExtractionPlan:
+    """
+    The compiled selectors and field specifications of an extraction state.
+
+    Selectors are translated to XPath and compiled into `lxml.etree.XPath`
+    objects once. Fields of type `xpath` are scoped and compiled, fields of
+    type `css` are translated to XPath first. Fields of other types are kept
+    out of the plan, as `extract_infos` does not implement them.
+    """
+
+    def __init__(self, selectors=None, data_to_find=None):
+        """
+        Compile and validate an extraction plan.
+
+        Args:
+            selectors (list): The BeautifulSoup-style selectors (optional).
+            data_to_find (dict): The field specifications, by field name (optional).
+
+        Raises:
+            ValueError: If a selector or a field specification is invalid.
+        """
+        self.selectors_spec = selectors
+        self.fields_spec = data_to_find
+        self.selectors = [self._compile(selector_to_xpath(selector), f"selector {selector}")
+                          for selector in selectors or []]
+        self.fields = []
+        for key, spec in (data_to_find or {}).items():
+            if spec.get('type') not in ('xpath', 'css'):
+                continue
+            if spec.get('extract') not in EXTRACT_TYPES:
+                raise ValueError(f"Invalid extract type for field '{key}': {spec.get('extract')}")
+            if spec['extract'] == 'attribute' and not spec.get('attribute_name'):
+                raise ValueError(f"No attribute name specified for field '{key}'.")
+            if spec['type'] == 'css':
+                try:
+                    expression = css_to_xpath(spec['attribute'])
+                except Exception as error:
+                    raise ValueError(f"Invalid CSS selector for field '{key}': {str(error)}") from error
+            else:
+                expression = scope_xpath(spec['attribute'])
+            self.fields.append((key, spec, self._compile(expression, f"field '{key}'")))
+
+    @staticmethod
+    def _compile(expression, label):
+        try:
+            return etree.XPath(expression)
+        except etree.XPathSyntaxError as error:
+            raise ValueError(f"Invalid XPath for {label}: {expression} ({str(error)})") from error
+
+    def matches(self, selectors=None, data_to_find=None):
+        """
+        Tell whether the plan was compiled from the given specifications.
+
+        Args:
+            selectors (list): The selectors (optional).
+            data_to_find (dict): The field specifications (optional).
+
+        Returns:
+            bool: True if the plan can be used for these specifications.
+        """
+        return ((selectors is None or selectors == self.selectors_spec) and
+                (data_to_find is None or data_to_find == self.fields_spec))
+
+    def extract_fields(self, element):
+        """
+        Extract every field of the plan from an element.
+
+        Args:
+            element (HtmlElement): The element holding the fields.
+
+        Returns:
+            dict: The extracted values, by field name.
+        """
+        return {key: extract_field(element, spec, compiled(element))
+                for key, spec, compiled in self.fields}
+
+    def extract(self, tree):
+        """
+        Apply the selectors to a parsed page and extract the fields of each match.
+
+        Args:
+            tree (HtmlElement): The parsed page.
+
+        Returns:
+            dict: The extracted fields of the matching elements, by selector index.
+        """
+        output_data = {}
+        for ida, selector in enumerate(self.selectors):
+            elements = selector(tree)
+            logger.debug("Found %d elements with selector: %s", len(elements), self.selectors_spec[ida])
+            output_data[ida] = [self.extract_fields(element) for element in elements]
+        return output_data
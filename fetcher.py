@@ -0,0 +1,129 @@
+"""
+HTTP Fetcher
+
+This file contains the HTTP backend used by the scraper for pages that do not
+need JavaScript: a pooled, keep-alive `requests` session and helpers to locate
+elements in the server-rendered HTML with the same locators Selenium uses.
+
+Author: mdakk072
+
+Usage:
+    fetcher = HttpFetcher(user_agent)
+    page = fetcher.get('https://wololo.net/page/1/')
+    response = fetcher.fetch('https://wololo.net/page/1/', headers={'If-None-Match': etag})
+    element_html = find_static_element(page, 'CSS_SELECTOR', 'div.post-list.group')
+
+"""
+import threading
+from lxml import html
+
+
+class HttpFetcher:
+    """Fetch pages over a pooled, keep-alive HTTP session."""
+
+    def __init__(self, user_agent=None, pool_size=10, timeout=15):
+        """
+        Initialize the fetcher.
+
+        Args:
+            user_agent (str): The user agent sent with every request (optional).
+            pool_size (int): The number of connections kept alive per host.
+            timeout (int): The request timeout in seconds.
+        """
+        self.user_agent = user_agent
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None  # Created on first use, so that offline runs never import requests
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The pooled session, created on first use."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+                    if self.user_agent:
+                        session.headers.update({'User-Agent': self.user_agent})
+                    self._session = session
+        return self._session
+
+    def get(self, url):
+        """
+        Download a page.
+
+        Args:
+            url (str): The URL of the page.
+
+        Returns:
+            str: The HTML of the page.
+
+        Raises:
+            requests.exceptions.RequestException: If the request failed.
+        """
+        return self.fetch(url).text
+
+    def fetch(self, url, headers=None):
+        """
+        Send a GET request, e.g. a conditional one.
+
+        Args:
+            url (str): The URL of the page.
+            headers (dict): Extra request headers, such as `If-None-Match` (optional).
+
+        Returns:
+            Response: The response, with a 2xx or 304 status.
+
+        Raises:
+            requests.exceptions.RequestException: If the request failed.
+        """
+        response = self.session.get(url, headers=headers, timeout=self.timeout)
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
+
+    def close(self):
+        """Close the pooled connections."""
+        if self._session is not None:
+            self._session.close()
+
+
+STATIC_LOCATORS = {
+    'XPATH': lambda tree, value: tree.xpath(value),
+    'CSS_SELECTOR': lambda tree, value: tree.cssselect(value),
+    'ID': lambda tree, value: tree.xpath('//*[@id=$value]', value=value),
+    'NAME': lambda tree, value: tree.xpath('//*[@name=$value]', value=value),
+    'CLASS_NAME': lambda tree, value: tree.find_class(value),
+    'TAG_NAME': lambda tree, value: list(tree.iter(value)),
+}
+
+
+def find_static_element(page_html, by_method, value):
+    """
+    Locate an element in static HTML, the way `scrap_page` does in the browser.
+
+    Args:
+        page_html (str): The HTML of the page.
+        by_method (str): The Selenium locator name (e.g., 'XPATH', 'CSS_SELECTOR').
+        value (str): The value to search for.
+
+    Returns:
+        str: The outer HTML of the first matching element, or None if not found.
+
+    Raises:
+        ValueError: If the locator is not supported.
+    """
+    locator = STATIC_LOCATORS.get(by_method.upper())
+    if locator is None:
+        raise ValueError(f"Unsupported locator for static HTML: {by_method}")
+    tree = html.fromstring(page_html)
+    elements = locator(tree, value)
+    if not elements:
+        return None
+    return html.tostring(elements[0], encoding='unicode')
@@ -0,0 +1,244 @@
+"""
+URL Frontier
+
+This file contains `Frontier`, the disk-backed memory of the scraper across
+runs:
+    - a seen-set of every listing URL already scraped, stored as 64-bit
+      hashes in a SQLite index, with an in-memory Bloom filter in front of it
+      so that most new URLs are recognized without a disk lookup;
+    - a queue of the URLs to visit (e.g. detail pages), popped by priority,
+      the most recent first.
+
+Author: mdakk072
+
+Usage:
+    frontier = Frontier('frontier_avito.sqlite')
+    new_urls = frontier.add(urls)
+    url = frontier.pop()
+    frontier.done(url)
+
+"""
+import hashlib
+import math
+import sqlite3
+import threading
+import time
+from urllib.parse import urldefrag
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (
+    hash INTEGER PRIMARY KEY,
+    first_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY,
+    hash INTEGER NOT NULL UNIQUE,
+    url TEXT NOT NULL,
+    priority REAL NOT NULL,
+    claimed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_queue_priority ON queue (claimed, priority DESC, id);
+"""
+
+
+def url_hash(url):
+    """
+    Hash a URL (without its fragment) to a signed 64-bit integer.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        int: The hash, usable as a SQLite INTEGER.
+    """
+    digest = hashlib.blake2b(urldefrag(url.strip())[0].encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class BloomFilter:
+    """A Bloom filter over 64-bit hashes, using double hashing for its k positions."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Size the filter.
+
+        Args:
+            capacity (int): The number of items the filter is sized for.
+            error_rate (float): The false positive rate at capacity.
+        """
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        value &= 0xFFFFFFFFFFFFFFFF
+        first, second = value & 0xFFFFFFFF, value >> 32 | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & 1 << (position & 7) for position in self._positions(value))
+
+
+class Frontier:
+    """A persistent seen-set and priority queue of URLs, shared by threads."""
+
+    def __init__(self, path, capacity=1000000, error_rate=0.001):
+        """
+        Open (and create if needed) the frontier and load its Bloom filter.
+
+        URLs claimed by `pop` in a run that stopped before calling `done` are
+        queued again.
+
+        Args:
+            path (str): The path of the SQLite file.
+            capacity (int): The number of URLs the Bloom filter is sized for.
+            error_rate (float): The false positive rate of the Bloom filter at capacity.
+        """
+        self.path = path
+        self.lookups = 0  # Seen-set lookups that reached the SQLite index
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+        self._connection.execute('UPDATE queue SET claimed = 0 WHERE claimed = 1')
+        count = self._connection.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+        self.bloom = BloomFilter(max(capacity, count * 2), error_rate)
+        for (value,) in self._connection.execute('SELECT hash FROM seen'):
+            self.bloom.add(value)
+
+    def _is_seen(self, value):
+        if value not in self.bloom:
+            return False
+        self.lookups += 1
+        return self._connection.execute('SELECT 1 FROM seen WHERE hash = ?', (value,)).fetchone() is not None
+
+    def seen(self, url):
+        """
+        Tell whether a URL was already added.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            bool: True if the URL is in the seen-set.
+        """
+        with self._lock:
+            return self._is_seen(url_hash(url))
+
+    def filter_new(self, urls):
+        """
+        Return the URLs that are not in the seen-set, without adding them.
+
+        Args:
+            urls (iterable): The URLs.
+
+        Returns:
+            list: The new URLs, without duplicates, in their original order.
+        """
+        new, hashes = [], set()
+        with self._lock:
+            for url in urls:
+                value = url_hash(url)
+                if value not in hashes and not self._is_seen(value):
+                    hashes.add(value)
+                    new.append(url)
+        return new
+
+    def add(self, urls, priority=None, enqueue=True):
+        """
+        Add URLs to the seen-set and queue the new ones.
+
+        Args:
+            urls (iterable): The URLs.
+            priority (float): The priority of the queued URLs (optional, the
+                current time). Give the URLs of a crawl the time it started, so
+                that URLs found by a later crawl come first.
+            enqueue (bool): Queue the new URLs to be visited.
+
+        Returns:
+            list: The URLs that were not seen before.
+        """
+        priority = time.time() if priority is None else priority
+        new = []
+        with self._lock:
+            cursor = self._connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                for url in urls:
+                    value = url_hash(url)
+                    # Another process sharing the file may have added it since the filter was loaded
+                    if self._is_seen(value) or not cursor.execute(
+                            'INSERT OR IGNORE INTO seen (hash, first_seen) VALUES (?, ?)', (value, time.time())).rowcount:
+                        self.bloom.add(value)
+                        continue
+                    if enqueue:
+                        cursor.execute('INSERT OR IGNORE INTO queue (hash, url, priority) VALUES (?, ?, ?)',
+                                       (value, url, priority))
+                    self.bloom.add(value)
+                    new.append(url)
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+        return new
+
+    def pop(self):
+        """
+        Claim the queued URL with the highest priority.
+
+        URLs of the same priority come in the order they were added.
+
+        Returns:
+            str: The URL, or None if the queue is empty.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT hash, url FROM queue WHERE claimed = 0 ORDER BY priority DESC, id LIMIT 1').fetchone()
+            if row is None:
+                return None
+            self._connection.execute('UPDATE queue SET claimed = 1 WHERE hash = ?', (row[0],))
+            return row[1]
+
+    def done(self, url):
+        """
+        Remove a URL claimed by `pop` from the queue once it has been visited.
+
+        Args:
+            url (str): The URL.
+        """
+        with self._lock:
+            self._connection.execute('DELETE FROM queue WHERE hash = ?', (url_hash(url),))
+
+    def release(self, url):
+        """
+        Queue again a URL claimed by `pop` that could not be visited.
+
+        Args:
+            url (str): The URL.
+        """
+        with self._lock:
+            self._connection.execute('UPDATE queue SET claimed = 0 WHERE hash = ?', (url_hash(url),))
+
+    def stats(self):
+        """
+        Return the size of the seen-set and the queue.
+
+        Returns:
+            dict: The number of seen URLs, queued URLs and index lookups.
+        """
+        with self._lock:
+            return {
+                'seen': self._connection.execute('SELECT COUNT(*) FROM seen').fetchone()[0],
+                'queued': self._connection.execute('SELECT COUNT(*) FROM queue').fetchone()[0],
+                'lookups': self.lookups,
+            }
+
+    def close(self):
+        """Close the frontier."""
+        with self._lock:
+            self._connection.close()
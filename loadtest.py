@@ -0,0 +1,182 @@
+"""
+Load Test
+
+A small load generator to compare the throughput of the API servers, e.g. the
+Flask API against its ASGI variant. Each worker thread keeps its own
+keep-alive session and sends requests in a loop: GET reads, or POST writes of
+batches of generated listings (`--method POST`). The run reports the
+throughput, the latency percentiles and the number of failed requests.
+
+Reads are measured against the database, not the query cache: the servers
+must run with `cache.enabled: false` in configDB.yaml (`--allow-cache` to
+measure the cache anyway).
+
+Author: mdakk072
+
+Usage:
+    python api.py &
+    python api_async.py &
+    python loadtest.py http://127.0.0.1:5000 http://127.0.0.1:5001 \\
+        --path "/get_record/Proprietes?Etat=New&limit=50" --concurrency 64 --requests 5000
+    python loadtest.py http://127.0.0.1:5000 http://127.0.0.1:5001 \\
+        --method POST --path /upsert_records/Proprietes --batch-size 100 --concurrency 8
+
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+DEFAULT_PATHS = {'GET': '/get_record/Proprietes?limit=50', 'POST': '/upsert_records/Proprietes'}
+
+
+def make_records(prefix, number, batch_size):
+    """
+    Generate a batch of listings to write, with URLs unique to the run.
+
+    Args:
+        prefix (str): The prefix of the URLs, unique to the run.
+        number (int): The number of the request.
+        batch_size (int): The number of listings.
+
+    Returns:
+        list: The listings.
+    """
+    return [{
+        'URLAnnonce': f"{prefix}/{number}/{index}",
+        'Type': 'Appartement',
+        'Ville': 'Casablanca',
+        'Quartier': 'Maarif',
+        'Prix': 950000.0 + index,
+        'NombreChambres': 2 + index % 3,
+        'SurfaceHabitable': 85.0,
+        'Etat': 'New',
+    } for index in range(batch_size)]
+
+
+def cache_enabled(base_url):
+    """
+    Tell whether the query cache of a server is enabled.
+
+    Args:
+        base_url (str): The address of the server.
+
+    Returns:
+        bool: True if `/cache_stats` answers, i.e. reads may be served from the cache.
+    """
+    try:
+        return requests.get(base_url.rstrip('/') + '/cache_stats', timeout=10).ok
+    except requests.exceptions.RequestException:
+        return False
+
+
+def run(base_url, path, concurrency, total, method='GET', batch_size=100):
+    """
+    Send `total` requests to a server from `concurrency` threads.
+
+    Args:
+        base_url (str): The address of the server.
+        path (str): The path requested, with its query string.
+        concurrency (int): The number of requests in flight.
+        total (int): The number of requests.
+        method (str): GET to read, POST to write batches of generated listings.
+        batch_size (int): The number of listings per POST request.
+
+    Returns:
+        dict: The throughput (requests and, for POST, records per second),
+            latency percentiles (in ms) and error count.
+    """
+    url = base_url.rstrip('/') + path
+    latencies = []
+    errors = []
+    counter = iter(range(total))
+    lock = threading.Lock()
+    prefix = f"https://loadtest/{uuid.uuid4().hex}"
+    headers = {'Content-Type': 'application/json'}
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                break
+            # The body is built before the clock starts
+            body = json.dumps({'records': make_records(prefix, number, batch_size)}) if method == 'POST' else None
+            start = time.perf_counter()
+            try:
+                if method == 'POST':
+                    ok = session.post(url, data=body, headers=headers, timeout=30).ok
+                else:
+                    ok = session.get(url, timeout=30).ok
+            except requests.exceptions.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if ok else errors).append(elapsed)
+        session.close()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    duration = time.perf_counter() - start
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else None
+    return {
+        'url': url,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / duration,
+        'records_per_s': len(latencies) * batch_size / duration if method == 'POST' else None,
+        'mean_ms': statistics.mean(latencies) * 1000 if latencies else None,
+        'p50_ms': percentile(0.50),
+        'p99_ms': percentile(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the throughput of API servers.')
+    parser.add_argument('base_urls', nargs='+', help='The servers to load, e.g. http://127.0.0.1:5000')
+    parser.add_argument('--method', choices=sorted(DEFAULT_PATHS), default='GET',
+                        help='GET to read, POST to write batches of generated listings.')
+    parser.add_argument('--path', help='The path requested (by default /get_record/Proprietes?limit=50 '
+                                       'for GET, /upsert_records/Proprietes for POST).')
+    parser.add_argument('--batch-size', type=int, default=100, help='The number of listings per POST request.')
+    parser.add_argument('--allow-cache', action='store_true',
+                        help='Measure reads even if the query cache of a server is enabled.')
+    parser.add_argument('--concurrency', type=int, default=32, help='The number of requests in flight.')
+    parser.add_argument('--requests', type=int, default=2000, help='The number of requests per server.')
+    parser.add_argument('--warmup', type=int, default=100, help='The number of requests sent before measuring.')
+    args = parser.parse_args()
+    path = args.path or DEFAULT_PATHS[args.method]
+
+    if args.method == 'GET' and not args.allow_cache:
+        cached = [base_url for base_url in args.base_urls if cache_enabled(base_url)]
+        if cached:
+            parser.error(f"The query cache is enabled on {', '.join(cached)}: set cache.enabled to false "
+                         f"in configDB.yaml and restart the server, or pass --allow-cache.")
+
+    results = []
+    for base_url in args.base_urls:
+        if args.warmup:
+            run(base_url, path, args.concurrency, args.warmup, args.method, args.batch_size)
+        results.append(run(base_url, path, args.concurrency, args.requests, args.method, args.batch_size))
+
+    format_value = lambda value: f"{value:9.1f}" if value is not None else f"{'-':>9}"
+    print(f"{'server':<40} {'req/s':>9} {'rec/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for result in results:
+        print(f"{result['url'][:40]:<40} {result['rps']:9.1f} {format_value(result['records_per_s'])} "
+              f"{format_value(result['p50_ms'])} {format_value(result['p99_ms'])} {result['errors']:7d}")
+    if len(results) > 1 and results[0]['rps']:
+        for result in results[1:]:
+            print(f"{result['url'][:40]}: x{result['rps'] / results[0]['rps']:.2f} the throughput of {results[0]['url'][:40]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+"""
+Crawl Metrics
+
+This file contains `CrawlMetrics`, the per-state instrumentation of the
+scraper's FSM: for every state name it counts the calls, wall time (with a
+latency histogram), bytes fetched, elements matched, records emitted,
+errors and retries. The counters are thread-safe, so that the workers of a
+parallel crawl share them.
+
+They are exposed in the Prometheus text format by a small HTTP endpoint
+(`serve`) and/or written periodically as a JSON snapshot (`start_snapshots`).
+`ErrorCounter` is a logging handler counting the error records logged while
+a state runs, so that errors reported by the states themselves (which log
+and return None) are counted too. `configure_logging` sets up the root logger
+from the `logging` section of a configuration, once, in the entry points.
+
+Author: mdakk072
+
+Usage:
+    metrics = CrawlMetrics('avito')
+    with metrics.track('scrap_page'):
+        ...
+    metrics.add('goto_next_page', 'bytes_fetched', 51234)
+    metrics.serve(9108)
+
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COUNTERS = ('calls', 'seconds', 'bytes_fetched', 'elements_matched', 'records_emitted', 'errors', 'retries')
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlMetrics:
+    """Thread-safe counters and latency histograms of the FSM states."""
+
+    def __init__(self, crawl_id):
+        """
+        Initialize the metrics.
+
+        Args:
+            crawl_id (str): The crawl identifier, used as the `crawl` label.
+        """
+        self.crawl_id = crawl_id
+        self.started = time.time()
+        self.states = {}  # state -> counters
+        self.histograms = {}  # state -> count of calls per bucket
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._server = None
+        self._snapshots = None
+
+    @property
+    def current_state(self):
+        """The state run by the calling thread, or None."""
+        return getattr(self._local, 'state', None)
+
+    def _counters(self, state):
+        counters = self.states.get(state)
+        if counters is None:
+            counters = self.states[state] = dict.fromkeys(COUNTERS, 0)
+            self.histograms[state] = [0] * len(BUCKETS)
+        return counters
+
+    def add(self, state, name, value=1):
+        """
+        Increase a counter of a state.
+
+        Args:
+            state (str): The state name (None for the state run by the calling thread).
+            name (str): The counter, one of `COUNTERS`.
+            value (float): The increment.
+        """
+        state = state or self.current_state
+        if state is None:
+            return
+        with self._lock:
+            self._counters(state)[name] += value
+
+    @contextmanager
+    def track(self, state):
+        """
+        Time a run of a state and count it, and its error if it raises.
+
+        Errors logged by the calling thread meanwhile are attributed to the
+        state by `ErrorCounter`.
+
+        Args:
+            state (str): The state name.
+        """
+        previous, self._local.state = self.current_state, state
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.add(state, 'errors')
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self._local.state = previous
+            with self._lock:
+                counters = self._counters(state)
+                counters['calls'] += 1
+                counters['seconds'] += elapsed
+                histogram = self.histograms[state]
+                for index, bound in enumerate(BUCKETS):
+                    if elapsed <= bound:
+                        histogram[index] += 1
+                        break
+
+    def snapshot(self):
+        """
+        Return the current values of the metrics.
+
+        Returns:
+            dict: The crawl identifier, uptime and the counters (with the mean
+                latency) and histogram of each state.
+        """
+        with self._lock:
+            states = {}
+            for state, counters in self.states.items():
+                values = dict(counters)
+                values['mean_seconds'] = counters['seconds'] / counters['calls'] if counters['calls'] else 0.0
+                values['histogram'] = dict(zip((str(bound) for bound in BUCKETS), self.histograms[state]))
+                states[state] = values
+        return {'crawl': self.crawl_id, 'time': time.time(), 'uptime': time.time() - self.started, 'states': states}
+
+    def render_prometheus(self):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        with self._lock:
+            states = {state: (dict(counters), list(self.histograms[state])) for state, counters in self.states.items()}
+        crawl = self.crawl_id.replace('\\', '\\\\').replace('"', '\\"')
+        lines = []
+        for name in COUNTERS:
+            if name == 'seconds':
+                continue
+            metric = f"scraper_state_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for state, (counters, _) in states.items():
+                lines.append(f'{metric}{{crawl="{crawl}",state="{state}"}} {counters[name]}')
+        lines.append("# TYPE scraper_state_seconds histogram")
+        for state, (counters, histogram) in states.items():
+            labels = f'crawl="{crawl}",state="{state}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram):
+                cumulative += count
+                lines.append(f'scraper_state_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'scraper_state_seconds_bucket{{{labels},le="+Inf"}} {counters["calls"]}')
+            lines.append(f'scraper_state_seconds_sum{{{labels}}} {counters["seconds"]}')
+            lines.append(f'scraper_state_seconds_count{{{labels}}} {counters["calls"]}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='0.0.0.0'):
+        """
+        Expose the metrics on http://host:port/metrics from a background thread.
+
+        Args:
+            port (int): The port to listen on.
+            host (str): The address to listen on.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    body, content_type = metrics.render_prometheus(), 'text/plain; version=0.0.4'
+                elif self.path.split('?')[0] == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='MetricsServer', daemon=True).start()
+        logger.info("Metrics served on http://%s:%s/metrics", host, self._server.server_port)
+
+    def write_snapshot(self, path):
+        """
+        Write the snapshot of the metrics to a JSON file, atomically.
+
+        Args:
+            path (str): The path of the file.
+        """
+        temporary = f"{path}.tmp"
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(temporary, path)
+
+    def start_snapshots(self, path, interval=30):
+        """
+        Write the JSON snapshot every `interval` seconds from a background thread.
+
+        Args:
+            path (str): The path of the file.
+            interval (float): The number of seconds between two snapshots.
+        """
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(interval):
+                try:
+                    self.write_snapshot(path)
+                except OSError as error:
+                    logger.error("An error occurred while writing the metrics snapshot: %s", error)
+
+        self._snapshots = (stop, path)
+        threading.Thread(target=run, name='MetricsSnapshots', daemon=True).start()
+
+    def close(self):
+        """Stop the endpoint and write the last snapshot."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._snapshots is not None:
+            stop, path = self._snapshots
+            stop.set()
+            self.write_snapshot(path)
+            self._snapshots = None
+
+
+def configure_logging(config_file=None, level=None):
+    """
+    Configure the root logger from the `logging` section of a configuration,
+    unless the application did. Called once by the command line entry points.
+
+    Args:
+        config_file (str): The scraper configuration (optional): its `logging`
+            section gives the `level` (default INFO), `format` and `file`
+            (optional, stderr by default).
+        level (str): A level overriding the one of the configuration (optional).
+    """
+    settings = {}
+    if config_file:
+        import yaml
+        with open(config_file, 'r', encoding='utf-8') as file:
+            settings = (yaml.safe_load(file) or {}).get('logging', {})
+    logging.basicConfig(
+        level=getattr(logging, str(level or settings.get('level', 'INFO')).upper()),
+        format=settings.get('format', '%(asctime)s %(levelname)s %(name)s: %(message)s'),
+        filename=settings.get('file'),
+    )
+
+
+class ErrorCounter(logging.Handler):
+    """A logging handler counting the error records of a state in its metrics."""
+
+    def __init__(self, metrics):
+        super().__init__(level=logging.ERROR)
+        self.metrics = metrics
+
+    @classmethod
+    def attach(cls, metrics):
+        """
+        Count the errors of the root logger in metrics, once whatever the number of calls.
+
+        Args:
+            metrics (CrawlMetrics): The metrics receiving the errors.
+
+        Returns:
+            ErrorCounter: The handler attached to the root logger.
+        """
+        root = logging.getLogger()
+        for handler in root.handlers:
+            if isinstance(handler, cls) and handler.metrics is metrics:
+                return handler
+        handler = cls(metrics)
+        root.addHandler(handler)
+        return handler
+
+    def detach(self):
+        """Stop counting the errors of the root logger."""
+        logging.getLogger().removeHandler(self)
+
+    def emit(self, record):
+        self.metrics.add(None, 'errors')
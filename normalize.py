@@ -0,0 +1,293 @@
+"""
+Record Normalization
+
+This file converts the raw fields returned by the extraction states ("1 200
+000 DH", "il y a 3 heures", "Casablanca, Maarif", "12") into the typed columns
+of a database table, so that a page or a batch of records can be bulk
+inserted as is.
+
+`Normalizer` works on a whole batch at once: the records are loaded into a
+pandas DataFrame and every column is parsed with vectorized string
+operations and precompiled regular expressions instead of per-field Python
+code. City and quartier names are matched, accent- and case-insensitively,
+against the `Villes` and `Quartiers` tables, whose names are cached and
+reloaded every `lookup_ttl` seconds.
+
+Author: mdakk072
+
+Usage:
+    normalizer = Normalizer({'Prix': {'source': 'price', 'parse': 'number'}}, db_manager)
+    rows = normalizer.normalize(records)
+    db_manager.upsert_records('Proprietes', rows)
+
+"""
+import logging
+import re
+import threading
+import time
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# "1 200 000", "1.200.000", "85,5": dots and spaces followed by exactly 3 digits separate thousands
+NUMBER_PATTERN = re.compile(r'(\d+(?:[ \u00a0\u202f.]\d{3}(?!\d))*)(?:[.,](\d+))?')
+THOUSANDS_PATTERN = re.compile(r'[ \u00a0\u202f.]')
+# "il y a 3 heures", "il y a 2 j": a count and a unit only make a date after "il y a"
+RELATIVE_DATE_PATTERN = re.compile(
+    r'\bil y a\s+(\d+)\s*(minutes?|min|heures?|h|jours?|j|semaines?|sem|mois|ans?)\b')
+# "hier", "aujourd'hui 14:30", "hier à 9h05"
+DAY_PATTERN = re.compile(r"^\s*(hier|aujourd)\S*(?:\s+(?:à\s*)?(\d{1,2})\s*[:h]\s*(\d{2}))?")
+# French month names, translated for the absolute date parser: "2 juin 2024"
+MONTH_PATTERN = re.compile(r'\b(janvier|janv|février|fevrier|févr|fevr|mars|avril|avr|mai|juin|juillet|juil|'
+                           r'août|aout|septembre|sept|octobre|oct|novembre|nov|décembre|decembre|déc|dec)\b\.?')
+# "Appartements dans Casablanca, Maarif" or "Casablanca, Maarif"
+LOCATION_PATTERN = re.compile(r'^(?:.*\bdans\s+)?(?P<city>[^,]+?)(?:\s*,\s*(?P<quartier>.+?))?\s*$')
+UNIT_SECONDS = {
+    'minute': 60, 'minutes': 60, 'min': 60, 'heure': 3600, 'heures': 3600, 'h': 3600,
+    'jour': 86400, 'jours': 86400, 'j': 86400, 'semaine': 604800, 'semaines': 604800, 'sem': 604800,
+    'mois': 2592000, 'an': 31536000, 'ans': 31536000,
+}
+DAY_OFFSETS = {'aujourd': 0, 'hier': 1}
+MONTHS = {
+    'janvier': 'jan', 'janv': 'jan', 'février': 'feb', 'fevrier': 'feb', 'févr': 'feb', 'fevr': 'feb',
+    'mars': 'mar', 'avril': 'apr', 'avr': 'apr', 'mai': 'may', 'juin': 'jun', 'juillet': 'jul', 'juil': 'jul',
+    'août': 'aug', 'aout': 'aug', 'septembre': 'sep', 'sept': 'sep', 'octobre': 'oct', 'oct': 'oct',
+    'novembre': 'nov', 'nov': 'nov', 'décembre': 'dec', 'decembre': 'dec', 'déc': 'dec', 'dec': 'dec',
+}
+
+
+def read_number(text):
+    """
+    Read the first number of a text, such as "1.200.000 DH" or "Surface habitable 85,5 m²".
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        float: The number, or None if the text holds none.
+    """
+    match = NUMBER_PATTERN.search(text)
+    if match is None:
+        return None
+    integer, decimals = match.groups()
+    return float(f"{THOUSANDS_PATTERN.sub('', integer)}.{decimals or 0}")
+
+
+def lookup_key(names):
+    """
+    Reduce names to their lookup key: lower case, without accents nor punctuation.
+
+    Args:
+        names (Series): The names.
+
+    Returns:
+        Series: The keys.
+    """
+    return (names.str.normalize('NFKD').str.encode('ascii', 'ignore').str.decode('ascii')
+            .str.lower().str.replace(r'[^a-z0-9]+', ' ', regex=True).str.strip())
+
+
+def parse_text(values):
+    """Collapse the whitespace of texts, empty texts becoming null."""
+    values = values.str.replace(r'\s+', ' ', regex=True).str.strip()
+    return values.where(values != '')
+
+
+def parse_number(values):
+    """Read the first number of texts, such as "1 200 000 DH", "1.200.000 DH" or "85,5 m²" (see `read_number`)."""
+    parts = values.str.extract(NUMBER_PATTERN)
+    numbers = parts[0].str.replace(THOUSANDS_PATTERN, '', regex=True) + '.' + parts[1].fillna('0')
+    return pd.to_numeric(numbers, errors='coerce').astype(float)
+
+
+def parse_integer(values):
+    """Read the first number of texts as a nullable integer."""
+    return parse_number(values).round().astype('Int64')
+
+
+def parse_date(values, now=None):
+    """
+    Read publication dates, relative ("il y a 3 heures", "hier 14:30") or
+    absolute ("12/03/2024", "2 juin 2024").
+
+    Args:
+        values (Series): The texts.
+        now (Timestamp): The time relative dates are counted from (optional, now).
+
+    Returns:
+        Series: The dates, NaT where the text is not a date.
+    """
+    now = now if now is not None else pd.Timestamp.now().floor('min')
+    lowered = values.str.lower()
+    parts = lowered.str.extract(RELATIVE_DATE_PATTERN)
+    seconds = pd.to_numeric(parts[0], errors='coerce') * parts[1].map(UNIT_SECONDS)
+    dates = now - pd.to_timedelta(seconds, unit='s')
+    days = lowered.str.extract(DAY_PATTERN)
+    day = now.normalize() - pd.to_timedelta(days[0].map(DAY_OFFSETS), unit='D')
+    time_of_day = (pd.to_timedelta(pd.to_numeric(days[1], errors='coerce'), unit='h') +
+                   pd.to_timedelta(pd.to_numeric(days[2], errors='coerce'), unit='m'))
+    # Without a time of day, "hier" is counted back from now
+    dates = dates.fillna((day + time_of_day).fillna(now - (now.normalize() - day)))
+    absolute = lowered.where(dates.isna())
+    if absolute.notna().any():
+        absolute = absolute.str.replace(MONTH_PATTERN, lambda match: MONTHS[match.group(1)], regex=True)
+        absolute = absolute.str.replace(r'\s+à\s+', ' ', regex=True)
+        dates = dates.fillna(pd.to_datetime(absolute, errors='coerce', dayfirst=True, format='mixed'))
+    return dates
+
+
+def parse_location(values):
+    """
+    Split locations such as "Casablanca, Maarif" into their city and quartier.
+
+    Args:
+        values (Series): The texts.
+
+    Returns:
+        DataFrame: The `city` and `quartier` columns.
+    """
+    return parse_text(values).str.extract(LOCATION_PATTERN)
+
+
+PARSERS = {
+    'text': parse_text,
+    'number': parse_number,
+    'integer': parse_integer,
+    'date': parse_date,
+    'city': lambda values: parse_location(values)['city'],
+    'quartier': lambda values: parse_location(values)['quartier'],
+}
+
+
+class Normalizer:
+    """Convert batches of raw records into typed rows of a table, with vectorized parsing."""
+
+    def __init__(self, columns, db_manager=None, lookup_ttl=3600):
+        """
+        Initialize the normalizer.
+
+        Args:
+            columns (dict): By target column, the `source` field of the records
+                and its `parse` type, one of `PARSERS`.
+            db_manager (DatabaseManager): The database whose `Villes` and
+                `Quartiers` canonicalize the city and quartier names (optional).
+            lookup_ttl (float): The number of seconds the names are cached.
+
+        Raises:
+            ValueError: If a parse type is unknown.
+        """
+        for column, spec in columns.items():
+            if spec.get('parse', 'text') not in PARSERS:
+                raise ValueError(f"Invalid parse type for column '{column}': {spec.get('parse')}")
+        self.columns = columns
+        self.db_manager = db_manager
+        self.lookup_ttl = lookup_ttl
+        self._lookups = None
+        self._lookups_loaded = 0
+        self._lock = threading.Lock()
+
+    def normalize(self, records):
+        """
+        Convert a batch of raw records into rows of the target columns.
+
+        Args:
+            records (list): The raw records, as dictionaries.
+
+        Returns:
+            list: The rows, as dictionaries of typed values (None for the
+                values missing or not parsed), ready for a bulk insert.
+        """
+        if not records:
+            return []
+        frame = pd.DataFrame.from_records(records)
+        parsed = {}
+        by_source = {}  # The parsed values per (source, parser), e.g. a location for both its city and quartier
+        for column, spec in self.columns.items():
+            source = spec.get('source', column)
+            parse = spec.get('parse', 'text')
+            stage = 'location' if parse in ('city', 'quartier') else parse
+            if (source, stage) not in by_source:
+                values = frame[source] if source in frame else pd.Series(None, index=frame.index, dtype=object)
+                by_source[source, stage] = self._parse_distinct(values, stage)
+            result = by_source[source, stage]
+            parsed[column] = result[parse] if stage == 'location' else result
+        columns = {column: values.astype(object).where(values.notna(), None).tolist()
+                   for column, values in parsed.items()}
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    def _parse_distinct(self, values, stage):
+        """
+        Parse the distinct values of a field only, and spread the results over the batch.
+
+        Scraped fields repeat a lot within a batch (cities, types, relative
+        dates), so this parses a few values instead of one per record.
+
+        Args:
+            values (Series): The raw values of the field.
+            stage (str): The parser, one of `PARSERS` or 'location'.
+
+        Returns:
+            Series or DataFrame: The parsed values, aligned with `values`.
+        """
+        codes, uniques = pd.factorize(values.where(values.notna()))
+        uniques = pd.Series(uniques, dtype=object).astype('string')
+        if stage == 'location':
+            result = self._canonicalize(parse_location(uniques))
+        else:
+            result = PARSERS[stage](uniques)
+        return result.reindex(codes).set_axis(values.index)
+
+    def _canonicalize(self, locations):
+        """
+        Replace the city and quartier names found in the lookup tables by their canonical names.
+
+        Args:
+            locations (DataFrame): The `city` and `quartier` columns.
+
+        Returns:
+            DataFrame: The locations, with the canonical names.
+        """
+        if self.db_manager is None:
+            return locations
+        city_names, quartier_names, unique_quartiers = self._get_lookups()
+        city_keys = lookup_key(locations['city'])
+        quartier_keys = lookup_key(locations['quartier'])
+        quartiers = (city_keys + '|' + quartier_keys).map(quartier_names).fillna(quartier_keys.map(unique_quartiers))
+        return pd.DataFrame({
+            'city': city_keys.map(city_names).fillna(locations['city']),
+            'quartier': quartiers.fillna(locations['quartier']),
+        })
+
+    def _get_lookups(self):
+        """
+        Return the cached canonical names, reloading them from the database once they expire.
+
+        Returns:
+            tuple: The city names by key, the quartier names by "city key|quartier
+                key", and the quartier names by key when only one city has them.
+        """
+        with self._lock:
+            if self._lookups is None or time.monotonic() - self._lookups_loaded > self.lookup_ttl:
+                try:
+                    self._lookups = self._load_lookups()
+                except Exception as error:
+                    logger.error(f"An error occurred while loading the city and quartier names: {str(error)}")
+                    if self._lookups is None:
+                        self._lookups = ({}, {}, {})
+                self._lookups_loaded = time.monotonic()
+            return self._lookups
+
+    def _load_lookups(self):
+        """Load the names of the `Villes` and `Quartiers` tables."""
+        villes = pd.DataFrame(list(self.db_manager.iter_records('Villes')), columns=['ID', 'Nom'])
+        quartiers = pd.DataFrame(list(self.db_manager.iter_records('Quartiers')), columns=['ID', 'Nom', 'IDVille'])
+        villes['key'] = lookup_key(villes['Nom'].astype('string'))
+        quartiers['key'] = lookup_key(quartiers['Nom'].astype('string'))
+        city_names = dict(zip(villes['key'], villes['Nom']))
+        quartiers['city_key'] = quartiers['IDVille'].map(dict(zip(villes['ID'], villes['key'])))
+        located = quartiers.dropna(subset=['city_key'])
+        quartier_names = dict(zip(located['city_key'] + '|' + located['key'], located['Nom']))
+        unique = quartiers.drop_duplicates('key', keep=False)
+        unique_quartiers = dict(zip(unique['key'], unique['Nom']))
+        logger.info(f"> Loaded {len(city_names)} cities and {len(quartiers)} quartiers")
+        return city_names, quartier_names, unique_quartiers
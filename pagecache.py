@@ -0,0 +1,183 @@
+"""
+Page Cache
+
+This file contains `PageCache`, the local SQLite cache of the pages visited
+by the scraper. For every URL it keeps the `ETag` and `Last-Modified`
+validators of the last response, the hash of the content returned by
+`scrap_page` and the compressed HTML of the page, so that:
+    - pages are fetched conditionally, and a `304 Not Modified` is served
+      from the cache;
+    - a page whose scraped content did not change since the last visit is
+      not extracted again;
+    - cached pages can be replayed offline, to develop extraction rules
+      without touching the live site.
+
+Author: mdakk072
+
+Usage:
+    cache = PageCache('pages_avito.sqlite')
+    headers = cache.validators(url)
+    if cache.content_changed(url, page_html):
+        cache.store_content(url, page_html)
+    page = cache.get_page(url)
+
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    page BLOB,
+    fetched_at REAL
+);
+"""
+
+
+def content_hash(content):
+    """
+    Hash scraped content.
+
+    Args:
+        content (str): The content.
+
+    Returns:
+        str: The hex SHA-256 of the content.
+    """
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class PageCache:
+    """A SQLite cache of page validators, content hashes and HTML, shared by threads."""
+
+    def __init__(self, path):
+        """
+        Open (and create if needed) the cache.
+
+        Args:
+            path (str): The path of the SQLite file.
+        """
+        self.path = path
+        self.stats = {'not_modified': 0, 'unchanged': 0, 'changed': 0, 'replayed': 0}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.executescript(SCHEMA)
+
+    def validators(self, url):
+        """
+        Return the conditional request headers of a URL.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            dict: `If-None-Match` and/or `If-Modified-Since`, empty if the URL
+                was never fetched or its page is not cached.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT etag, last_modified FROM pages WHERE url = ? AND page IS NOT NULL', (url,)).fetchone()
+        headers = {}
+        if row is not None:
+            if row[0]:
+                headers['If-None-Match'] = row[0]
+            if row[1]:
+                headers['If-Modified-Since'] = row[1]
+        return headers
+
+    def store_page(self, url, page, etag=None, last_modified=None):
+        """
+        Cache the HTML of a page and the validators of its response.
+
+        Args:
+            url (str): The URL.
+            page (str): The HTML of the page.
+            etag (str): The `ETag` header of the response (optional).
+            last_modified (str): The `Last-Modified` header of the response (optional).
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT INTO pages (url, etag, last_modified, page, fetched_at) VALUES (?, ?, ?, ?, ?) '
+                'ON CONFLICT (url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, '
+                'page = excluded.page, fetched_at = excluded.fetched_at',
+                (url, etag, last_modified, zlib.compress(page.encode('utf-8')), time.time()))
+
+    def get_page(self, url):
+        """
+        Return the cached HTML of a page.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            str: The HTML, or None if the page is not cached.
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT page FROM pages WHERE url = ?', (url,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def content_changed(self, url, content):
+        """
+        Compare the content scraped from a page with the hash of the last visit.
+
+        Args:
+            url (str): The URL.
+            content (str): The content returned by `scrap_page`.
+
+        Returns:
+            bool: True if the content differs from the last visit (or is new).
+        """
+        with self._lock:
+            row = self._connection.execute('SELECT content_hash FROM pages WHERE url = ?', (url,)).fetchone()
+            changed = row is None or row[0] != content_hash(content)
+            self.stats['changed' if changed else 'unchanged'] += 1
+        return changed
+
+    def store_content(self, url, content, page=None):
+        """
+        Record the hash of the content scraped from a page, once it was extracted and delivered.
+
+        Args:
+            url (str): The URL.
+            content (str): The content returned by `scrap_page`.
+            page (str): The HTML of the whole page, cached with it (optional).
+        """
+        digest = content_hash(content)
+        with self._lock:
+            if page is not None:
+                self._connection.execute(
+                    'INSERT INTO pages (url, content_hash, page, fetched_at) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (url) DO UPDATE SET content_hash = excluded.content_hash, '
+                    'page = excluded.page, fetched_at = excluded.fetched_at',
+                    (url, digest, zlib.compress(page.encode('utf-8')), time.time()))
+            else:
+                self._connection.execute(
+                    'INSERT INTO pages (url, content_hash) VALUES (?, ?) '
+                    'ON CONFLICT (url) DO UPDATE SET content_hash = excluded.content_hash',
+                    (url, digest))
+
+    def urls(self):
+        """
+        Return the URLs whose page is cached, e.g. to replay them offline.
+
+        Returns:
+            list: The URLs, in the order they were last fetched.
+        """
+        with self._lock:
+            return [row[0] for row in self._connection.execute(
+                'SELECT url FROM pages WHERE page IS NOT NULL ORDER BY fetched_at')]
+
+    def close(self):
+        """Close the cache."""
+        with self._lock:
+            self._connection.close()
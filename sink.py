@@ -0,0 +1,206 @@
+"""
+Buffered Sink
+
+This file contains `BufferedSink`, the delivery side of the scraper: records
+are buffered in memory, flushed in batches when the batch is full or too old,
+and posted over a pooled keep-alive session by a background thread. Failed
+batches are retried with exponential backoff and spilled to a local NDJSON
+file when the API stays unreachable, so scraping never waits on the API.
+
+Author: mdakk072
+
+Usage:
+    sink = BufferedSink('http://127.0.0.1:5000/api/receive_dict', batch_size=100)
+    sink.put(records)
+    sink.close()
+
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class _Signal:
+    """A flush request queued behind the records, set once they are delivered."""
+
+    def __init__(self, close=False):
+        self.close = close
+        self.done = threading.Event()
+
+
+class BufferedSink:
+    """Deliver records to an HTTP endpoint in batches, on a background thread."""
+
+    def __init__(self, address, batch_size=100, max_age=5.0, retries=3, backoff=0.5,
+                 timeout=10, spill_file='spill.ndjson', max_pending=10000):
+        """
+        Initialize the sink and start its delivery thread.
+
+        Args:
+            address (str): The address the batches are posted to.
+            batch_size (int): The number of records that triggers a flush.
+            max_age (float): The age in seconds of the oldest buffered record that triggers a flush.
+            retries (int): The number of retries of a failed batch.
+            backoff (float): The delay before the first retry, doubled after each retry.
+            timeout (int): The request timeout in seconds.
+            spill_file (str): The NDJSON file receiving the batches that could not be delivered.
+            max_pending (int): The number of queued records above which `put` blocks.
+        """
+        self.address = address
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.spill_file = spill_file
+        self.stats = {'queued': 0, 'sent': 0, 'batches': 0, 'retries': 0, 'spilled': 0}
+        self._stats_lock = threading.Lock()  # put is called by the workers, the others by the delivery thread
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=1))
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='BufferedSink', daemon=True)
+        self._thread.start()
+
+    def put(self, records):
+        """
+        Queue records for delivery.
+
+        Args:
+            records (iterable): The records to deliver.
+
+        Returns:
+            int: The number of records queued.
+        """
+        count = 0
+        for record in records:
+            self._queue.put(record)
+            count += 1
+        self._count('queued', count)
+        return count
+
+    def flush(self):
+        """Deliver the buffered records now and wait until it is done."""
+        signal = _Signal()
+        self._queue.put(signal)
+        while not signal.done.wait(0.5) and self._thread.is_alive():
+            pass
+
+    def settled(self):
+        """
+        Return the number of queued records that were delivered or spilled.
+
+        Records are delivered in the order they were queued, so the records
+        queued before `stats['queued']` reached this number are no longer
+        only in memory.
+
+        Returns:
+            int: The number of records settled.
+        """
+        with self._stats_lock:
+            return self.stats['sent'] + self.stats['spilled']
+
+    def _count(self, name, count=1):
+        """Add to a counter of `stats`."""
+        with self._stats_lock:
+            self.stats[name] += count
+
+    def close(self):
+        """Deliver the buffered records and stop the delivery thread."""
+        if self._thread.is_alive():
+            self._queue.put(_Signal(close=True))
+            self._thread.join()
+        self.session.close()
+
+    def replay_spill(self):
+        """
+        Queue again the records of the spill file, e.g. once the API is back.
+
+        Returns:
+            int: The number of records queued.
+        """
+        if not os.path.exists(self.spill_file):
+            return 0
+        replay_file = f"{self.spill_file}.replay"
+        os.replace(self.spill_file, replay_file)
+        with open(replay_file, 'r', encoding='utf-8') as file:
+            count = self.put(json.loads(line) for line in file if line.strip())
+        os.remove(replay_file)
+        return count
+
+    def _run(self):
+        batch = []
+        oldest = None
+        while True:
+            timeout = None if not batch else max(0, oldest + self.max_age - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # The oldest buffered record reached max_age
+                self._deliver(batch)
+                batch = []
+                continue
+            if isinstance(item, _Signal):
+                if batch:
+                    self._deliver(batch)
+                batch = []
+                item.done.set()
+                if item.close:
+                    return
+                continue
+            if not batch:
+                oldest = time.monotonic()
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._deliver(batch)
+                batch = []
+
+    def _deliver(self, batch):
+        """
+        Post a batch, retrying with backoff, and spill it if it cannot be delivered.
+
+        Args:
+            batch (list): The records to post.
+        """
+        payload = json.dumps({'records': batch}, default=str)
+        headers = {'Content-Type': 'application/json'}
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(self.address, data=payload, headers=headers, timeout=self.timeout)
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    with self._stats_lock:
+                        self.stats['sent'] += len(batch)
+                        self.stats['batches'] += 1
+                    return
+                logger.warning(f"Sink received status {response.status_code} from {self.address}.")
+            except requests.exceptions.HTTPError as error:
+                # The API rejected the batch, retrying would not help
+                logger.error(f"An error occurred while sending data: {str(error)}")
+                break
+            except requests.exceptions.RequestException as error:
+                logger.error(f"An error occurred while sending data: {str(error)}")
+        self._spill(batch)
+
+    def _spill(self, batch):
+        """
+        Append a batch to the spill file.
+
+        Args:
+            batch (list): The records that could not be delivered.
+        """
+        with open(self.spill_file, 'a', encoding='utf-8') as file:
+            for record in batch:
+                file.write(json.dumps(record, default=str) + '\n')
+        self._count('spilled', len(batch))
+        logger.warning(f"Spilled {len(batch)} records to {self.spill_file}.")
@@ -0,0 +1,132 @@
+"""
+Smsar CLI
+
+The command line entry point of the project. Every subcommand imports only
+the backends it needs, when it runs:
+    - `crawl` runs a scraper configuration (Selenium is only loaded when a
+      state needs the browser);
+    - `serve` starts the API, with Flask or, with `--async`, Starlette;
+    - `extract` runs the extraction states of a configuration offline on
+      saved pages and writes the records as NDJSON (lxml only), or with
+      `--normalize` the typed rows of the `normalize` section (pandas);
+    - `migrate` brings the database schema up to date with the database
+      configuration (`--force` re-checks it even if its fingerprint is stored).
+
+Author: mdakk072
+
+Usage:
+    python smsar.py crawl configAvito.yaml --resume
+    python smsar.py crawl configAvito.yaml --parallel --workers 4
+    python smsar.py crawl configAvito.yaml --parallel --fresh
+    python smsar.py serve --async --port 5001
+    python smsar.py extract configAvito.yaml --from-cache pages_avito.sqlite --output records.ndjson
+    python smsar.py migrate configDB.yaml --force
+
+"""
+import argparse
+import json
+import sys
+
+
+def crawl(args):
+    from metrics import configure_logging
+    configure_logging(args.config)
+    from Scrapper import Scraper
+    scraper = Scraper(args.config)
+    if args.parallel:
+        print(scraper.scrape_site_parallel(args.workers, args.first_page, args.last_page, args.resume, args.fresh))
+    else:
+        if args.fresh:
+            scraper.checkpoint.reset(scraper.crawl_id)
+        scraper.scrape_site(single_pass=args.single_pass, stream=args.stream, resume=args.resume)
+
+
+def serve(args):
+    if args.use_async:
+        import uvicorn
+        import api_async
+        api_async.DB_CONFIG = args.db_config
+        uvicorn.run(api_async.app, host=args.host, port=args.port or 5001)
+    else:
+        import api
+        api.DB_CONFIG = args.db_config
+        api.get_db_manager()  # Fail at startup rather than on the first request
+        api.app.run(host=args.host, port=args.port or 5000, debug=args.debug)
+
+
+def extract(args):
+    from metrics import configure_logging
+    configure_logging(level='WARNING')
+    from benchmark import ExtractionBenchmark, load_fixtures
+    pages = load_fixtures(args.pages, args.from_cache)
+    if not pages:
+        raise SystemExit("No page to extract.")
+    extractor = ExtractionBenchmark(args.config)
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    count = 0
+    try:
+        for _, page_html in pages:
+            records = extractor.extract(page_html)
+            if args.normalize:
+                records = extractor.scraper.normalize_records(records)
+            for record in records:
+                output.write(json.dumps(record, default=str, ensure_ascii=False) + '\n')
+                count += 1
+    finally:
+        if args.output:
+            output.close()
+    print(f"{count} records extracted from {len(pages)} pages", file=sys.stderr)
+
+
+def migrate(args):
+    from database import DatabaseManager
+    db_manager = DatabaseManager(args.db_config)
+    changes = db_manager.migrate(force=True) if args.force else db_manager.schema_changes
+    print('\n'.join(changes) if changes else "Schema up to date.")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='smsar', description='Crawl, extract and serve real estate listings.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    crawl_parser = commands.add_parser('crawl', help='Run a scraper configuration.')
+    crawl_parser.add_argument('config', help='The scraper configuration.')
+    resume_group = crawl_parser.add_mutually_exclusive_group()
+    resume_group.add_argument('--resume', action='store_true', help='Continue the crawl from its checkpoint.')
+    resume_group.add_argument('--fresh', action='store_true',
+                              help='Forget the checkpoint and the claimed page ranges of the crawl first.')
+    crawl_parser.add_argument('--single-pass', action='store_true', help='Stop when the FSM comes back to its initial state.')
+    crawl_parser.add_argument('--stream', action='store_true', default=None, help='Stream the records to the sink.')
+    crawl_parser.add_argument('--parallel', action='store_true', help='Crawl the page range with a pool of drivers.')
+    crawl_parser.add_argument('--workers', type=int, help='The number of drivers of a parallel crawl.')
+    crawl_parser.add_argument('--first-page', type=int, help='The first page of a parallel crawl.')
+    crawl_parser.add_argument('--last-page', type=int, help='The last page of a parallel crawl.')
+    crawl_parser.set_defaults(handler=crawl)
+
+    serve_parser = commands.add_parser('serve', help='Start the API.')
+    serve_parser.add_argument('--async', dest='use_async', action='store_true', help='Serve the ASGI API with uvicorn.')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='The address to listen on.')
+    serve_parser.add_argument('--port', type=int, help='The port to listen on (5000, or 5001 with --async).')
+    serve_parser.add_argument('--db-config', default='configDB.yaml', help='The database configuration.')
+    serve_parser.add_argument('--debug', action='store_true', help='Run Flask in debug mode.')
+    serve_parser.set_defaults(handler=serve)
+
+    extract_parser = commands.add_parser('extract', help='Extract the records of saved pages offline, as NDJSON.')
+    extract_parser.add_argument('config', help='The scraper configuration.')
+    extract_parser.add_argument('pages', nargs='?', help='A directory of saved .html pages.')
+    extract_parser.add_argument('--from-cache', help='Use the pages of a page cache file.')
+    extract_parser.add_argument('--output', help='The NDJSON file to write (default: stdout).')
+    extract_parser.add_argument('--normalize', action='store_true', help='Write the typed rows of the normalize section.')
+    extract_parser.set_defaults(handler=extract)
+
+    migrate_parser = commands.add_parser('migrate', help='Bring the database schema up to date with its configuration.')
+    migrate_parser.add_argument('db_config', nargs='?', default='configDB.yaml', help='The database configuration.')
+    migrate_parser.add_argument('--force', action='store_true', help='Compare the schema even if its fingerprint is up to date.')
+    migrate_parser.set_defaults(handler=migrate)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
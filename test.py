@@ -12,24 +12,25 @@ cursor = conn.cursor()
 
 # Execute the query to fetch all records from the annonces table
 cursor.execute("SELECT * FROM annonces")
-rows = cursor.fetchall()
-
-# Iterate over each row
-for row in rows:
-    # Create a dictionary to hold the record data
-    record = {
-        'Type': row[1],
-        'URLAnnonce': row[2],
-        'Prix': row[4],
-        'DatePublication': row[5],
-        'Ville': row[6],
-        'URLImage': row[7],
-        'NombreImages': row[8]
-    }
-
-    # Use the POST method to add the record to the Proprietes table in the PostgreSQL database
-    response = requests.post(f'{base_url}/add_record/{table_name}', json=record)
-    print(response.json())  # Should print {'message': 'Record added.'} or {'message': 'Failed to add record.'}
+
+def ndjson_records(cursor):
+    # Stream the rows as NDJSON so that the whole table is never held in memory
+    for row in cursor:
+        record = {
+            'Type': row[1],
+            'URLAnnonce': row[2],
+            'Prix': row[4],
+            'DatePublication': row[5],
+            'Ville': row[6],
+            'URLImage': row[7],
+            'NombreImages': row[8]
+        }
+        yield (json.dumps(record) + '\n').encode('utf-8')
+
+# Use the bulk POST method to add all the records to the Proprietes table in the PostgreSQL database
+response = requests.post(f'{base_url}/add_records/{table_name}', data=ndjson_records(cursor),
+                         headers={'Content-Type': 'application/x-ndjson'})
+print(response.json())  # Should print {'message': 'X records added.', 'count': X} or a failure message
 
 # Close the connection to the SQLite database
 conn.close()